@@ -1,14 +1,39 @@
 #!/usr/bin/env python3
 import os
+import tempfile
+import threading
+import time
+import uuid
 import datetime
+import json
+import math
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import face_recognition
-from pymongo import MongoClient, ASCENDING
-from flask import Flask, flash, make_response, render_template, request, jsonify, redirect, url_for, session, send_from_directory
+from pymongo import ASCENDING
+import click
+from flask import Flask, Response, flash, g, make_response, render_template, request, jsonify, redirect, url_for, session, send_from_directory, stream_with_context
+from flask.cli import AppGroup
+from werkzeug.utils import secure_filename
 import logging
 from logging.handlers import RotatingFileHandler
 from bson.binary import Binary
 from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError
+from gallery import FaceGallery, select_templates
+from gallery_index import make_index
+from gallery_sync import GallerySync
+from metrics import COUNT_BUCKETS, CommandTimer, MetricsRegistry
+from mongo_pool import MongoClientManager
+from recent_cache import RecentRecognitions
+import attendance_export
+import attendance_records
+import attendance_rollups
+import bulk_enroll
+import encoding_format
+import face_pipeline
+import face_settings
+import student_listing
+from face_pipeline import FaceWorkerPool, FaceJobTimeout, InvalidImage, PoolSaturated
+from face_stream import StreamClosed, StreamLimitReached, StreamRegistry
 
 # Configure logging
 log_formatter = logging.Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]')
@@ -25,47 +50,153 @@ app = Flask(__name__)
 app.logger.addHandler(file_handler)
 app.logger.addHandler(console_handler)
 app.logger.setLevel(logging.INFO)
+
+# Helper modules log under the "eduvision" namespace
+module_logger = logging.getLogger('eduvision')
+module_logger.addHandler(file_handler)
+module_logger.addHandler(console_handler)
+module_logger.setLevel(logging.INFO)
 # Configurations for MongoDB
 app.config['MONGO_URI'] = 'mongodb://localhost:27017/'
 app.config['MONGO_DB_NAME'] = 'eduvision_db'
+# One MongoClient per process; these size its connection pool
+app.config['MONGO_MAX_POOL_SIZE'] = 100
+app.config['MONGO_MIN_POOL_SIZE'] = 0
+app.config['MONGO_WAIT_QUEUE_TIMEOUT_MS'] = 5000  # fail instead of waiting forever for a free connection
+app.config['MONGO_HEALTH_CHECK_INTERVAL'] = 30  # seconds between pings of the server
 
 # Increase timeout for face recognition
 app.config['FACE_RECOGNITION_TIMEOUT'] = 30  # seconds
 
+# Face detection/encoding worker processes of each web worker (None = one per CPU core, 0 = run inline);
+# gunicorn.conf.py sets EDUVISION_FACE_WORKERS so that the pools of all web workers share the cores
+app.config['FACE_WORKERS'] = int(os.environ['EDUVISION_FACE_WORKERS']) if os.environ.get('EDUVISION_FACE_WORKERS') else None
+app.config['FACE_MAX_PENDING_JOBS'] = None  # default: 4 per worker (min 8); beyond this requests get 503
+app.config['FACE_WORKER_START_METHOD'] = None  # default: forkserver where available, else spawn
+
+# Face detection (attendance and enrollment) and per-route encoding policies; the defaults and their
+# rationale are in face_settings, shared with the benchmarks
+app.config['FACE_DETECTION'] = dict(face_settings.FACE_DETECTION)
+app.config['FACE_DETECTION_ENROLLMENT'] = dict(face_settings.FACE_DETECTION_ENROLLMENT)
+app.config['FACE_ENCODING_ATTENDANCE'] = dict(face_settings.FACE_ENCODING_ATTENDANCE)
+app.config['FACE_ENCODING_STREAM'] = dict(face_settings.FACE_ENCODING_STREAM)
+app.config['FACE_ENCODING_ENROLLMENT'] = dict(face_settings.FACE_ENCODING_ENROLLMENT)
+
+# Face matching thresholds
+app.config['FACE_MATCH_TOLERANCE'] = 0.5
+app.config['FACE_MATCH_MIN_CONFIDENCE'] = 65  # percent
+
+# Gallery sync: change streams when available, otherwise poll for changed students
+app.config['GALLERY_USE_CHANGE_STREAM'] = True
+app.config['GALLERY_POLL_INTERVAL'] = 5  # seconds
+# Processes map the gallery from this snapshot (see gallery_snapshot) and only fetch students changed since
+# it was written, instead of reading every encoding from MongoDB at startup (None = always do the full load)
+app.config['GALLERY_SNAPSHOT_PATH'] = os.path.join(app.instance_path, 'gallery_snapshot')
+
+# Stored encodings carry a format header (see encoding_format); float32 halves their size,
+# float16 quarters it. Existing documents are converted with: flask --app app encodings migrate
+app.config['FACE_ENCODING_DTYPE'] = 'float32'
+# Precision of the in-memory gallery matrix (float32 halves its memory)
+app.config['GALLERY_DTYPE'] = 'float32'
+
+# Templates kept per student at enrollment; beyond the cap, 'diverse' keeps the most varied
+# encodings and 'centroids' stores k-means cluster centres instead
+app.config['FACE_MAX_TEMPLATES'] = 5
+app.config['FACE_TEMPLATE_MODE'] = 'diverse'
+
+# Per-image failures kept on a bulk enrollment job document (the CLI can write all of them to a CSV)
+app.config['BULK_ENROLL_MAX_REPORTED_FAILURES'] = 1000
+
+# Gallery search backend: 'exact' brute force, or 'ivf' for very large galleries
+# (e.g. GALLERY_INDEX_OPTIONS = {'nprobe': 16}; higher nprobe = better recall, slower)
+app.config['GALLERY_INDEX'] = 'exact'
+app.config['GALLERY_INDEX_OPTIONS'] = {}
+
+# Maximum number of frames accepted by /take_attendance/batch
+app.config['ATTENDANCE_BATCH_MAX_FRAMES'] = 8
+
+# /take_attendance/crops: face crops per request, and whether the face boxes sent by the browser are
+# used as-is (False re-detects each face inside its crop, which is slower but aligns like enrollment)
+app.config['ATTENDANCE_MAX_CROPS'] = 40
+app.config['ATTENDANCE_CROPS_TRUST_BOXES'] = True
+
+# Live stream mode: full face detection every STREAM_KEYFRAME_INTERVAL frames, OpenCV trackers in between
+# (MIL ships with opencv-python; KCF/CSRT need opencv-contrib-python)
+app.config['STREAM_KEYFRAME_INTERVAL'] = 10
+app.config['STREAM_TRACKER'] = 'MIL'
+app.config['STREAM_MAX_TRACKS'] = 30
+app.config['STREAM_MAX_ENCODE_ATTEMPTS'] = 3  # keyframes on which an unrecognized face is encoded again
+# Per process; each open stream has one frame request in flight at a time, so keep this well below the
+# server threads (gunicorn.conf.py) or streams can hold every thread while their keyframes wait on the face workers
+app.config['STREAM_MAX_STREAMS'] = 4
+app.config['STREAM_IDLE_TIMEOUT'] = 60  # seconds without a frame before a stream is closed
+
+# Students per page on the dashboard and the students page (the JSON listing accepts up to STUDENTS_MAX_PAGE_SIZE)
+app.config['DASHBOARD_STUDENTS'] = 20
+app.config['STUDENTS_PAGE_SIZE'] = 50
+app.config['STUDENTS_MAX_PAGE_SIZE'] = 200
+
+# Dashboard counters are cached per process for this long (seconds); attendance writes clear the cache
+app.config['DASHBOARD_STATS_TTL'] = 30
+
+# A face this close to one recorded in the same class within the TTL (seconds) is taken as that
+# student without searching the gallery or writing attendance again (TTL 0 disables the cache)
+app.config['RECENT_RECOGNITION_TTL'] = 300
+app.config['RECENT_RECOGNITION_DISTANCE'] = 0.3
+app.config['RECENT_RECOGNITION_MAX_PER_CLASS'] = 500
+
+# Match against the class roster first; fall back to the whole school when a face is not on it
+app.config['ROSTER_FALLBACK_TO_GLOBAL'] = True
+
+# Stage timings, request and MongoDB latency on /metrics (Prometheus text format). Admins can always read it;
+# scrapers send "Authorization: Bearer <METRICS_TOKEN>". Disabled metrics cost next to nothing
+app.config['METRICS_ENABLED'] = True
+app.config['METRICS_TOKEN'] = None
+
 app.logger.info('EduVision application startup')
 
 app.secret_key = 'eduvision_secret_123'
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
+# Uploaded frames are decoded in memory; set to True to also keep a copy in UPLOAD_FOLDER for auditing
+app.config['SAVE_UPLOADED_FRAMES'] = False
 app.config['SESSION_COOKIE_NAME'] = 'eduvision_session'
 
 # # MongoDB Configuration
 # MONGO_URI = "mongodb://localhost:27017/"
 # DB_NAME = "eduvision_db"
 
+# Per-process metrics (see metrics.py); the collectors reading app state are added further down
+metrics = MetricsRegistry(enabled=app.config['METRICS_ENABLED'])
+metrics.histogram('eduvision_face_stage_seconds', 'Duration of face pipeline stages (decode, hog, cnn, encode, match, db_write, ...)')
+metrics.histogram('eduvision_faces_per_frame', 'Faces found per frame', buckets=COUNT_BUCKETS)
+metrics.counter('eduvision_frames_total', 'Frames run through face detection, by the detector that found faces (none: no face)')
+metrics.counter('eduvision_cnn_fallback_total', 'Frames on which the CNN detector ran after HOG found nothing')
+metrics.counter('eduvision_faces_rejected_total', 'Detected faces not encoded because they failed a quality check, by reason')
+metrics.histogram('eduvision_mongo_command_seconds', 'MongoDB command latency')
+metrics.histogram('eduvision_http_request_seconds', 'HTTP request duration until the response starts')
+
 # Initialize MongoDB connection
+mongo = MongoClientManager(
+    app.config['MONGO_URI'],
+    app.config['MONGO_DB_NAME'],
+    max_pool_size=app.config['MONGO_MAX_POOL_SIZE'],
+    min_pool_size=app.config['MONGO_MIN_POOL_SIZE'],
+    wait_queue_timeout_ms=app.config['MONGO_WAIT_QUEUE_TIMEOUT_MS'],
+    health_check_interval=app.config['MONGO_HEALTH_CHECK_INTERVAL'],
+    event_listeners=[CommandTimer(metrics)] if metrics.enabled else []
+)
 
 def get_db():
-    """Get MongoDB database connection with proper error handling"""
+    """Get the MongoDB database from the shared client, or None when the server is unreachable"""
     try:
-        # Update with your actual MongoDB connection string
-        client = MongoClient(
-            app.config.get('MONGO_URI', 'mongodb://localhost:27017/'),
-            serverSelectionTimeoutMS=5000,  # 5 second timeout
-            connectTimeoutMS=10000  # 10 second connection timeout
-        )
-        
-        # Test the connection
-        client.admin.command('ismaster')
-        
-        db_name = app.config.get('MONGO_DB_NAME', 'eduvision_db')
-        return client[db_name]
-        
+        return mongo.get_db()
     except (ConnectionFailure, ServerSelectionTimeoutError) as e:
         app.logger.error(f"MongoDB connection failed: {str(e)}")
         return None
     except Exception as e:
         app.logger.error(f"Database connection error: {str(e)}")
         return None
+
 # Create collections if not exists
 def init_db():
     db = get_db()
@@ -74,7 +205,7 @@ def init_db():
         return
         
     # Create collections
-    collections = ['students', 'attendance', 'users']
+    collections = ['students', 'attendance', 'users', 'attendance_jobs', 'enrollment_jobs']
     for col in collections:
         if col not in db.list_collection_names():
             db.create_collection(col)
@@ -82,8 +213,24 @@ def init_db():
     
     # Create indexes
     db.students.create_index([("student_id", ASCENDING)], unique=True)
+    db.students.create_index([("updated_at", ASCENDING)])
+    db.students.create_index([("classes", ASCENDING)])
+    student_listing.ensure_indexes(db)
     db.attendance.create_index([("timestamp", ASCENDING)])
+    db.attendance.create_index([("class_name", ASCENDING), ("timestamp", ASCENDING)])
     db.users.create_index([("username", ASCENDING)], unique=True)
+    # Finished and abandoned async attendance jobs expire after an hour
+    db.attendance_jobs.create_index([("created_at", ASCENDING)], expireAfterSeconds=3600)
+    # Bulk enrollment reports are kept for a week
+    db.enrollment_jobs.create_index([("created_at", ASCENDING)], expireAfterSeconds=7 * 24 * 3600)
+    attendance_records.ensure_indexes(db)
+    # Records from before the unique index get a day; today's at least, so nobody is recorded twice today
+    attendance_records.backfill_days(db, since=datetime.datetime.combine(datetime.date.today(), datetime.time.min))
+    attendance_rollups.ensure_indexes(db)
+    # Backfill the report rollups the first time this version runs against existing attendance
+    if db.attendance_by_student.estimated_document_count() == 0 and db.attendance.estimated_document_count() > 0:
+        app.logger.info("Building attendance rollups from existing records")
+        attendance_rollups.rebuild(db)
     
     # Create default admin user if not exists
     if db.users.count_documents({"username": "admin"}) == 0:
@@ -97,15 +244,133 @@ def init_db():
 # Create directories if not exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-# Initialize database
-init_db()
+# Initialize database (not when multiprocessing re-imports this module in a face worker)
+if __name__ != '__mp_main__':
+    init_db()
+
+def get_students_collection():
+    db = get_db()
+    return None if db is None else db.students
+
+# Face detection/encoding runs in worker processes, outside the request threads
+face_pool = FaceWorkerPool(
+    workers=app.config['FACE_WORKERS'],
+    max_pending=app.config['FACE_MAX_PENDING_JOBS'],
+    timeout=app.config['FACE_RECOGNITION_TIMEOUT'],
+    start_method=app.config['FACE_WORKER_START_METHOD']
+)
+
+# Process-wide face gallery, loaded from MongoDB on first use and then kept in sync incrementally
+gallery = FaceGallery(
+    dtype=app.config['GALLERY_DTYPE'],
+    index=make_index(app.config['GALLERY_INDEX'], **app.config['GALLERY_INDEX_OPTIONS'])
+)
+gallery_sync = GallerySync(
+    gallery,
+    get_students_collection,
+    poll_interval=app.config['GALLERY_POLL_INTERVAL'],
+    use_change_stream=app.config['GALLERY_USE_CHANGE_STREAM'],
+    snapshot_path=app.config['GALLERY_SNAPSHOT_PATH']
+)
+
+def warm_up():
+    """Load the gallery once, before a server forks its workers (see gunicorn.conf.py).
+
+    Workers inherit it copy-on-write and only catch up with students changed since;
+    the MongoDB client is closed so that no worker inherits its sockets. The face
+    models are not loaded here: face jobs run in the face worker pool, whose
+    processes start fresh (forkserver or spawn) and load the models themselves.
+    """
+    started = time.monotonic()
+    gallery_sync.warm_up(watch=False)
+    mongo.close()
+    app.logger.info(f"Warm-up finished in {time.monotonic() - started:.1f}s ({len(gallery)} students)")
+
+# Students recognized and recorded moments ago, per class (see recent_cache)
+recent_recognitions = RecentRecognitions(
+    ttl=app.config['RECENT_RECOGNITION_TTL'],
+    distance=app.config['RECENT_RECOGNITION_DISTANCE'],
+    max_per_class=app.config['RECENT_RECOGNITION_MAX_PER_CLASS']
+)
+
+# Live attendance streams of this process (see face_stream)
+streams = StreamRegistry(
+    max_streams=app.config['STREAM_MAX_STREAMS'],
+    idle_timeout=app.config['STREAM_IDLE_TIMEOUT']
+)
+
+def collect_app_metrics():
+    """Gauges and counters read from app state at scrape time"""
+    pool = mongo.pool_metrics()
+    cache = recent_recognitions.stats()
+    return [
+        ('eduvision_gallery_students', 'gauge', 'Students in the in-memory face gallery', len(gallery)),
+        ('eduvision_gallery_templates', 'gauge', 'Face templates in the in-memory gallery', gallery.template_count),
+        ('eduvision_face_jobs_pending', 'gauge', 'Face jobs queued or running on the worker pool', face_pool.pending),
+        ('eduvision_face_jobs_max_pending', 'gauge', 'Face job slots of the worker pool', face_pool.max_pending),
+        ('eduvision_live_streams', 'gauge', 'Open live attendance streams', len(streams)),
+        ('eduvision_mongo_pool_connections', 'gauge', 'Open MongoDB connections', pool['connections_open']),
+        ('eduvision_mongo_pool_checked_out', 'gauge', 'MongoDB connections in use', pool['checked_out']),
+        ('eduvision_mongo_pool_checkouts_total', 'counter', 'MongoDB connection checkouts', pool['checkouts']),
+        ('eduvision_mongo_pool_checkout_failures_total', 'counter', 'Failed MongoDB connection checkouts',
+         pool['checkout_failures']),
+        ('eduvision_mongo_pool_wait_seconds_total', 'counter', 'Time spent waiting for a MongoDB connection',
+         pool['wait_seconds_total']),
+        ('eduvision_mongo_pool_clears_total', 'counter', 'MongoDB connection pool clears', pool['pool_clears']),
+        ('eduvision_recent_cache_hits_total', 'counter', 'Faces answered by the recent-recognition cache',
+         cache['hits']),
+        ('eduvision_recent_cache_misses_total', 'counter', 'Faces not found in the recent-recognition cache',
+         cache['misses']),
+        ('eduvision_recent_cache_entries', 'gauge', 'Faces held by the recent-recognition cache', cache['entries']),
+    ]
+
+if metrics.enabled:
+    metrics.add_collector(collect_app_metrics)
+
+def observe_face_timings(timings, faces, pipeline='attendance'):
+    """Record the stage timings returned by a face job and the number of faces it found"""
+    if not metrics.enabled:
+        return
+    for stage, seconds in timings.items():
+        if isinstance(seconds, float):
+            metrics.observe('eduvision_face_stage_seconds', seconds, stage=stage, pipeline=pipeline)
+    metrics.observe('eduvision_faces_per_frame', faces, pipeline=pipeline)
+    if 'detector' in timings:
+        metrics.inc('eduvision_frames_total', detector=timings['detector'] or 'none', pipeline=pipeline)
+    if 'cnn' in timings:
+        metrics.inc('eduvision_cnn_fallback_total', pipeline=pipeline)
+    for reason, count in timings.get('rejected', {}).items():
+        metrics.inc('eduvision_faces_rejected_total', count, reason=reason, pipeline=pipeline)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    if metrics.enabled and 'request_started' in g:
+        metrics.observe('eduvision_http_request_seconds', time.perf_counter() - g.request_started,
+                        endpoint=request.endpoint or 'unmatched', method=request.method, status=response.status_code)
+    return response
 
 # Helper functions
-def get_students():
+def get_gallery():
+    """Return the in-memory face gallery, applying any pending student changes"""
+    gallery_sync.refresh()
+    return gallery
+
+def save_uploaded_frame(data, prefix):
+    """Keep an audit copy of an uploaded frame (only when SAVE_UPLOADED_FRAMES is on)"""
+    filename = f"{prefix}_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}.jpg"
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], filename), 'wb') as f:
+        f.write(data)
+
+def get_students(limit, cursor=None, search=None):
+    """One page of students, newest first, without their face encodings; returns ``(students, next_cursor)``"""
     db = get_db()
     if db is None:
-        return []
-    return list(db.students.find().sort("registered_on", -1))
+        return [], None
+    return student_listing.list_students(db.students, limit=limit, cursor=cursor, search=search)
 
 def get_attendance():
     db = get_db()
@@ -138,7 +403,21 @@ def get_attendance():
     
     return list(db.attendance.aggregate(pipeline))
 
+# Per-process cache of the dashboard counters; see get_attendance_stats
+_stats_cache = {'value': None, 'expires': 0.0}
+_stats_lock = threading.Lock()
+
+def invalidate_attendance_stats():
+    """Drop this process's cached dashboard counters (called after attendance is written)"""
+    with _stats_lock:
+        _stats_cache['expires'] = 0.0
+
 def get_attendance_stats():
+    """Dashboard counters, cached for DASHBOARD_STATS_TTL seconds"""
+    with _stats_lock:
+        if _stats_cache['value'] is not None and time.monotonic() < _stats_cache['expires']:
+            return _stats_cache['value']
+    
     db = get_db()
     if db is None:
         return {
@@ -148,40 +427,44 @@ def get_attendance_stats():
             'daily_data': []
         }
     
-    # Today's attendance
-    today_start = datetime.datetime.combine(datetime.date.today(), datetime.time.min)
-    today_end = datetime.datetime.combine(datetime.date.today(), datetime.time.max)
-    today_count = db.attendance.count_documents({
-        "timestamp": {"$gte": today_start, "$lte": today_end}
-    })
-    
-    # Total students
-    total_students = db.students.count_documents({})
-    
-    # This week attendance (unique students)
+    today = datetime.date.today()
+    days = [today - datetime.timedelta(days=i) for i in range(7)]
+    histogram_start = datetime.datetime.combine(days[-1], datetime.time.min)
     week_start = datetime.datetime.now() - datetime.timedelta(days=7)
-    week_count = len(db.attendance.distinct("student_id", {
-        "timestamp": {"$gte": week_start}
-    }))
-    
-    # Attendance by day (last 7 days)
-    daily_data = []
-    for i in range(7):
-        day = datetime.date.today() - datetime.timedelta(days=i)
-        day_start = datetime.datetime.combine(day, datetime.time.min)
-        day_end = datetime.datetime.combine(day, datetime.time.max)
-        
-        count = db.attendance.count_documents({
-            "timestamp": {"$gte": day_start, "$lte": day_end}
-        })
-        daily_data.append((day.strftime("%Y-%m-%d"), count))
     
-    return {
-        'today_count': today_count,
-        'total_students': total_students,
-        'week_count': week_count,
+    # Attendance by day (last 7 days) and unique students this week in one round trip
+    pipeline = [
+        {"$match": {"timestamp": {"$gte": min(histogram_start, week_start)}}},
+        {"$facet": {
+            "daily": [
+                {"$match": {"timestamp": {"$gte": histogram_start}}},
+                {"$group": {
+                    "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$timestamp"}},
+                    "count": {"$sum": 1}
+                }}
+            ],
+            "week": [
+                {"$match": {"timestamp": {"$gte": week_start}}},
+                {"$group": {"_id": "$student_id"}},
+                {"$count": "students"}
+            ]
+        }}
+    ]
+    result = next(db.attendance.aggregate(pipeline), {'daily': [], 'week': []})
+    counts = {row['_id']: row['count'] for row in result['daily']}
+    daily_data = [(day.strftime("%Y-%m-%d"), counts.get(day.strftime("%Y-%m-%d"), 0)) for day in days]
+    
+    stats = {
+        'today_count': daily_data[0][1],
+        # Collection metadata; no scan of the students collection
+        'total_students': db.students.estimated_document_count(),
+        'week_count': result['week'][0]['students'] if result['week'] else 0,
         'daily_data': daily_data
     }
+    with _stats_lock:
+        _stats_cache['value'] = stats
+        _stats_cache['expires'] = time.monotonic() + app.config['DASHBOARD_STATS_TTL']
+    return stats
 
 # Authentication middleware
 def login_required(route_function):
@@ -265,8 +548,42 @@ def logout():
 def dashboard():
     stats = get_attendance_stats()
     attendance = get_attendance()
-    students = get_students()
-    return render_template('dashboard.html', stats=stats, attendance=attendance, students=students)
+    students, next_cursor = get_students(app.config['DASHBOARD_STUDENTS'])
+    return render_template('dashboard.html', stats=stats, attendance=attendance, students=students,
+                           more_students=next_cursor is not None)
+
+@app.route('/students')
+@login_required
+def manage_students():
+    search = request.args.get('q', '').strip()
+    cursor = request.args.get('cursor') or None
+    wants_json = request.args.get('format') == 'json'
+    limit = app.config['STUDENTS_PAGE_SIZE']
+    if wants_json:
+        limit = max(1, min(request.args.get('limit', limit, type=int), app.config['STUDENTS_MAX_PAGE_SIZE']))
+    
+    try:
+        students, next_cursor = get_students(limit, cursor=cursor, search=search)
+    except ValueError as e:
+        if wants_json:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        return redirect(url_for('manage_students', q=search or None))
+    
+    if wants_json:
+        return jsonify({
+            'status': 'success',
+            'students': [
+                {
+                    'student_id': student['student_id'],
+                    'name': student.get('name'),
+                    'classes': student.get('classes', []),
+                    'registration_date': student['registration_date'].isoformat() if student.get('registration_date') else None
+                }
+                for student in students
+            ],
+            'next_cursor': next_cursor
+        })
+    return render_template('students.html', students=students, next_cursor=next_cursor, search=search)
 
 @app.route('/register', methods=['GET', 'POST'])
 @login_required
@@ -274,77 +591,225 @@ def register_student():
     if request.method == 'POST':
         name = request.form.get('name')
         student_id = request.form.get('student_id')
+        classes = [c.strip() for c in request.form.get('classes', '').split(',') if c.strip()]
         image_files = request.files.getlist('images')  # Allow multiple images
         
         if not name or not student_id or not image_files:
             flash('Please fill all fields and upload at least one image', 'danger')
-            return redirect(url_for('register'))
+            return redirect(url_for('register_student'))
         
         # Get MongoDB connection
         db = get_db()
         if db is None:
             flash('Database connection failed', 'danger')
-            return redirect(url_for('register'))
+            return redirect(url_for('register_student'))
             
         # Check if student already exists
         if db.students.find_one({'student_id': student_id}):
             flash('Student ID already exists', 'danger')
-            return redirect(url_for('register'))
+            return redirect(url_for('register_student'))
         
-        # Process multiple images for better recognition
+        # Process multiple images for better recognition, in parallel on the face worker pool
         face_encodings = []
-        for image_file in image_files:
-            if image_file.filename == '':
-                continue
-                
-            # Save temporary image
-            filename = f"temp_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}_{image_file.filename}"
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            image_file.save(filepath)
-            
+        jobs = []
+        try:
+            for image_file in image_files:
+                if image_file.filename == '':
+                    continue
+                    
+                try:
+                    # Only the raw bytes cross to the worker, which decodes them
+                    data = image_file.read()
+                    jobs.append((image_file.filename, data, face_pool.submit(
+                        face_pipeline.encode_image, data, encoding=app.config['FACE_ENCODING_ENROLLMENT'],
+                        detection=app.config['FACE_DETECTION_ENROLLMENT'])))
+                except PoolSaturated:
+                    raise
+                except Exception as e:
+                    app.logger.error(f"Error processing image {image_file.filename}: {str(e)}")
+        except PoolSaturated:
+            for _, _, job in jobs:
+                job.cancel()
+            flash('Face recognition is busy, please try again in a moment', 'warning')
+            return redirect(url_for('register_student'))
+        
+        # All images share one FACE_RECOGNITION_TIMEOUT budget
+        deadline = time.monotonic() + app.config['FACE_RECOGNITION_TIMEOUT']
+        rejected = set()
+        for filename, data, job in jobs:
             try:
-                # Process image
-                img = face_recognition.load_image_file(filepath)
-                
-                # Try different models for face detection
-                face_locations = face_recognition.face_locations(img, model="hog")
-                if not face_locations:
-                    face_locations = face_recognition.face_locations(img, model="cnn")
-                
-                if face_locations:
-                    # Get face encodings
-                    encodings = face_recognition.face_encodings(img, face_locations, num_jitters=2)
-                    if encodings:
-                        face_encodings.extend(encodings)
-                
+                _, encodings, timings = face_pool.result(job, timeout=max(deadline - time.monotonic(), 0))
+                face_encodings.extend(encodings)
+                rejected.update(timings.get('rejected', {}))
+                observe_face_timings(timings, len(encodings), pipeline='enrollment')
+                if app.config['SAVE_UPLOADED_FRAMES']:
+                    save_uploaded_frame(data, secure_filename(student_id) or 'student')
+            except InvalidImage as e:
+                app.logger.warning(f"Skipping image {filename}: {str(e)}")
             except Exception as e:
-                app.logger.error(f"Error processing image {image_file.filename}: {str(e)}")
-            finally:
-                if os.path.exists(filepath):
-                    os.remove(filepath)
+                app.logger.error(f"Error processing image {filename}: {str(e)}")
         
         if not face_encodings:
-            flash('No faces detected in the uploaded images', 'danger')
-            return redirect(url_for('register'))
+            if rejected:
+                flash(f"No usable faces in the uploaded images ({', '.join(sorted(rejected))}); "
+                      "use sharper, closer photos", 'danger')
+            else:
+                flash('No faces detected in the uploaded images', 'danger')
+            return redirect(url_for('register_student'))
         
-        # Calculate average encoding for better recognition
-        avg_encoding = np.mean(face_encodings, axis=0)
+        # Keep several templates (poses/lighting) instead of collapsing them into one average
+        templates = select_templates(
+            face_encodings,
+            max_templates=app.config['FACE_MAX_TEMPLATES'],
+            mode=app.config['FACE_TEMPLATE_MODE']
+        )
+        dtype = app.config['FACE_ENCODING_DTYPE']
         
         # Store student data
-        db.students.insert_one({
+        now = datetime.datetime.now()
+        student = {
             'student_id': student_id,
             'name': name,
-            'face_encoding': avg_encoding.tobytes(),
-            'registration_date': datetime.datetime.now(),
+            'classes': classes,
+            'face_templates': [encoding_format.encode(template, dtype=dtype) for template in templates],
+            # Average of the templates, for tools that expect a single encoding
+            'face_encoding': encoding_format.encode(np.mean(templates, axis=0), dtype=dtype),
+            'registration_date': now,
+            'updated_at': now,
             'image_count': len(face_encodings)
-        })
+        }
+        db.students.insert_one(student)
+        # Other workers pick the new student up through gallery_sync
+        if gallery.loaded:
+            gallery.upsert(student)
         
         flash(f'Student {name} registered successfully with {len(face_encodings)} facial encodings', 'success')
         return redirect(url_for('manage_students'))
     
     return render_template('register.html')
 
-# ... rest of the code remains the same ...
+def recognize_faces(db, face_encodings, class_name):
+    """Match face encodings and record each recognized student once.
+    
+    Returns ``(matches, already_recorded)``: ``(student, confidence)`` per face
+    (``(None, 0)`` when unknown) and the ids of students recorded for this
+    class earlier today.
+    """
+    faces = np.asarray(face_encodings, dtype=np.float64).reshape(-1, 128)
+    # Faces confirmed in this class a moment ago need neither a gallery search nor a write
+    matches = recent_recognitions.lookup(class_name, faces)
+    misses = [i for i, hit in enumerate(matches) if hit is None]
+    already_recorded = {hit[0]['student_id'] for hit in matches if hit is not None}
+    if not misses:
+        return matches, already_recorded
+    
+    # Compare the other faces against the class roster (then the whole gallery) in one batch
+    face_gallery = get_gallery()
+    with metrics.timer('eduvision_face_stage_seconds', stage='match', pipeline='attendance'):
+        found = face_gallery.match(
+            faces[misses],
+            tolerance=app.config['FACE_MATCH_TOLERANCE'],
+            min_confidence=app.config['FACE_MATCH_MIN_CONFIDENCE'],
+            class_name=class_name,
+            fallback=app.config['ROSTER_FALLBACK_TO_GLOBAL']
+        )
+    for i, match in zip(misses, found):
+        matches[i] = match
+    
+    # Keep the best confidence per student; the same student can appear in several faces or frames
+    best_confidences = {}
+    for best_match, best_confidence in found:
+        # Only matches within tolerance and above the confidence threshold are returned
+        if best_match and best_confidence > best_confidences.get(best_match['student_id'], 0):
+            best_confidences[best_match['student_id']] = best_confidence
+    
+    if best_confidences:
+        # One bulk upsert per frame; the unique (student_id, class_name, day) index prevents duplicates
+        with metrics.timer('eduvision_face_stage_seconds', stage='db_write', pipeline='attendance'):
+            new_records = attendance_records.record(db, class_name, best_confidences, datetime.datetime.now())
+            if new_records:
+                attendance_rollups.record(db, new_records)
+        already_recorded |= set(best_confidences) - {record['student_id'] for record in new_records}
+        if new_records:
+            invalidate_attendance_stats()
+        # Everyone matched is now recorded for today
+        recent_recognitions.remember(class_name, faces[misses], found)
+    return matches, already_recorded
+
+def record_attendance(db, face_encodings, class_name):
+    """Match face encodings against the gallery and record each student once; returns the JSON payload"""
+    matches, already_recorded = recognize_faces(db, face_encodings, class_name)
+    
+    best_matches = {}
+    for best_match, best_confidence in matches:
+        if best_match and best_confidence > best_matches.get(best_match['student_id'], (None, 0))[1]:
+            best_matches[best_match['student_id']] = (best_match, best_confidence)
+    
+    recognized_students = [
+        {
+            'student_id': student_id,
+            'name': student['name'],
+            'confidence': f"{confidence:.2f}%",
+            'already_recorded': student_id in already_recorded
+        }
+        for student_id, (student, confidence) in best_matches.items()
+    ]
+    
+    return {
+        'status': 'success',
+        'recognized': recognized_students,
+        'count': len([s for s in recognized_students if not s['already_recorded']])
+    }
+
+# Background threads that finish asynchronous attendance jobs (the face work itself runs on face_pool)
+job_runner = ThreadPoolExecutor(max_workers=face_pool.max_pending, thread_name_prefix='attendance-job')
+
+def run_attendance_job(job_id, future, class_name):
+    """Wait for the face job, record attendance and store the outcome on the job document"""
+    try:
+        _, face_encodings, timings = face_pool.result(future)
+        observe_face_timings(timings, len(face_encodings))
+        db = get_db()
+        if db is None:
+            raise RuntimeError('Database connection failed')
+        result = record_attendance(db, face_encodings, class_name)
+        result['timings'] = face_pipeline.timings_ms(timings)
+        update = {'status': 'success', 'result': result}
+    except Exception as e:
+        app.logger.error(f"Attendance job {job_id} failed: {str(e)}")
+        update = {'status': 'error', 'message': str(e)}
+        db = get_db()
+    
+    update['finished_at'] = datetime.datetime.now()
+    if db is not None:
+        db.attendance_jobs.update_one({'_id': job_id}, {'$set': update})
+
+def submit_attendance_job(img, class_name):
+    """Queue face recognition for a frame and return the 202 response with the job id"""
+    future = face_pool.submit(face_pipeline.detect_and_encode, img, encoding=app.config['FACE_ENCODING_ATTENDANCE'],
+                              detection=app.config['FACE_DETECTION'])
+    
+    db = get_db()
+    if db is None:
+        future.cancel()
+        return jsonify({'status': 'error', 'message': 'Database connection failed'}), 500
+    
+    job_id = uuid.uuid4().hex
+    db.attendance_jobs.insert_one({
+        '_id': job_id,
+        'status': 'running',
+        'class_name': class_name,
+        'username': session['user']['username'],
+        'created_at': datetime.datetime.now()
+    })
+    job_runner.submit(run_attendance_job, job_id, future, class_name)
+    
+    return jsonify({
+        'status': 'accepted',
+        'job_id': job_id,
+        'poll_url': url_for('attendance_job', job_id=job_id)
+    }), 202
+
 @app.route('/take_attendance', methods=['GET', 'POST'])
 @login_required
 def take_attendance():
@@ -352,106 +817,487 @@ def take_attendance():
         # Get image from webcam
         image_file = request.files.get('image')
         class_name = request.form.get('class_name', 'General')
+        # async=1: return a job id straight away and let the client poll /attendance_jobs/<id>
+        run_async = request.form.get('async') in ('1', 'true')
         
         if not image_file:
             return jsonify({'status': 'error', 'message': 'No image provided'}), 400
         
-        # Save temporary image
-        filename = f"attendance_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}.jpg"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        image_file.save(filepath)
-        
         try:
-            # Process image with enhanced settings
-            img = face_recognition.load_image_file(filepath)
+            # Decode the upload straight from the request stream
+            data = image_file.read()
+            with metrics.timer('eduvision_face_stage_seconds', stage='decode', pipeline='attendance'):
+                img = face_pipeline.decode_image(data)
+            if app.config['SAVE_UPLOADED_FRAMES']:
+                save_uploaded_frame(data, 'attendance')
             
-            # Try multiple face detection models
-            face_locations = face_recognition.face_locations(img, model="hog")
-            if not face_locations:
-                face_locations = face_recognition.face_locations(img, model="cnn")
-                
-            face_encodings = face_recognition.face_encodings(img, face_locations, num_jitters=2)
+            if run_async:
+                return submit_attendance_job(img, class_name)
+            
+            # Detection and encoding run on the worker pool, bounded by FACE_RECOGNITION_TIMEOUT
+            face_locations, face_encodings, timings = face_pool.run(
+                face_pipeline.detect_and_encode, img, encoding=app.config['FACE_ENCODING_ATTENDANCE'],
+                detection=app.config['FACE_DETECTION'])
+            observe_face_timings(timings, len(face_encodings))
             
             # Get MongoDB connection
             db = get_db()
             if db is None:
                 return jsonify({'status': 'error', 'message': 'Database connection failed'}), 500
-                
-            # Get all students from database
-            students_collection = db['students']
-            students = list(students_collection.find({}))
             
-            recognized_students = []
+            result = record_attendance(db, face_encodings, class_name)
+            result['timings'] = face_pipeline.timings_ms(timings)
+            return jsonify(result)
             
-            # Compare faces with enhanced matching
-            for face_encoding in face_encodings:
-                best_match = None
-                best_confidence = 0
-                
-                for student in students:
-                    try:
-                        if 'face_encoding' not in student or not student['face_encoding']:
-                            continue
-                            
-                        # Convert stored encoding back to numpy array
-                        db_encoding = np.frombuffer(student['face_encoding'], dtype=np.float64)
-                        
-                        # Use lower tolerance for more strict matching
-                        matches = face_recognition.compare_faces([db_encoding], face_encoding, tolerance=0.5)
-                        face_distance = face_recognition.face_distance([db_encoding], face_encoding)[0]
-                        confidence = (1 - face_distance) * 100
-                        
-                        # Track the best match
-                        if matches[0] and confidence > best_confidence:
-                            best_match = student
-                            best_confidence = confidence
-                            
-                    except Exception as e:
-                        app.logger.error(f"Error processing student {student.get('student_id', 'unknown')}: {str(e)}")
-                        continue
-                
-                # Only accept matches with sufficient confidence
-                if best_match and best_confidence > 65:  # Lowered threshold to 65%
-                    # Check if already recorded today (prevent duplicates)
-                    today_start = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-                    existing_attendance = db.attendance.find_one({
-                        'student_id': best_match['student_id'],
-                        'timestamp': {'$gte': today_start},
-                        'class_name': class_name
-                    })
-                    
-                    if not existing_attendance:
-                        # Record attendance
-                        db.attendance.insert_one({
-                            'student_id': best_match['student_id'],
-                            'timestamp': datetime.datetime.now(),
-                            'class_name': class_name,
-                            'confidence': best_confidence
-                        })
-                    
-                    recognized_students.append({
-                        'student_id': best_match['student_id'],
-                        'name': best_match['name'],
-                        'confidence': f"{best_confidence:.2f}%",
-                        'already_recorded': existing_attendance is not None
-                    })
+        except PoolSaturated as e:
+            app.logger.warning(f"Attendance rejected, face workers saturated: {str(e)}")
+            return jsonify({'status': 'error', 'message': 'Server busy, please retry shortly'}), 503, {'Retry-After': '5'}
             
-            return jsonify({
-                'status': 'success',
-                'recognized': recognized_students,
-                'count': len([s for s in recognized_students if not s['already_recorded']])
-            })
+        except FaceJobTimeout as e:
+            app.logger.error(f"Attendance processing timed out: {str(e)}")
+            return jsonify({'status': 'error', 'message': str(e)}), 504
+            
+        except InvalidImage as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
             
         except Exception as e:
             app.logger.error(f"Attendance processing error: {str(e)}")
             return jsonify({'status': 'error', 'message': str(e)}), 500
-            
-        finally:
-            if os.path.exists(filepath):
-                os.remove(filepath)  # Clean up temp file
                 
     return render_template('take_attendance.html')
 
+@app.route('/take_attendance/batch', methods=['POST'])
+@login_required
+def take_attendance_batch():
+    # A burst of frames from one classroom sweep, processed together
+    image_files = [f for f in request.files.getlist('images') if f.filename != '']
+    class_name = request.form.get('class_name', 'General')
+    
+    if not image_files:
+        return jsonify({'status': 'error', 'message': 'No images provided'}), 400
+    # Every frame needs its own worker-pool slot, so a burst can never exceed the pool bound
+    max_frames = min(app.config['ATTENDANCE_BATCH_MAX_FRAMES'], face_pool.max_pending)
+    if len(image_files) > max_frames:
+        return jsonify({'status': 'error', 'message': f"At most {max_frames} frames per batch"}), 400
+    
+    jobs = []
+    try:
+        # Frames are encoded in parallel on the worker pool
+        for image_file in image_files:
+            with metrics.timer('eduvision_face_stage_seconds', stage='decode', pipeline='attendance'):
+                img = face_pipeline.decode_image(image_file.read())
+            jobs.append(face_pool.submit(face_pipeline.detect_and_encode, img,
+                                         encoding=app.config['FACE_ENCODING_ATTENDANCE'],
+                                         detection=app.config['FACE_DETECTION']))
+        
+        # The whole burst shares one FACE_RECOGNITION_TIMEOUT budget
+        deadline = time.monotonic() + app.config['FACE_RECOGNITION_TIMEOUT']
+        face_encodings = []
+        frame_timings = []
+        for job in jobs:
+            _, encodings, timings = face_pool.result(job, timeout=max(deadline - time.monotonic(), 0))
+            face_encodings.extend(encodings)
+            frame_timings.append(face_pipeline.timings_ms(timings))
+            observe_face_timings(timings, len(encodings))
+        
+        db = get_db()
+        if db is None:
+            return jsonify({'status': 'error', 'message': 'Database connection failed'}), 500
+        
+        # One match over every face in the burst, one write per student
+        result = record_attendance(db, face_encodings, class_name)
+        result['frames'] = len(jobs)
+        result['faces'] = len(face_encodings)
+        result['timings'] = frame_timings
+        return jsonify(result)
+        
+    except PoolSaturated as e:
+        for job in jobs:
+            job.cancel()
+        app.logger.warning(f"Attendance batch rejected, face workers saturated: {str(e)}")
+        return jsonify({'status': 'error', 'message': 'Server busy, please retry shortly'}), 503, {'Retry-After': '5'}
+        
+    except FaceJobTimeout as e:
+        for job in jobs:
+            job.cancel()
+        app.logger.error(f"Attendance batch timed out: {str(e)}")
+        return jsonify({'status': 'error', 'message': str(e)}), 504
+        
+    except InvalidImage as e:
+        for job in jobs:
+            job.cancel()
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+        
+    except Exception as e:
+        app.logger.error(f"Attendance batch processing error: {str(e)}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+def parse_crop_boxes(raw, count):
+    """Parse the JSON ``boxes`` field: one ``[top, right, bottom, left]`` (or null) per crop"""
+    if not raw:
+        return None
+    try:
+        boxes = json.loads(raw)
+    except ValueError:
+        raise ValueError('boxes must be a JSON list')
+    if not isinstance(boxes, list) or len(boxes) != count:
+        raise ValueError(f"boxes must list one box (or null) for each of the {count} crops")
+    for box in boxes:
+        if box is not None and (not isinstance(box, list) or len(box) != 4
+                                or not all(isinstance(v, (int, float)) and math.isfinite(v) for v in box)):
+            raise ValueError('each box must be [top, right, bottom, left] in crop pixels')
+    return boxes
+
+@app.route('/take_attendance/crops', methods=['POST'])
+@login_required
+def take_attendance_crops():
+    # Faces already cropped by the kiosk: only the crops are decoded and no full-frame detection runs
+    crop_files = [f for f in request.files.getlist('crops') if f.filename != '']
+    class_name = request.form.get('class_name', 'General')
+    
+    if not crop_files:
+        return jsonify({'status': 'error', 'message': 'No face crops provided'}), 400
+    if len(crop_files) > app.config['ATTENDANCE_MAX_CROPS']:
+        return jsonify({'status': 'error', 'message': f"At most {app.config['ATTENDANCE_MAX_CROPS']} crops per request"}), 400
+    try:
+        boxes = parse_crop_boxes(request.form.get('boxes'), len(crop_files))
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    if not app.config['ATTENDANCE_CROPS_TRUST_BOXES']:
+        boxes = None
+    
+    try:
+        # An optional downscaled frame is only kept for auditing
+        frame_file = request.files.get('frame')
+        if frame_file and app.config['SAVE_UPLOADED_FRAMES']:
+            save_uploaded_frame(frame_file.read(), 'attendance')
+        
+        # Crops travel to the worker as bytes and are decoded there
+        face_encodings, timings = face_pool.run(
+            face_pipeline.encode_crops, [f.read() for f in crop_files], boxes,
+            encoding=app.config['FACE_ENCODING_ATTENDANCE'], detection=app.config['FACE_DETECTION'])
+        observe_face_timings(timings, len(face_encodings))
+        
+        db = get_db()
+        if db is None:
+            return jsonify({'status': 'error', 'message': 'Database connection failed'}), 500
+        
+        result = record_attendance(db, face_encodings, class_name)
+        result['crops'] = len(crop_files)
+        result['faces'] = len(face_encodings)
+        result['timings'] = face_pipeline.timings_ms(timings)
+        return jsonify(result)
+        
+    except PoolSaturated as e:
+        app.logger.warning(f"Attendance crops rejected, face workers saturated: {str(e)}")
+        return jsonify({'status': 'error', 'message': 'Server busy, please retry shortly'}), 503, {'Retry-After': '5'}
+        
+    except FaceJobTimeout as e:
+        app.logger.error(f"Attendance crops timed out: {str(e)}")
+        return jsonify({'status': 'error', 'message': str(e)}), 504
+        
+    except InvalidImage as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+        
+    except Exception as e:
+        app.logger.error(f"Attendance crops processing error: {str(e)}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/take_attendance/stream', methods=['POST'])
+@login_required
+def start_attendance_stream():
+    class_name = request.form.get('class_name', 'General')
+    try:
+        stream = streams.open(
+            class_name=class_name,
+            username=session['user']['username'],
+            pool=face_pool,
+            detection=app.config['FACE_DETECTION'],
+            encoding=app.config['FACE_ENCODING_STREAM'],
+            keyframe_interval=app.config['STREAM_KEYFRAME_INTERVAL'],
+            tracker=app.config['STREAM_TRACKER'],
+            max_tracks=app.config['STREAM_MAX_TRACKS'],
+            max_encode_attempts=app.config['STREAM_MAX_ENCODE_ATTEMPTS']
+        )
+    except StreamLimitReached as e:
+        app.logger.warning(f"Live stream rejected: {str(e)}")
+        return jsonify({'status': 'error', 'message': 'Too many live streams, please retry shortly'}), 503, {'Retry-After': '5'}
+    
+    app.logger.info(f"Live stream {stream.id} started for class {class_name}")
+    return jsonify({
+        'status': 'success',
+        'stream_id': stream.id,
+        'frame_url': url_for('attendance_stream_frame', stream_id=stream.id),
+        'events_url': url_for('attendance_stream_events', stream_id=stream.id),
+        'close_url': url_for('close_attendance_stream', stream_id=stream.id)
+    })
+
+def get_own_stream(stream_id):
+    """Return the open stream if it belongs to the logged-in user, else None"""
+    stream = streams.get(stream_id)
+    if stream is None or stream.username != session['user']['username']:
+        return None
+    return stream
+
+@app.route('/take_attendance/stream/<stream_id>/frame', methods=['POST'])
+@login_required
+def attendance_stream_frame(stream_id):
+    stream = get_own_stream(stream_id)
+    if stream is None:
+        return jsonify({'status': 'error', 'message': 'Stream not found'}), 404
+    image_file = request.files.get('image')
+    if not image_file:
+        return jsonify({'status': 'error', 'message': 'No image provided'}), 400
+    
+    try:
+        with metrics.timer('eduvision_face_stage_seconds', stage='decode', pipeline='stream'):
+            img = face_pipeline.decode_image(image_file.read())
+        db = get_db()
+        if db is None:
+            return jsonify({'status': 'error', 'message': 'Database connection failed'}), 500
+        
+        # Keyframes detect (and encode new faces) on the worker pool; other frames only update trackers
+        started = time.perf_counter()
+        result = stream.process(img, lambda encodings: recognize_faces(db, encodings, stream.class_name))
+        metrics.observe('eduvision_face_stage_seconds', time.perf_counter() - started,
+                        stage='keyframe' if result['keyframe'] else 'track', pipeline='stream')
+        # Recognitions since the last event the page has seen come back with the frame
+        result['events'], result['closed'] = stream.events_after(request.form.get('after', type=int) or 0)
+        return jsonify(dict(result, status='success'))
+        
+    except PoolSaturated as e:
+        # Drop this frame; the next one retries the keyframe
+        app.logger.warning(f"Stream frame dropped, face workers saturated: {str(e)}")
+        return jsonify({'status': 'error', 'message': 'Server busy, please retry shortly'}), 503, {'Retry-After': '1'}
+        
+    except FaceJobTimeout as e:
+        app.logger.error(f"Stream keyframe timed out: {str(e)}")
+        return jsonify({'status': 'error', 'message': str(e)}), 504
+        
+    except InvalidImage as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+        
+    except StreamClosed as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 404
+        
+    except Exception as e:
+        app.logger.error(f"Stream frame processing error: {str(e)}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/take_attendance/stream/<stream_id>/events')
+@login_required
+def attendance_stream_events(stream_id):
+    # Polled without blocking, so a stream never holds a server thread between requests
+    stream = get_own_stream(stream_id)
+    if stream is None:
+        return jsonify({'status': 'error', 'message': 'Stream not found'}), 404
+    events, closed = stream.events_after(request.args.get('after', type=int) or 0)
+    return jsonify({'status': 'success', 'events': events, 'closed': closed})
+
+@app.route('/take_attendance/stream/<stream_id>', methods=['DELETE'])
+@login_required
+def close_attendance_stream(stream_id):
+    stream = get_own_stream(stream_id)
+    if stream is None:
+        return jsonify({'status': 'error', 'message': 'Stream not found'}), 404
+    streams.close(stream_id)
+    return jsonify({'status': 'success', 'stream_id': stream_id, 'counts': stream.counts})
+
+@app.route('/attendance_jobs/<job_id>')
+@login_required
+def attendance_job(job_id):
+    db = get_db()
+    if db is None:
+        return jsonify({'status': 'error', 'message': 'Database connection failed'}), 500
+    
+    job = db.attendance_jobs.find_one({'_id': job_id})
+    if not job or (job.get('username') != session['user']['username'] and session['user'].get('role') != 'admin'):
+        return jsonify({'status': 'error', 'message': 'Job not found'}), 404
+    
+    if job['status'] == 'success':
+        return jsonify(dict(job['result'], job_id=job_id))
+    if job['status'] == 'error':
+        return jsonify({'status': 'error', 'job_id': job_id, 'message': job.get('message')})
+    return jsonify({'status': 'running', 'job_id': job_id})
+
+@app.route('/db_pool_stats')
+@login_required
+def db_pool_stats():
+    if session['user'].get('role') != 'admin':
+        return jsonify({'status': 'error', 'message': 'Admin access required'}), 403
+    return jsonify(mongo.pool_metrics())
+
+# Bulk enrollment jobs run one at a time; the face work is spread over face_pool
+enrollment_runner = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bulk-enroll')
+
+def make_bulk_enrollment(db, replace_existing=False, progress=None):
+    return bulk_enroll.BulkEnrollment(
+        db.students,
+        face_pool,
+        encoding=app.config['FACE_ENCODING_ENROLLMENT'],
+        detection=app.config['FACE_DETECTION_ENROLLMENT'],
+        max_templates=app.config['FACE_MAX_TEMPLATES'],
+        template_mode=app.config['FACE_TEMPLATE_MODE'],
+        dtype=app.config['FACE_ENCODING_DTYPE'],
+        replace_existing=replace_existing,
+        progress=progress
+    )
+
+def run_enrollment_job(job_id, archive_path, names_path, replace_existing):
+    """Enroll every student in an uploaded archive, recording progress on the job document"""
+    db = get_db()
+    
+    def save_progress(report):
+        progress = {key: value for key, value in report.items() if key != 'image_failures'}
+        progress['image_failure_count'] = len(report['image_failures'])
+        db.enrollment_jobs.update_one({'_id': job_id}, {'$set': {'progress': progress}})
+    
+    try:
+        if db is None:
+            raise RuntimeError('Database connection failed')
+        with bulk_enroll.EnrollmentSource(archive_path, names_path) as source:
+            report = make_bulk_enrollment(db, replace_existing, save_progress).run(source)
+        failures = report.pop('image_failures')
+        report['image_failure_count'] = len(failures)
+        update = {
+            'status': 'success',
+            'result': report,
+            # Keep the job document well under the BSON size limit
+            'failures': [list(failure) for failure in failures[:app.config['BULK_ENROLL_MAX_REPORTED_FAILURES']]]
+        }
+        gallery_sync.refresh(force=True)
+    except Exception as e:
+        app.logger.error(f"Enrollment job {job_id} failed: {str(e)}")
+        update = {'status': 'error', 'message': str(e)}
+    finally:
+        for path in (archive_path, names_path):
+            if path:
+                os.remove(path)
+    
+    update['finished_at'] = datetime.datetime.now()
+    if db is not None:
+        db.enrollment_jobs.update_one({'_id': job_id}, {'$set': update})
+
+def save_upload_to_temp(file_storage, suffix):
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    with os.fdopen(fd, 'wb') as f:
+        file_storage.save(f)
+    return path
+
+@app.route('/students/bulk_enroll', methods=['POST'])
+@login_required
+def bulk_enroll_students():
+    # ZIP of student_id/*.jpg folders plus students.csv (or a separate 'names' CSV upload)
+    if session['user'].get('role') != 'admin':
+        return jsonify({'status': 'error', 'message': 'Admin access required'}), 403
+    
+    archive = request.files.get('archive')
+    if archive is None or archive.filename == '':
+        return jsonify({'status': 'error', 'message': 'No archive uploaded'}), 400
+    
+    db = get_db()
+    if db is None:
+        return jsonify({'status': 'error', 'message': 'Database connection failed'}), 500
+    
+    archive_path = save_upload_to_temp(archive, '.zip')
+    names = request.files.get('names')
+    names_path = save_upload_to_temp(names, '.csv') if names and names.filename else None
+    try:
+        # Reject a broken archive now rather than in the background job
+        with bulk_enroll.EnrollmentSource(archive_path, names_path) as source:
+            student_count = len(source.images)
+    except Exception as e:
+        for path in (archive_path, names_path):
+            if path:
+                os.remove(path)
+        return jsonify({'status': 'error', 'message': f"Invalid archive: {str(e)}"}), 400
+    
+    job_id = uuid.uuid4().hex
+    db.enrollment_jobs.insert_one({
+        '_id': job_id,
+        'status': 'running',
+        'username': session['user']['username'],
+        'students': student_count,
+        'created_at': datetime.datetime.now()
+    })
+    replace_existing = request.form.get('replace_existing') in ('1', 'true', 'on')
+    enrollment_runner.submit(run_enrollment_job, job_id, archive_path, names_path, replace_existing)
+    
+    return jsonify({
+        'status': 'accepted',
+        'job_id': job_id,
+        'students': student_count,
+        'poll_url': url_for('bulk_enroll_job', job_id=job_id)
+    }), 202
+
+@app.route('/students/bulk_enroll/<job_id>')
+@login_required
+def bulk_enroll_job(job_id):
+    if session['user'].get('role') != 'admin':
+        return jsonify({'status': 'error', 'message': 'Admin access required'}), 403
+    
+    db = get_db()
+    if db is None:
+        return jsonify({'status': 'error', 'message': 'Database connection failed'}), 500
+    
+    job = db.enrollment_jobs.find_one({'_id': job_id})
+    if not job:
+        return jsonify({'status': 'error', 'message': 'Job not found'}), 404
+    
+    job['job_id'] = job.pop('_id')
+    return jsonify(job)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if not metrics.enabled:
+        return jsonify({'status': 'error', 'message': 'Metrics are disabled'}), 404
+    token = app.config['METRICS_TOKEN']
+    authorized = token and request.headers.get('Authorization') == f"Bearer {token}"
+    if not authorized and session.get('user', {}).get('role') != 'admin':
+        return jsonify({'status': 'error', 'message': 'Admin access required'}), 403
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/recognition_cache_stats')
+@login_required
+def recognition_cache_stats():
+    if session['user'].get('role') != 'admin':
+        return jsonify({'status': 'error', 'message': 'Admin access required'}), 403
+    return jsonify(recent_recognitions.stats())
+
+@app.route('/classes/<class_name>/roster', methods=['GET', 'POST'])
+@login_required
+def class_roster(class_name):
+    db = get_db()
+    if db is None:
+        return jsonify({'status': 'error', 'message': 'Database connection failed'}), 500
+    
+    if request.method == 'POST':
+        # Enroll / unenroll students: {"add": [student_id, ...], "remove": [student_id, ...]}
+        data = request.get_json(silent=True) or {}
+        add = [str(s) for s in data.get('add', [])]
+        remove = [str(s) for s in data.get('remove', [])]
+        now = datetime.datetime.now()
+        
+        if add:
+            db.students.update_many(
+                {'student_id': {'$in': add}},
+                {'$addToSet': {'classes': class_name}, '$set': {'updated_at': now}}
+            )
+        if remove:
+            db.students.update_many(
+                {'student_id': {'$in': remove}},
+                {'$pull': {'classes': class_name}, '$set': {'updated_at': now}}
+            )
+        # Only the changed students are re-read; other workers follow via gallery_sync
+        if add or remove:
+            gallery_sync.refresh(force=True)
+    
+    students = list(db.students.find(
+        {'classes': class_name},
+        {'_id': 0, 'student_id': 1, 'name': 1}
+    ).sort('student_id', ASCENDING))
+    return jsonify({'status': 'success', 'class_name': class_name, 'students': students})
+
 
 @app.route('/reports')
 @login_required
@@ -470,26 +1316,10 @@ def reports():
                                   student_data=[],
                                   class_data=[])
         
-        # Daily attendance (last 30 days)
+        # Daily attendance (last 30 days), read from the rollups
         daily_data = []
         try:
-            daily_data = list(db.attendance.aggregate([
-                {
-                    "$group": {
-                        "_id": {"$dateToString": { "format": "%Y-%m-%d", "date": "$timestamp" }},
-                        "count": {"$sum": 1}
-                    }
-                },
-                {"$sort": {"_id": -1}},
-                {"$limit": 30},
-                {
-                    "$project": {
-                        "date": "$_id",
-                        "count": 1,
-                        "_id": 0
-                    }
-                }
-            ]))
+            daily_data = attendance_rollups.daily_counts(db, days=30)
         except Exception as e:
             app.logger.error(f"Error retrieving daily data: {str(e)}")
             flash('Error retrieving daily attendance data', 'warning')
@@ -497,33 +1327,7 @@ def reports():
         # Student attendance
         student_data = []
         try:
-            student_data = list(db.attendance.aggregate([
-                {
-                    "$group": {
-                        "_id": "$student_id",
-                        "attendance_count": {"$sum": 1},
-                        "last_attendance": {"$max": "$timestamp"}
-                    }
-                },
-                {
-                    "$lookup": {
-                        "from": "students",
-                        "localField": "_id",
-                        "foreignField": "student_id",
-                        "as": "student_info"
-                    }
-                },
-                {"$unwind": "$student_info"},
-                {
-                    "$project": {
-                        "student_id": "$_id",
-                        "name": "$student_info.name",
-                        "attendance_count": 1,
-                        "last_attendance": 1
-                    }
-                },
-                {"$sort": {"attendance_count": -1}}
-            ]))
+            student_data = attendance_rollups.student_totals(db)
         except Exception as e:
             app.logger.error(f"Error retrieving student data: {str(e)}")
             flash('Error retrieving student attendance data', 'warning')
@@ -531,22 +1335,7 @@ def reports():
         # Class attendance
         class_data = []
         try:
-            class_data = list(db.attendance.aggregate([
-                {
-                    "$group": {
-                        "_id": "$class_name",
-                        "count": {"$sum": 1}
-                    }
-                },
-                {
-                    "$project": {
-                        "class_name": "$_id",
-                        "count": 1,
-                        "_id": 0
-                    }
-                },
-                {"$sort": {"count": -1}}
-            ]))
+            class_data = attendance_rollups.class_counts(db)
         except Exception as e:
             app.logger.error(f"Error retrieving class data: {str(e)}")
             flash('Error retrieving class attendance data', 'warning')
@@ -588,46 +1377,26 @@ def export_csv():
             response.status_code = 500
             return response
             
-        # Get student attendance data
-        student_data = list(db.attendance.aggregate([
-            {
-                "$group": {
-                    "_id": "$student_id",
-                    "attendance_count": {"$sum": 1},
-                    "last_attendance": {"$max": "$timestamp"}
-                }
-            },
-            {
-                "$lookup": {
-                    "from": "students",
-                    "localField": "_id",
-                    "foreignField": "student_id",
-                    "as": "student_info"
-                }
-            },
-            {"$unwind": "$student_info"},
-            {
-                "$project": {
-                    "student_id": "$_id",
-                    "name": "$student_info.name",
-                    "attendance_count": 1,
-                    "last_attendance": 1
-                }
-            }
-        ]))
-        
-        # Create CSV content
-        csv_content = "Student ID,Name,Attendance Count,Last Attendance\n"
-        for row in student_data:
-            last_attendance = row['last_attendance'].strftime('%Y-%m-%d %H:%M') if row.get('last_attendance') else 'Never'
-            # Escape any commas in names to prevent CSV format issues
-            name = str(row['name']).replace('"', '""') if row.get('name') else ''
-            csv_content += f'"{row["student_id"]}","{name}",{row["attendance_count"]},{last_attendance}\n'
-        
-        # Create response
-        response = make_response(csv_content)
-        response.headers['Content-Type'] = 'text/csv'
-        response.headers['Content-Disposition'] = 'attachment; filename=attendance_report.csv'
+        # ?mode=summary|records&from=YYYY-MM-DD&to=YYYY-MM-DD&class_name=...
+        try:
+            start = attendance_export.parse_day(request.args['from'], 'from') if request.args.get('from') else None
+            end = attendance_export.parse_day(request.args['to'], 'to') if request.args.get('to') else None
+            filename, chunks = attendance_export.export(
+                db,
+                mode=request.args.get('mode', 'summary'),
+                start=start,
+                end=end,
+                class_name=request.args.get('class_name') or None
+            )
+        except ValueError as e:
+            response = make_response(str(e))
+            response.headers['Content-Type'] = 'text/plain'
+            response.status_code = 400
+            return response
+        
+        # Stream rows from the cursor instead of building the whole file in memory
+        response = Response(stream_with_context(chunks), mimetype='text/csv')
+        response.headers['Content-Disposition'] = f'attachment; filename={filename}'
         return response
         
     except Exception as e:
@@ -638,5 +1407,127 @@ def export_csv():
         response.status_code = 500
         return response
 
+# Maintenance commands: flask --app app rollups rebuild|check
+rollups_cli = AppGroup('rollups', help='Maintain the attendance report rollups.')
+
+@rollups_cli.command('rebuild')
+def rebuild_rollups():
+    """Recompute the rollups from the attendance collection"""
+    db = get_db()
+    if db is None:
+        raise click.ClickException('Database connection failed')
+    for name, rows in attendance_rollups.rebuild(db).items():
+        click.echo(f"{name}: {rows} rows")
+
+@rollups_cli.command('check')
+def check_rollups():
+    """Compare the rollups with the attendance collection"""
+    db = get_db()
+    if db is None:
+        raise click.ClickException('Database connection failed')
+    mismatches = attendance_rollups.check(db)
+    for name, key, expected, actual in mismatches:
+        click.echo(f"{name} {key}: expected {expected}, found {actual}")
+    if mismatches:
+        raise click.ClickException(f"{len(mismatches)} rollup rows differ; run 'flask rollups rebuild'")
+    click.echo('Rollups are consistent')
+
+app.cli.add_command(rollups_cli)
+
+encodings_cli = AppGroup('encodings', help='Inspect and migrate stored face encodings.')
+
+@encodings_cli.command('stats')
+def encoding_stats():
+    """Count stored encodings by format version and dtype"""
+    db = get_db()
+    if db is None:
+        raise click.ClickException('Database connection failed')
+    counts = {}
+    for student in db.students.find({'face_encoding': {'$exists': True}}, {'face_encoding': 1}):
+        try:
+            info = encoding_format.describe(student['face_encoding'])
+            key = f"version={info['version']} dtype={info['dtype'].name} dim={info['dim']}"
+        except ValueError as e:
+            key = f"invalid ({e})"
+        counts[key] = counts.get(key, 0) + 1
+    for key, count in sorted(counts.items()):
+        click.echo(f"{count:>8}  {key}")
+
+@encodings_cli.command('migrate')
+@click.option('--dtype', type=click.Choice(['float64', 'float32', 'float16']), default=None,
+              help='Target dtype (default: FACE_ENCODING_DTYPE)')
+@click.option('--batch-size', type=int, default=500, show_default=True)
+@click.option('--dry-run', is_flag=True, help='Report what would change without writing')
+def migrate_encodings(dtype, batch_size, dry_run):
+    """Convert stored encodings to the current format, in batches"""
+    db = get_db()
+    if db is None:
+        raise click.ClickException('Database connection failed')
+    counts = encoding_format.migrate(db.students, dtype=dtype or app.config['FACE_ENCODING_DTYPE'],
+                                     batch_size=batch_size, dry_run=dry_run)
+    click.echo(', '.join(f"{key}: {value}" for key, value in counts.items()))
+
+app.cli.add_command(encodings_cli)
+
+students_cli = AppGroup('students', help='Student enrollment tools.')
+
+@students_cli.command('bulk-enroll')
+@click.argument('source', type=click.Path(exists=True))
+@click.option('--names', type=click.Path(exists=True, dir_okay=False),
+              help='CSV of student_id,name[,classes] (default: students.csv inside SOURCE)')
+@click.option('--replace-existing', is_flag=True, help='Re-enroll students that already exist')
+@click.option('--report', type=click.Path(dir_okay=False, writable=True), help='Write per-image failures to this CSV')
+def bulk_enroll_command(source, names, replace_existing, report):
+    """Enroll every student_id/*.jpg folder in SOURCE (a directory or ZIP archive)"""
+    db = get_db()
+    if db is None:
+        raise click.ClickException('Database connection failed')
+    with bulk_enroll.EnrollmentSource(source, names) as enrollment_source:
+        click.echo(f"Found {len(enrollment_source.images)} students, "
+                   f"{sum(len(images) for images in enrollment_source.images.values())} images")
+        result = make_bulk_enrollment(db, replace_existing).run(enrollment_source)
+    face_pool.shutdown()
+    
+    failures = result.pop('image_failures')
+    click.echo(', '.join(f"{key}: {value}" for key, value in result.items()))
+    click.echo(f"image failures: {len(failures)}")
+    if report:
+        with open(report, 'w', newline='', encoding='utf-8') as f:
+            bulk_enroll.write_failures(failures, f)
+        click.echo(f"Failure report written to {report}")
+    else:
+        for student_id, image, reason in failures[:20]:
+            click.echo(f"  {student_id} {image or ''}: {reason}")
+
+app.cli.add_command(students_cli)
+
+attendance_cli = AppGroup('attendance', help='Attendance record maintenance.')
+
+@attendance_cli.command('backfill-day')
+@click.option('--batch-size', type=int, default=1000, show_default=True)
+def backfill_attendance_day(batch_size):
+    """Add the day field to attendance records written before it existed"""
+    db = get_db()
+    if db is None:
+        raise click.ClickException('Database connection failed')
+    updated, duplicates = attendance_records.backfill_days(db, batch_size=batch_size)
+    click.echo(f"Updated {updated} records; {duplicates} legacy duplicates left without a day")
+
+app.cli.add_command(attendance_cli)
+
+gallery_cli = AppGroup('gallery', help='Face gallery maintenance.')
+
+@gallery_cli.command('snapshot')
+def gallery_snapshot_command():
+    """Rebuild the gallery snapshot from a full read of the students collection"""
+    if not app.config['GALLERY_SNAPSHOT_PATH']:
+        raise click.ClickException('GALLERY_SNAPSHOT_PATH is not set')
+    if not gallery_sync.warm_up(watch=False, use_snapshot=False):
+        raise click.ClickException('Database connection failed')
+    click.echo(f"Snapshot of {len(gallery)} students ({gallery.template_count} templates) "
+               f"written to {app.config['GALLERY_SNAPSHOT_PATH']}")
+
+app.cli.add_command(gallery_cli)
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file
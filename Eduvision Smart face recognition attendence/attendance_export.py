@@ -0,0 +1,140 @@
+"""Streaming CSV exports of attendance.
+
+Every export is a generator of CSV text chunks fed straight from a MongoDB
+cursor, so a multi-year export runs in constant memory and the first bytes
+reach the client before the last rows have been read.
+"""
+import csv
+import datetime
+import io
+
+from pymongo import ASCENDING
+
+import attendance_rollups
+
+EXPORT_MODES = ('summary', 'records')
+
+SUMMARY_HEADER = ['Student ID', 'Name', 'Attendance Count', 'Last Attendance']
+RECORDS_HEADER = ['Student ID', 'Name', 'Class', 'Timestamp', 'Confidence']
+
+
+def parse_day(value, name):
+    """Parse a ``YYYY-MM-DD`` query parameter; raises ValueError with a readable message"""
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise ValueError(f"'{name}' must be a date in YYYY-MM-DD format")
+
+
+def build_filter(start=None, end=None, class_name=None):
+    """Attendance query for an inclusive day range and an optional class"""
+    query = {}
+    if start or end:
+        query['timestamp'] = {}
+        if start:
+            query['timestamp']['$gte'] = start
+        if end:
+            query['timestamp']['$lt'] = end + datetime.timedelta(days=1)
+    if class_name:
+        query['class_name'] = class_name
+    return query
+
+
+def stream_csv(header, rows, chunk_rows=500):
+    """Yield CSV text for ``header`` and ``rows`` in chunks of ``chunk_rows`` lines"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _format_time(value, fmt='%Y-%m-%d %H:%M'):
+    return value.strftime(fmt) if value else 'Never'
+
+
+def summary_rows(db, query=None, batch_size=1000):
+    """One row per student. Unfiltered exports read the rollups; filtered ones group the matching records"""
+    if not query:
+        rows = attendance_rollups.iter_student_totals(db, batch_size=batch_size)
+    else:
+        rows = db.attendance.aggregate([
+            {"$match": query},
+            {"$group": {
+                "_id": "$student_id",
+                "attendance_count": {"$sum": 1},
+                "last_attendance": {"$max": "$timestamp"}
+            }},
+            {"$lookup": {
+                "from": "students",
+                "localField": "_id",
+                "foreignField": "student_id",
+                "as": "student_info"
+            }},
+            {"$unwind": "$student_info"},
+            {"$sort": {"attendance_count": -1}},
+            {"$project": {
+                "student_id": "$_id",
+                "name": "$student_info.name",
+                "attendance_count": 1,
+                "last_attendance": 1
+            }}
+        ], allowDiskUse=True, batchSize=batch_size)
+    for row in rows:
+        yield [row['student_id'], row.get('name') or '', row['attendance_count'], _format_time(row.get('last_attendance'))]
+
+
+def record_rows(db, query=None, batch_size=1000):
+    """One row per attendance record, oldest first; names are looked up one batch at a time"""
+    cursor = db.attendance.find(
+        query or {},
+        {'_id': 0, 'student_id': 1, 'class_name': 1, 'timestamp': 1, 'confidence': 1}
+    ).sort('timestamp', ASCENDING).batch_size(batch_size)
+
+    batch = []
+    for record in cursor:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield from _record_batch(db, batch)
+            batch = []
+    yield from _record_batch(db, batch)
+
+
+def _record_batch(db, records):
+    if not records:
+        return
+    names = attendance_rollups.student_names(db, {record['student_id'] for record in records})
+    for record in records:
+        confidence = record.get('confidence')
+        yield [
+            record['student_id'],
+            names.get(record['student_id']) or '',
+            record.get('class_name') or '',
+            _format_time(record.get('timestamp'), '%Y-%m-%d %H:%M:%S'),
+            f"{confidence:.2f}" if confidence is not None else ''
+        ]
+
+
+def export(db, mode='summary', start=None, end=None, class_name=None):
+    """Return ``(filename, chunks)`` for an export; ``chunks`` is a generator of CSV text"""
+    if mode not in EXPORT_MODES:
+        raise ValueError(f"'mode' must be one of: {', '.join(EXPORT_MODES)}")
+    query = build_filter(start, end, class_name)
+    if mode == 'records':
+        header, rows = RECORDS_HEADER, record_rows(db, query)
+    else:
+        header, rows = SUMMARY_HEADER, summary_rows(db, query)
+
+    parts = ['attendance', mode]
+    if class_name:
+        parts.append(''.join(c if c.isalnum() or c in '-_' else '_' for c in class_name))
+    if start:
+        parts.append(start.strftime('%Y%m%d'))
+    if end:
+        parts.append(end.strftime('%Y%m%d'))
+    return '_'.join(parts) + '.csv', stream_csv(header, rows)
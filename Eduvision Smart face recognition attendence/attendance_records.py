@@ -0,0 +1,121 @@
+"""Writing attendance records.
+
+Each record carries a ``day`` (``YYYY-MM-DD``) field, and a unique index on
+``(student_id, class_name, day)`` makes "one record per student, class and
+day" a database guarantee. All students recognized in a frame are written
+with one unordered bulk write of upserts, so a request is a single round trip
+and concurrent requests for the same classroom cannot create duplicates.
+
+Records written before ``day`` existed are left out of the unique index (it
+is partial) until :func:`backfill_days` gives them a ``day``.
+"""
+import logging
+
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger('eduvision.attendance_records')
+
+DUPLICATE_KEY = 11000
+DAY_FORMAT = '%Y-%m-%d'
+
+
+def ensure_indexes(db):
+    db.attendance.create_index(
+        [("student_id", ASCENDING), ("class_name", ASCENDING), ("day", ASCENDING)],
+        name='student_class_day_unique',
+        unique=True,
+        partialFilterExpression={'day': {'$exists': True}}
+    )
+
+
+def record(db, class_name, confidences, now):
+    """Record each student once for ``class_name`` today.
+
+    ``confidences`` maps student ids to match confidence. Returns the list of
+    newly inserted records; students already recorded today are left as they
+    are.
+    """
+    if not confidences:
+        return []
+    day = now.strftime(DAY_FORMAT)
+    student_ids = list(confidences)
+    operations = [
+        UpdateOne(
+            {'student_id': student_id, 'class_name': class_name, 'day': day},
+            {'$setOnInsert': {'timestamp': now, 'confidence': confidences[student_id]}},
+            upsert=True
+        )
+        for student_id in student_ids
+    ]
+    try:
+        upserted = db.attendance.bulk_write(operations, ordered=False).upserted_ids
+    except BulkWriteError as e:
+        # Two requests upserting the same student at the same moment: the loser just sees a duplicate
+        errors = [error for error in e.details.get('writeErrors', []) if error.get('code') != DUPLICATE_KEY]
+        if errors:
+            raise
+        upserted = {item['index']: item['_id'] for item in e.details.get('upserted', [])}
+
+    return [
+        {
+            '_id': upserted[index],
+            'student_id': student_ids[index],
+            'timestamp': now,
+            'class_name': class_name,
+            'day': day,
+            'confidence': confidences[student_ids[index]]
+        }
+        for index in sorted(upserted)
+    ]
+
+
+def backfill_days(db, since=None, batch_size=1000):
+    """Set ``day`` on records that predate it; returns ``(updated, duplicates)``.
+
+    Only the earliest of several legacy records for the same student, class
+    and day gets a ``day``; the others stay outside the unique index (and are
+    still counted by reports, as before). ``since`` limits the backfill to
+    recent records, which uses the timestamp index.
+    """
+    match = {'day': {'$exists': False}}
+    if since is not None:
+        match['timestamp'] = {'$gte': since}
+    groups = db.attendance.aggregate([
+        {"$match": match},
+        {"$sort": {"timestamp": 1}},
+        {"$group": {
+            "_id": {
+                "student_id": "$student_id",
+                "class_name": "$class_name",
+                "day": {"$dateToString": {"format": DAY_FORMAT, "date": "$timestamp"}}
+            },
+            "first": {"$first": "$_id"},
+            "count": {"$sum": 1}
+        }}
+    ], allowDiskUse=True)
+
+    updated = duplicates = 0
+    batch = []
+    for group in groups:
+        duplicates += group['count'] - 1
+        batch.append(UpdateOne({'_id': group['first'], 'day': {'$exists': False}},
+                               {'$set': {'day': group['_id']['day']}}))
+        if len(batch) >= batch_size:
+            updated += _apply(db, batch)
+            batch = []
+    if batch:
+        updated += _apply(db, batch)
+    if updated or duplicates:
+        logger.info(f"Backfilled day on {updated} attendance records ({duplicates} legacy duplicates left as is)")
+    return updated, duplicates
+
+
+def _apply(db, operations):
+    try:
+        return db.attendance.bulk_write(operations, ordered=False).modified_count
+    except BulkWriteError as e:
+        # A record written with ``day`` since then already holds this key
+        if any(error.get('code') != DUPLICATE_KEY for error in e.details.get('writeErrors', [])):
+            raise
+        return e.details.get('nModified', 0)
@@ -0,0 +1,163 @@
+"""Materialized attendance rollups used by the report pages.
+
+Three small collections are kept next to ``attendance`` and updated whenever
+attendance records are inserted:
+
+- ``attendance_daily``: ``{_id: 'YYYY-MM-DD', count}``
+- ``attendance_by_class``: ``{_id: class_name, count}``
+- ``attendance_by_student``: ``{_id: student_id, attendance_count, last_attendance}``
+
+Reports read these instead of grouping the whole attendance history. The
+rollup update is a separate write from the insert, so :func:`check` compares
+them with the source collection and :func:`rebuild` recomputes them.
+"""
+import logging
+from collections import Counter
+
+from pymongo import DESCENDING, UpdateOne
+
+logger = logging.getLogger('eduvision.rollups')
+
+DAILY = 'attendance_daily'
+BY_CLASS = 'attendance_by_class'
+BY_STUDENT = 'attendance_by_student'
+
+# Source aggregations; used to rebuild the rollups and to check them
+PIPELINES = {
+    DAILY: [
+        {"$group": {
+            "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$timestamp"}},
+            "count": {"$sum": 1}
+        }}
+    ],
+    BY_CLASS: [
+        {"$group": {"_id": "$class_name", "count": {"$sum": 1}}}
+    ],
+    BY_STUDENT: [
+        {"$group": {
+            "_id": "$student_id",
+            "attendance_count": {"$sum": 1},
+            "last_attendance": {"$max": "$timestamp"}
+        }}
+    ],
+}
+
+
+def ensure_indexes(db):
+    db[BY_CLASS].create_index([("count", DESCENDING)])
+    db[BY_STUDENT].create_index([("attendance_count", DESCENDING)])
+
+
+def record(db, records):
+    """Fold newly inserted attendance records into the rollups (one bulk write per rollup)"""
+    if not records:
+        return
+    daily = Counter(r['timestamp'].strftime('%Y-%m-%d') for r in records)
+    classes = Counter(r.get('class_name') for r in records)
+    students = {}
+    for r in records:
+        count, last = students.get(r['student_id'], (0, r['timestamp']))
+        students[r['student_id']] = (count + 1, max(last, r['timestamp']))
+
+    db[DAILY].bulk_write([
+        UpdateOne({'_id': day}, {'$inc': {'count': count}}, upsert=True)
+        for day, count in daily.items()
+    ], ordered=False)
+    db[BY_CLASS].bulk_write([
+        UpdateOne({'_id': class_name}, {'$inc': {'count': count}}, upsert=True)
+        for class_name, count in classes.items()
+    ], ordered=False)
+    db[BY_STUDENT].bulk_write([
+        UpdateOne({'_id': student_id},
+                  {'$inc': {'attendance_count': count}, '$max': {'last_attendance': last}},
+                  upsert=True)
+        for student_id, (count, last) in students.items()
+    ], ordered=False)
+
+
+def rebuild(db):
+    """Recompute every rollup from the attendance collection; returns the number of rows per rollup.
+
+    Each rollup is replaced atomically with ``$out``. Attendance written while
+    a rebuild runs may be missed, so run it in a quiet period (or run
+    :func:`check` afterwards).
+    """
+    sizes = {}
+    for name, pipeline in PIPELINES.items():
+        db.attendance.aggregate(pipeline + [{"$out": name}])
+        sizes[name] = db[name].count_documents({})
+        logger.info(f"Rebuilt {name}: {sizes[name]} rows")
+    ensure_indexes(db)
+    return sizes
+
+
+def check(db):
+    """Compare the rollups with the attendance collection.
+
+    Returns a list of ``(rollup, key, expected, actual)`` tuples, empty when
+    everything matches. ``expected``/``actual`` are ``None`` for missing rows.
+    """
+    mismatches = []
+    for name, pipeline in PIPELINES.items():
+        expected = {row.pop('_id'): row for row in db.attendance.aggregate(pipeline)}
+        actual = {row.pop('_id'): row for row in db[name].find()}
+        for key in expected.keys() | actual.keys():
+            if expected.get(key) != actual.get(key):
+                mismatches.append((name, key, expected.get(key), actual.get(key)))
+    return mismatches
+
+
+def daily_counts(db, days=30):
+    """Most recent ``days`` days with attendance, newest first, as ``{date, count}`` dicts"""
+    return [{'date': row['_id'], 'count': row['count']}
+            for row in db[DAILY].find().sort('_id', DESCENDING).limit(days)]
+
+
+def class_counts(db):
+    """Attendance per class as ``{class_name, count}`` dicts, busiest first"""
+    return [{'class_name': row['_id'], 'count': row['count']}
+            for row in db[BY_CLASS].find().sort('count', DESCENDING)]
+
+
+def student_names(db, student_ids):
+    """Map the given student ids to names with one projected query"""
+    return {
+        student['student_id']: student.get('name')
+        for student in db.students.find({'student_id': {'$in': list(student_ids)}}, {'student_id': 1, 'name': 1})
+    }
+
+
+def iter_student_totals(db, batch_size=1000):
+    """Yield attendance count and last attendance per registered student, most present first.
+
+    Rows are read from the rollup cursor and joined with student names one
+    batch at a time, so memory use does not grow with the number of students.
+    """
+    cursor = db[BY_STUDENT].find().sort('attendance_count', DESCENDING).batch_size(batch_size)
+    batch = []
+    for row in cursor:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield from _with_names(db, batch)
+            batch = []
+    yield from _with_names(db, batch)
+
+
+def _with_names(db, rows):
+    if not rows:
+        return
+    names = student_names(db, {row['_id'] for row in rows})
+    # Like the old $lookup/$unwind, rows for deleted students are left out
+    for row in rows:
+        if row['_id'] in names:
+            yield {
+                'student_id': row['_id'],
+                'name': names[row['_id']],
+                'attendance_count': row['attendance_count'],
+                'last_attendance': row.get('last_attendance')
+            }
+
+
+def student_totals(db):
+    """Attendance count and last attendance per registered student, most present first"""
+    return list(iter_student_totals(db))
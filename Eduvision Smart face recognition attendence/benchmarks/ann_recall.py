@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""Recall and latency of the IVF gallery index against the exact matcher.
+
+Builds a synthetic gallery of 128-d encodings, probes it with noisy copies of
+enrolled students (like attendance frames would) and reports, per ``nprobe``,
+how often the IVF index returns the same student as the exact brute-force
+search, together with the per-face query latency.
+
+    python benchmarks/ann_recall.py --students 100000 --queries 500 --nprobe 4 8 16 32
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gallery_index import ExactIndex, IVFIndex  # noqa: E402
+
+
+def synthetic_gallery(students, queries, spread, noise, seed):
+    """Random student encodings plus noisy probes of randomly chosen students"""
+    rng = np.random.default_rng(seed)
+    gallery = rng.normal(0, spread, size=(students, 128))
+    truth = rng.integers(0, students, size=queries)
+    probes = gallery[truth] + rng.normal(0, noise, size=(queries, 128))
+    return gallery, probes
+
+
+def timed_search(searcher, probes, batch):
+    rows = np.empty(len(probes), dtype=np.intp)
+    start = time.perf_counter()
+    for i in range(0, len(probes), batch):
+        rows[i:i + batch], _ = searcher.search(probes[i:i + batch])
+    elapsed = time.perf_counter() - start
+    return rows, elapsed * 1000 / len(probes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--students', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--faces-per-frame', type=int, default=10, help='faces searched per call')
+    parser.add_argument('--nlist', type=int, default=None, help='IVF cells (default 4*sqrt(N))')
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 8, 16, 32])
+    parser.add_argument('--spread', type=float, default=0.06, help='std-dev of synthetic student encodings')
+    parser.add_argument('--noise', type=float, default=0.02, help='std-dev of per-frame encoding noise')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    gallery, probes = synthetic_gallery(args.students, args.queries, args.spread, args.noise, args.seed)
+
+    exact_rows, exact_ms = timed_search(ExactIndex().build(gallery), probes, args.faces_per_frame)
+    results = [{'backend': 'exact', 'nprobe': None, 'recall': 1.0, 'ms_per_face': exact_ms, 'build_s': 0.0}]
+
+    for nprobe in args.nprobe:
+        index = IVFIndex(nlist=args.nlist, nprobe=nprobe, min_size=0, seed=args.seed)
+        start = time.perf_counter()
+        searcher = index.build(gallery)
+        build_s = time.perf_counter() - start
+        rows, ms = timed_search(searcher, probes, args.faces_per_frame)
+        results.append({
+            'backend': 'ivf',
+            'nprobe': nprobe,
+            'recall': float(np.mean(rows == exact_rows)),
+            'ms_per_face': ms,
+            'build_s': build_s,
+        })
+
+    if args.json:
+        print(json.dumps({'students': args.students, 'queries': args.queries, 'results': results}, indent=2))
+        return
+
+    print(f"{args.students} students, {args.queries} probe faces")
+    print(f"{'backend':<8}{'nprobe':>8}{'recall@1':>10}{'ms/face':>10}{'build s':>10}")
+    for r in results:
+        nprobe = '-' if r['nprobe'] is None else r['nprobe']
+        print(f"{r['backend']:<8}{nprobe:>8}{r['recall']:>10.3f}{r['ms_per_face']:>10.3f}{r['build_s']:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Latency and recall of face detection settings on the bundled sample images.
+
+Every variant is compared with the original behaviour (full-resolution HOG,
+CNN fallback whenever HOG finds nothing). A face counts as recalled when a
+variant returns a box overlapping the baseline box (IoU >= 0.3). Blank
+frames are included because that is where the CNN fallback used to cost the
+most.
+
+    python benchmarks/detection.py --repeat 3
+    python benchmarks/detection.py --images path/to/frames --json
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import face_pipeline  # noqa: E402
+
+VARIANTS = {
+    'baseline': {'max_width': 0, 'cnn_fallback': 'always', 'cnn_max_width': 0, 'cnn_budget': 0},
+    'hog-640-precheck': {'max_width': 640, 'cnn_fallback': 'precheck', 'cnn_max_width': 480},
+    'hog-480-precheck': {'max_width': 480, 'cnn_fallback': 'precheck', 'cnn_max_width': 480},
+    'hog-320-precheck': {'max_width': 320, 'cnn_fallback': 'precheck', 'cnn_max_width': 320},
+    'hog-640-no-cnn': {'max_width': 640, 'cnn_fallback': 'never'},
+}
+
+
+def load_images(pattern, blank_frames):
+    images = []
+    for path in sorted(glob.glob(pattern)):
+        with open(path, 'rb') as f:
+            images.append((os.path.basename(path), face_pipeline.decode_image(f.read())))
+    rng = np.random.default_rng(0)
+    for i in range(blank_frames):
+        noise = rng.integers(90, 140, size=(480, 640, 3), dtype=np.uint8)
+        images.append((f'blank_{i}', noise))
+    return images
+
+
+def iou(a, b):
+    top, right = max(a[0], b[0]), min(a[1], b[1])
+    bottom, left = min(a[2], b[2]), max(a[3], b[3])
+    inter = max(0, bottom - top) * max(0, right - left)
+    area = lambda box: (box[2] - box[0]) * (box[1] - box[3])  # noqa: E731
+    union = area(a) + area(b) - inter
+    return inter / union if union else 0.0
+
+
+def run_variant(options, images, repeat):
+    latencies, found, stages = [], {}, {}
+    for name, img in images:
+        for _ in range(repeat):
+            timings = {}
+            start = time.perf_counter()
+            boxes = face_pipeline.detect_faces(img, options, timings)
+            latencies.append((time.perf_counter() - start) * 1000)
+            for stage, value in timings.items():
+                if isinstance(value, float):
+                    stages.setdefault(stage, []).append(value * 1000)
+        found[name] = boxes
+    return latencies, found, {stage: statistics.mean(values) for stage, values in stages.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', default=os.path.join(APP_DIR, 'static', 'uploads', '*.jpg'),
+                        help='glob of sample images')
+    parser.add_argument('--blank-frames', type=int, default=2, help='add N face-free noise frames')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    images = load_images(args.images, args.blank_frames)
+    if not images:
+        parser.error(f"no images match {args.images}")
+
+    # Warm up the dlib models so the first variant is not charged for loading them
+    face_pipeline.detect_faces(images[0][1], VARIANTS['baseline'])
+
+    results = []
+    baseline = None
+    for variant, options in VARIANTS.items():
+        latencies, found, stages = run_variant(options, images, args.repeat)
+        if baseline is None:
+            baseline = found
+        expected = sum(len(boxes) for boxes in baseline.values())
+        recalled = sum(
+            1 for name, boxes in baseline.items() for box in boxes
+            if any(iou(box, other) >= 0.3 for other in found[name])
+        )
+        results.append({
+            'variant': variant,
+            'options': options,
+            'mean_ms': statistics.mean(latencies),
+            'max_ms': max(latencies),
+            'faces': sum(len(boxes) for boxes in found.values()),
+            'recall': recalled / expected if expected else 1.0,
+            'stage_mean_ms': stages,
+        })
+
+    if args.json:
+        print(json.dumps({'images': [name for name, _ in images], 'results': results}, indent=2))
+        return
+
+    print(f"{len(images)} images x {args.repeat} runs")
+    print(f"{'variant':<20}{'mean ms':>10}{'max ms':>10}{'faces':>7}{'recall':>8}  stages (mean ms)")
+    for r in results:
+        stages = ' '.join(f"{stage}={ms:.0f}" for stage, ms in r['stage_mean_ms'].items())
+        print(f"{r['variant']:<20}{r['mean_ms']:>10.1f}{r['max_ms']:>10.1f}{r['faces']:>7}{r['recall']:>8.2f}  {stages}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""Latency and accuracy of face encoding policies (jitters and quality checks).
+
+Every identity is enrolled from its first image with each enrollment policy.
+The identity is the file name up to the first ``_``, as in ``static/uploads``,
+or with ``--by-folder`` the folder name, as in ``dataset/<student_id>/*.jpg``.
+Every image is then probed as an attendance frame with each attendance
+policy. Probes are run as-is, blurred and downscaled, so the quality checks
+have something to reject. Synthetic students are added to the gallery so a
+wrong match is possible.
+
+Reported per policy and probe variant:
+
+- encoding and quality-check time per face;
+- faces skipped by the quality checks;
+- the share of images whose student was recognized;
+- faces matched to the wrong student.
+
+    python benchmarks/encoding_policy.py
+    python benchmarks/encoding_policy.py --images 'dataset/*/*.jpg' --by-folder --json
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import sys
+import time
+
+import cv2
+import numpy as np
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import encoding_format  # noqa: E402
+import face_pipeline  # noqa: E402
+import face_settings  # noqa: E402
+from gallery import FaceGallery  # noqa: E402
+
+# The app's policies (face_settings) next to the previous fixed num_jitters=2
+ATTENDANCE_DETECTION = face_settings.FACE_DETECTION
+ENROLLMENT_DETECTION = face_settings.FACE_DETECTION_ENROLLMENT
+ATTENDANCE_POLICIES = {
+    'jitter-2': {'num_jitters': 2},
+    'jitter-1': {'num_jitters': 1},
+    'attendance': face_settings.FACE_ENCODING_ATTENDANCE,
+    'stream': face_settings.FACE_ENCODING_STREAM,
+}
+ENROLLMENT_POLICIES = {
+    'jitter-2': {'num_jitters': 2},
+    'enrollment': face_settings.FACE_ENCODING_ENROLLMENT,
+}
+
+
+def identity(path, by_folder=False):
+    if by_folder:
+        return os.path.basename(os.path.dirname(path))
+    return os.path.splitext(os.path.basename(path))[0].split('_')[0]
+
+
+def variants(img):
+    """The probe as captured, motion-blurred and as a small, distant face"""
+    height, width = img.shape[:2]
+    sigma = max(width, height) / 80
+    yield 'original', img
+    yield 'blurred', cv2.GaussianBlur(img, (0, 0), sigma)
+    small = cv2.resize(img, (max(1, width // 4), max(1, height // 4)), interpolation=cv2.INTER_AREA)
+    yield 'small', small
+
+
+def enroll(images, policy, synthetic, seed, by_folder=False):
+    """Gallery with one student per identity (first image) plus synthetic students; returns encode ms per face"""
+    students, durations, enrolled = [], [], set()
+    for path, img in images:
+        student_id = identity(path, by_folder)
+        if student_id in enrolled:
+            continue
+        timings = {}
+        locations = face_pipeline.detect_faces(img, ENROLLMENT_DETECTION, timings)
+        start = time.perf_counter()
+        encodings = face_pipeline.encode_faces(img, locations[:1], encoding=policy)
+        durations.append((time.perf_counter() - start) * 1000)
+        if not encodings or encodings[0] is None:
+            print(f"no usable face in {path}, {student_id} not enrolled", file=sys.stderr)
+            continue
+        enrolled.add(student_id)
+        students.append({'_id': student_id, 'student_id': student_id, 'name': student_id,
+                         'face_encoding': encoding_format.encode(encodings[0])})
+
+    rng = np.random.default_rng(seed)
+    centre = np.mean([encoding_format.decode(s['face_encoding']) for s in students], axis=0) if students else 0
+    for i in range(synthetic):
+        students.append({'_id': f'synthetic-{i}', 'student_id': f'synthetic-{i}', 'name': 'synthetic',
+                         'face_encoding': encoding_format.encode(centre + rng.normal(0, 0.06, size=128))})
+    gallery = FaceGallery(dtype='float32')
+    gallery.load(students)
+    return gallery, enrolled, durations
+
+
+def probe(gallery, enrolled, images, policy, repeat, tolerance, min_confidence, by_folder=False):
+    """Attendance-frame results of one policy, per probe variant"""
+    results = {}
+    for path, img in images:
+        student_id = identity(path, by_folder)
+        if student_id not in enrolled:
+            continue
+        for variant, frame in variants(img):
+            row = results.setdefault(variant, {'images': 0, 'recognized': 0, 'faces': 0, 'encoded': 0,
+                                               'rejected': {}, 'wrong': 0, 'encode_ms': [], 'quality_ms': []})
+            locations = face_pipeline.detect_faces(frame, ATTENDANCE_DETECTION)
+            for _ in range(max(1, repeat)):
+                timings = {}
+                kept, _ = face_pipeline.quality_gate(frame, locations, policy, timings)
+                start = time.perf_counter()
+                encodings = face_pipeline.encode_faces(frame, kept, encoding=dict(policy, min_face_size=0,
+                                                                                   min_sharpness=0, max_yaw=None))
+                if locations:
+                    row['quality_ms'].append(timings['quality'] * 1000 / len(locations))
+                if kept:
+                    row['encode_ms'].append((time.perf_counter() - start) * 1000 / len(kept))
+            row['images'] += 1
+            row['faces'] += len(locations)
+            row['encoded'] += len(kept)
+            for reason, count in timings.get('rejected', {}).items():
+                row['rejected'][reason] = row['rejected'].get(reason, 0) + count
+            matches = gallery.match(encodings, tolerance=tolerance, min_confidence=min_confidence) if encodings else []
+            found = [student['student_id'] for student, _ in matches if student]
+            row['recognized'] += student_id in found
+            row['wrong'] += sum(1 for found_id in found if found_id != student_id)
+
+    for row in results.values():
+        row['recall'] = round(row['recognized'] / row['images'], 3) if row['images'] else None
+        row['encode_ms'] = round(statistics.mean(row['encode_ms']), 2) if row['encode_ms'] else None
+        row['quality_ms'] = round(statistics.mean(row['quality_ms']), 2) if row['quality_ms'] else None
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', default=os.path.join(APP_DIR, 'static', 'uploads', '*.jpg'),
+                        help='glob of face images named <student_id>_*.jpg')
+    parser.add_argument('--by-folder', action='store_true', help='take the student id from the folder name')
+    parser.add_argument('--synthetic', type=int, default=1000, help='synthetic students added to the gallery')
+    parser.add_argument('--repeat', type=int, default=3, help='timed encodings per probe')
+    parser.add_argument('--tolerance', type=float, default=0.5)
+    parser.add_argument('--min-confidence', type=float, default=65)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    images = []
+    for path in sorted(glob.glob(args.images)):
+        with open(path, 'rb') as f:
+            images.append((path, face_pipeline.decode_image(f.read())))
+    if not images:
+        parser.error(f"no images match {args.images}")
+    face_pipeline.preload_models()
+
+    results = []
+    for enrollment, enrollment_policy in ENROLLMENT_POLICIES.items():
+        gallery, enrolled, enroll_ms = enroll(images, enrollment_policy, args.synthetic, args.seed, args.by_folder)
+        for attendance, policy in ATTENDANCE_POLICIES.items():
+            rows = probe(gallery, enrolled, images, policy, args.repeat, args.tolerance, args.min_confidence,
+                         args.by_folder)
+            for variant, row in rows.items():
+                results.append(dict(row, enrollment=enrollment, attendance=attendance, variant=variant,
+                                    enroll_ms=round(statistics.mean(enroll_ms), 2) if enroll_ms else None))
+
+    if args.json:
+        print(json.dumps({'images': len(images), 'policies': {'attendance': ATTENDANCE_POLICIES,
+                                                              'enrollment': ENROLLMENT_POLICIES},
+                          'results': results}, indent=2))
+        return
+
+    print(f"{len(images)} images, {args.synthetic} synthetic students, {args.repeat} timed encodings per probe")
+    print(f"{'enrollment':<18}{'attendance':<18}{'probe':<10}{'enroll ms':>10}{'encode ms':>10}{'check ms':>9}"
+          f"{'faces':>7}{'skipped':>9}{'recall':>8}{'wrong':>7}")
+    for r in results:
+        skipped = sum(r['rejected'].values())
+        print(f"{r['enrollment']:<18}{r['attendance']:<18}{r['variant']:<10}{r['enroll_ms'] or 0:>10.1f}"
+              f"{r['encode_ms'] or 0:>10.1f}{r['quality_ms'] or 0:>9.2f}{r['faces']:>7}{skipped:>9}"
+              f"{r['recall'] or 0:>8.2f}{r['wrong']:>7}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""Matching accuracy of compact encoding dtypes against the float64 baseline.
+
+Enrolls one student per sample image (encoded with jitter, like
+registration), probes the gallery with a fresh un-jittered encoding of the
+same image (like an attendance frame) and compares, for each storage dtype,
+the matched student and distance with the float64 baseline. Synthetic
+students are added so the nearest-neighbour decision is not trivial.
+
+    python benchmarks/encoding_precision.py
+    python benchmarks/encoding_precision.py --images path/to/faces/*.jpg --synthetic 5000 --json
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+
+import numpy as np
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import encoding_format  # noqa: E402
+from gallery import FaceGallery  # noqa: E402
+
+DTYPES = ['float64', 'float32', 'float16']
+
+
+def sample_encodings(pattern):
+    """``(enrolled, probes)`` encodings of the first face in each image"""
+    import face_recognition
+    import face_pipeline
+
+    enrolled, probes = [], []
+    for path in sorted(glob.glob(pattern)):
+        with open(path, 'rb') as f:
+            img = face_pipeline.decode_image(f.read())
+        locations, encodings, _ = face_pipeline.detect_and_encode(img, encoding={'num_jitters': 2})
+        if not encodings:
+            print(f"no face in {path}, skipped", file=sys.stderr)
+            continue
+        enrolled.append(encodings[0])
+        probes.append(face_recognition.face_encodings(img, locations[:1], num_jitters=0)[0])
+    return np.array(enrolled).reshape(-1, 128), np.array(probes).reshape(-1, 128)
+
+
+def synthetic_encodings(students, probes, seed):
+    """Random students around a common centre plus noisy probes of some of them"""
+    rng = np.random.default_rng(seed)
+    centre = rng.normal(0, 0.1, size=128)
+    enrolled = centre + rng.normal(0, 0.06, size=(students, 128))
+    chosen = rng.integers(0, students, size=probes)
+    return enrolled, enrolled[chosen] + rng.normal(0, 0.02, size=(probes, 128))
+
+
+def match(enrolled, probes, dtype, tolerance, min_confidence):
+    students = [
+        {'_id': i, 'student_id': str(i), 'name': str(i),
+         'face_encoding': encoding_format.encode(encoding, dtype=dtype)}
+        for i, encoding in enumerate(enrolled)
+    ]
+    # float16 is a storage format only; the gallery matrix is float32 at least
+    gallery = FaceGallery(dtype=np.float32 if dtype == 'float16' else dtype)
+    gallery.load(students)
+    results = gallery.match(probes, tolerance=tolerance, min_confidence=min_confidence)
+    return results, len(students[0]['face_encoding']), gallery._state.matrix.nbytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', default=os.path.join(APP_DIR, 'static', 'uploads', '*.jpg'),
+                        help='glob of face images (one student per image); empty string to skip')
+    parser.add_argument('--synthetic', type=int, default=2000, help='synthetic students added to the gallery')
+    parser.add_argument('--synthetic-probes', type=int, default=500)
+    parser.add_argument('--tolerance', type=float, default=0.5)
+    parser.add_argument('--min-confidence', type=float, default=65)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    enrolled, probes = np.empty((0, 128)), np.empty((0, 128))
+    if args.images:
+        enrolled, probes = sample_encodings(args.images)
+    image_probes = len(probes)
+    if args.synthetic:
+        extra, extra_probes = synthetic_encodings(args.synthetic, args.synthetic_probes, args.seed)
+        enrolled = np.vstack([enrolled, extra])
+        probes = np.vstack([probes, extra_probes])
+    if not len(probes):
+        parser.error('no sample faces found and --synthetic is 0')
+
+    baseline, _, _ = match(enrolled, probes, 'float64', args.tolerance, args.min_confidence)
+    results = []
+    for dtype in DTYPES:
+        found, stored_bytes, matrix_bytes = match(enrolled, probes, dtype, args.tolerance, args.min_confidence)
+        same = sum(
+            (a[0] and a[0]['student_id']) == (b[0] and b[0]['student_id'])
+            for a, b in zip(baseline, found)
+        )
+        confidence_error = max(abs(a[1] - b[1]) for a, b in zip(baseline, found))
+        results.append({
+            'dtype': dtype,
+            'bytes_per_encoding': stored_bytes,
+            'gallery_bytes': matrix_bytes,
+            'agreement': same / len(probes),
+            'max_confidence_error': confidence_error,
+        })
+
+    if args.json:
+        print(json.dumps({'students': len(enrolled), 'image_probes': image_probes,
+                          'probes': len(probes), 'results': results}, indent=2))
+        return
+
+    print(f"{len(enrolled)} students, {len(probes)} probes ({image_probes} from sample images)")
+    print(f"{'dtype':<10}{'bytes':>8}{'gallery KB':>12}{'agreement':>11}{'max conf err':>14}")
+    for r in results:
+        print(f"{r['dtype']:<10}{r['bytes_per_encoding']:>8}{r['gallery_bytes'] / 1024:>12.1f}"
+              f"{r['agreement']:>11.4f}{r['max_confidence_error']:>14.4f}")
+
+
+if __name__ == '__main__':
+    main()
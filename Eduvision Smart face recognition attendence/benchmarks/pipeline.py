@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""Per-stage latency of the attendance and registration pipelines.
+
+Runs the same steps as ``take_attendance`` (decode, detection, encoding,
+gallery matching, attendance write) and ``register_student`` (decode,
+enrollment detection, jittered encoding, template selection, student write,
+gallery update) offline, and reports p50/p95/p99 latency and throughput for
+each stage:
+
+- decode, detection and encoding use the images in ``static/uploads``
+  (skipped when face_recognition is not installed or there are no images);
+- matching uses synthetic 128-d galleries of each ``--gallery-sizes`` and
+  frames with each ``--faces-per-frame``;
+- database writes go to mongomock (see requirements-dev.txt) unless
+  ``--mongo-uri`` points at a MongoDB server, where a throwaway database is
+  created and dropped.
+
+    python benchmarks/pipeline.py
+    python benchmarks/pipeline.py --gallery-sizes 1000 10000 100000 200000 --faces-per-frame 1 10 30 --json > bench.json
+"""
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import attendance_records  # noqa: E402
+import attendance_rollups  # noqa: E402
+import encoding_format  # noqa: E402
+import face_settings  # noqa: E402
+from gallery import FaceGallery, select_templates  # noqa: E402
+from gallery_index import make_index  # noqa: E402
+
+CLASSES = 40
+
+
+def summarize(durations, items=1):
+    """Latency percentiles (ms) and throughput (calls/s, items/s) of a list of durations in seconds"""
+    ms = np.asarray(durations) * 1000
+    total = float(np.sum(durations))
+    return {
+        'calls': len(ms),
+        'p50_ms': round(float(np.percentile(ms, 50)), 3),
+        'p95_ms': round(float(np.percentile(ms, 95)), 3),
+        'p99_ms': round(float(np.percentile(ms, 99)), 3),
+        'mean_ms': round(float(ms.mean()), 3),
+        'calls_per_s': round(len(ms) / total, 1) if total else None,
+        'items_per_s': round(len(ms) * items / total, 1) if total else None,
+    }
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def open_database(uri):
+    """``(db, cleanup, description)`` for a MongoDB server or an in-process mongomock stand-in"""
+    if uri:
+        from pymongo import MongoClient
+        client = MongoClient(uri)
+        name = f"eduvision_bench_{os.getpid()}"
+        return client[name], lambda: client.drop_database(name), 'mongodb'
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit('mongomock is not installed: pip install -r requirements-dev.txt, '
+                 'or pass --mongo-uri mongodb://localhost:27017/')
+    return mongomock.MongoClient()['eduvision_bench'], lambda: None, 'mongomock'
+
+
+def synthetic_students(count, rng, dtype):
+    """Student documents with random encodings spread around a common centre, in CLASSES classes"""
+    centre = rng.normal(0, 0.1, size=128)
+    encodings = centre + rng.normal(0, 0.06, size=(count, 128))
+    students = [
+        {'_id': i, 'student_id': f'B{i:06d}', 'name': f'Student {i}', 'classes': [f'class-{i % CLASSES}'],
+         'face_encoding': encoding_format.encode(encoding, dtype=dtype)}
+        for i, encoding in enumerate(encodings)
+    ]
+    return students, encodings
+
+
+def face_stages(images, frames, jitters, results):
+    """Decode, detection and encoding (with its quality checks) on sample images, for attendance and registration"""
+    import face_pipeline
+
+    samples = []
+    for path in images:
+        with open(path, 'rb') as f:
+            samples.append(f.read())
+
+    attendance_encoding = face_settings.FACE_ENCODING_ATTENDANCE
+    if jitters is not None:
+        attendance_encoding = dict(attendance_encoding, num_jitters=jitters)
+    for scenario, detection, encoding in (
+            ('attendance', face_settings.FACE_DETECTION, attendance_encoding),
+            ('register', face_settings.FACE_DETECTION_ENROLLMENT, face_settings.FACE_ENCODING_ENROLLMENT)):
+        decode, detect, encode, faces, cnn_frames = [], [], [], 0, 0
+        for i in range(frames):
+            img, seconds = timed(face_pipeline.decode_image, samples[i % len(samples)])
+            decode.append(seconds)
+            timings = {}
+            locations, seconds = timed(face_pipeline.detect_faces, img, detection, timings)
+            detect.append(seconds)
+            cnn_frames += 'cnn' in timings
+            if locations:
+                encodings, seconds = timed(face_pipeline.encode_faces, img, locations, encoding=encoding)
+                encode.append(seconds)
+                faces += sum(1 for face in encodings if face is not None)
+        results.append(dict(summarize(decode), scenario=scenario, stage='decode'))
+        results.append(dict(summarize(detect), scenario=scenario, stage='detection',
+                            cnn_fallback_rate=round(cnn_frames / frames, 3)))
+        if encode:
+            results.append(dict(summarize(encode, items=faces / len(encode)), scenario=scenario, stage='encoding',
+                                faces_per_frame=round(faces / len(encode), 2), num_jitters=encoding['num_jitters']))
+
+
+def match_stages(sizes, faces_per_frame, frames, index_names, dtype, rng, results):
+    """Gallery matching for every gallery size, index backend and number of faces per frame"""
+    for size in sizes:
+        students, encodings = synthetic_students(size, rng, dtype)
+        for index_name in index_names:
+            gallery = FaceGallery(dtype=dtype, index=make_index(index_name))
+            _, load_seconds = timed(gallery.load, students)
+            for faces in faces_per_frame:
+                durations = []
+                for _ in range(frames):
+                    chosen = rng.integers(0, size, size=faces)
+                    probes = encodings[chosen] + rng.normal(0, 0.02, size=(faces, 128))
+                    class_name = students[chosen[0]]['classes'][0]
+                    _, seconds = timed(gallery.match, probes, tolerance=0.5, min_confidence=65, class_name=class_name)
+                    durations.append(seconds)
+                results.append(dict(summarize(durations, items=faces), scenario='attendance', stage='matching',
+                                    gallery_size=size, faces_per_frame=faces, index=index_name,
+                                    gallery_load_s=round(load_seconds, 3)))
+
+            # Registering one more student updates the gallery incrementally
+            durations = []
+            for i in range(min(frames, 50)):
+                student = dict(students[i], _id=f'new-{i}', student_id=f'N{i:06d}')
+                _, seconds = timed(gallery.upsert, student)
+                durations.append(seconds)
+            results.append(dict(summarize(durations), scenario='register', stage='gallery_update',
+                                gallery_size=size, index=index_name))
+
+
+def write_stages(db, faces_per_frame, frames, dtype, rng, results):
+    """Attendance bulk upserts (with rollups) and student writes against the database"""
+    attendance_records.ensure_indexes(db)
+    attendance_rollups.ensure_indexes(db)
+    now = datetime.datetime.now()
+    for faces in faces_per_frame:
+        durations = []
+        for i in range(frames):
+            # A new class every frame, so every student is a new record (the worst case)
+            confidences = {f'B{j:06d}': 90.0 for j in rng.choice(100000, size=faces, replace=False)}
+            start = time.perf_counter()
+            records = attendance_records.record(db, f'bench-{faces}-{i}', confidences, now)
+            attendance_rollups.record(db, records)
+            durations.append(time.perf_counter() - start)
+        results.append(dict(summarize(durations, items=faces), scenario='attendance', stage='db_write',
+                            faces_per_frame=faces))
+
+    templates, writes = [], []
+    for i in range(frames):
+        encodings = rng.normal(0, 0.1, size=(8, 128))
+        chosen, seconds = timed(select_templates, list(encodings), max_templates=5, mode='diverse')
+        templates.append(seconds)
+        document = {
+            'student_id': f'R{i:06d}',
+            'name': f'Registered {i}',
+            'classes': ['class-0'],
+            'face_templates': [encoding_format.encode(t, dtype=dtype) for t in chosen],
+            'face_encoding': encoding_format.encode(np.mean(chosen, axis=0), dtype=dtype),
+            'registration_date': now,
+            'updated_at': now,
+        }
+        _, seconds = timed(db.students.insert_one, document)
+        writes.append(seconds)
+    results.append(dict(summarize(templates), scenario='register', stage='templates'))
+    results.append(dict(summarize(writes), scenario='register', stage='db_write'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', default=os.path.join(APP_DIR, 'static', 'uploads', '*.jpg'),
+                        help='glob of sample face images; empty string to skip decode/detection/encoding')
+    parser.add_argument('--gallery-sizes', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--faces-per-frame', type=int, nargs='+', default=[1, 5, 20])
+    parser.add_argument('--frames', type=int, default=100, help='calls timed per stage and setting')
+    parser.add_argument('--index', nargs='+', default=['exact'], choices=['exact', 'ivf'])
+    parser.add_argument('--dtype', default='float32', help='gallery and storage dtype')
+    parser.add_argument('--jitters', type=int, default=None,
+                        help='num_jitters of attendance encoding (default: the app default)')
+    parser.add_argument('--mongo-uri', default=None, help='MongoDB server to write to (default: mongomock)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    results, skipped = [], []
+    images = sorted(glob.glob(args.images)) if args.images else []
+    if not images:
+        skipped.append('decode/detection/encoding: no sample images')
+    else:
+        try:
+            face_stages(images, args.frames, args.jitters, results)
+        except ImportError as e:
+            skipped.append(f"decode/detection/encoding: {str(e)}")
+
+    match_stages(args.gallery_sizes, args.faces_per_frame, args.frames, args.index, args.dtype, rng, results)
+
+    db, cleanup, backend = open_database(args.mongo_uri)
+    try:
+        write_stages(db, args.faces_per_frame, args.frames, args.dtype, rng, results)
+    finally:
+        cleanup()
+
+    report = {
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'database': backend,
+        },
+        'settings': vars(args),
+        'skipped': skipped,
+        'results': results,
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"database: {backend}; {len(images)} sample images; {args.frames} calls per stage")
+    for reason in skipped:
+        print(f"skipped {reason}")
+    print(f"{'scenario':<11}{'stage':<15}{'setting':<44}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'items/s':>11}")
+    for r in results:
+        setting = ' '.join(f"{key}={r[key]}" for key in ('gallery_size', 'faces_per_frame', 'index') if key in r)
+        print(f"{r['scenario']:<11}{r['stage']:<15}{setting:<44}{r['p50_ms']:>9.2f}{r['p95_ms']:>9.2f}"
+              f"{r['p99_ms']:>9.2f}{r['items_per_s'] or 0:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+"""Bulk student enrollment from a folder or ZIP archive.
+
+Expected layout (a single top-level folder inside the ZIP is fine too)::
+
+    students.csv            student_id,name[,classes]   (classes separated by ';')
+    1001/front.jpg
+    1001/left.jpg
+    1002/photo.png
+    ...
+
+Images are encoded in parallel on the face worker pool and students are
+written with bulk upserts every ``batch_size`` students. Students that
+already exist are skipped unless ``replace_existing`` is set, so re-running
+after an interruption resumes where the previous run stopped.
+"""
+import csv
+import datetime
+import io
+import logging
+import os
+import time
+import zipfile
+from collections import deque
+
+import numpy as np
+from pymongo import UpdateOne
+
+import encoding_format
+import face_pipeline
+from face_pipeline import PoolSaturated
+from gallery import select_templates
+
+logger = logging.getLogger('eduvision.bulk_enroll')
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.webp'}
+NAMES_FILE = 'students.csv'
+
+
+class EnrollmentSource:
+    """Student images and names read from a directory or a ZIP archive"""
+
+    def __init__(self, path, names_path=None):
+        self.path = path
+        self._zip = None if os.path.isdir(path) else zipfile.ZipFile(path)
+        self.images = {}
+        csv_files = []
+        for name in self._list():
+            parts = [part for part in name.split('/') if part]
+            if not parts or any(part.startswith(('.', '__MACOSX')) for part in parts):
+                continue
+            extension = os.path.splitext(parts[-1])[1].lower()
+            if extension == '.csv':
+                csv_files.append(name)
+            elif extension in IMAGE_EXTENSIONS and len(parts) >= 2:
+                # The folder holding an image is the student id
+                self.images.setdefault(parts[-2], []).append(name)
+        for images in self.images.values():
+            images.sort()
+
+        if names_path:
+            with open(names_path, newline='', encoding='utf-8-sig') as f:
+                self.names = parse_names(f)
+        else:
+            candidates = sorted(csv_files, key=lambda n: (os.path.basename(n) != NAMES_FILE, n.count('/')))
+            self.names = parse_names(io.StringIO(self.read(candidates[0]).decode('utf-8-sig'))) if candidates else {}
+
+    def _list(self):
+        if self._zip is not None:
+            return [info.filename for info in self._zip.infolist() if not info.is_dir()]
+        names = []
+        for root, _, files in os.walk(self.path):
+            for filename in files:
+                names.append(os.path.relpath(os.path.join(root, filename), self.path).replace(os.sep, '/'))
+        return names
+
+    def read(self, name):
+        if self._zip is not None:
+            return self._zip.read(name)
+        with open(os.path.join(self.path, name), 'rb') as f:
+            return f.read()
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def parse_names(f):
+    """Read ``student_id,name[,classes]`` rows into ``{student_id: {'name', 'classes'}}``"""
+    students = {}
+    for row in csv.DictReader(f):
+        row = {(key or '').strip().lower(): (value or '').strip() for key, value in row.items()}
+        if not row.get('student_id'):
+            continue
+        classes = row.get('classes')
+        students[row['student_id']] = {
+            'name': row.get('name'),
+            # An empty cell leaves an existing student's classes alone
+            'classes': [c.strip() for c in classes.split(';') if c.strip()] if classes else None
+        }
+    return students
+
+
+class BulkEnrollment:
+    """Encodes every student of an :class:`EnrollmentSource` and upserts them in batches.
+
+    ``report`` collects counts and per-image failures as
+    ``(student_id, image, reason)``; ``progress(report)`` is called after
+    every batch write.
+    """
+
+    def __init__(self, collection, pool, encoding=None, detection=None, max_templates=5, template_mode='diverse',
+                 dtype='float32', batch_size=50, replace_existing=False, max_inflight=None, progress=None):
+        self.collection = collection
+        self.pool = pool
+        self.encoding = encoding
+        self.detection = detection
+        self.max_templates = max_templates
+        self.template_mode = template_mode
+        self.dtype = dtype
+        self.batch_size = batch_size
+        self.replace_existing = replace_existing
+        # Leave pool slots free for attendance requests sharing the same workers
+        self.max_inflight = max_inflight or max(1, pool.max_pending // 2)
+        self.progress = progress
+        self.report = {
+            'students_total': 0,
+            'enrolled': 0,
+            'skipped_existing': 0,
+            'failed_students': 0,
+            'images_processed': 0,
+            'image_failures': [],
+        }
+        self._encodings = {}
+        self._remaining = {}
+        self._writes = []
+
+    def run(self, source):
+        report = self.report
+        report['students_total'] = len(source.images)
+        student_ids = sorted(source.images)
+        if not self.replace_existing:
+            existing = set(self.collection.distinct('student_id', {'student_id': {'$in': student_ids}}))
+            report['skipped_existing'] = len(existing)
+            student_ids = [sid for sid in student_ids if sid not in existing]
+
+        inflight = deque()
+        for student_id in student_ids:
+            info = source.names.get(student_id)
+            if not info or not info.get('name'):
+                self._fail_student(student_id, None, 'no name in the names CSV')
+                continue
+            self._encodings[student_id] = []
+            self._remaining[student_id] = len(source.images[student_id])
+            for image in source.images[student_id]:
+                try:
+                    data = source.read(image)
+                except Exception as e:
+                    self._image_done(student_id, image, None, f"unreadable: {str(e)}", source)
+                    continue
+                while len(inflight) >= self.max_inflight:
+                    self._collect(inflight.popleft(), source)
+                future = self._submit(data, inflight, source)
+                inflight.append((student_id, image, future))
+        while inflight:
+            self._collect(inflight.popleft(), source)
+        self._flush()
+        return report
+
+    def _submit(self, data, inflight, source):
+        while True:
+            try:
+                return self.pool.submit(face_pipeline.encode_image, data, encoding=self.encoding,
+                                        detection=self.detection)
+            except PoolSaturated:
+                # Other work holds the slots; finish one of ours or wait briefly
+                if inflight:
+                    self._collect(inflight.popleft(), source)
+                else:
+                    time.sleep(0.2)
+
+    def _collect(self, job, source):
+        student_id, image, future = job
+        try:
+            _, encodings, timings = self.pool.result(future)
+        except Exception as e:
+            self._image_done(student_id, image, None, str(e) or type(e).__name__, source)
+            return
+        error = None
+        if not encodings and timings.get('rejected'):
+            error = 'no usable face (' + ', '.join(sorted(timings['rejected'])) + ')'
+        elif not encodings:
+            error = 'no face detected'
+        self._image_done(student_id, image, encodings, error, source)
+
+    def _image_done(self, student_id, image, encodings, error, source):
+        self.report['images_processed'] += 1
+        if error:
+            self.report['image_failures'].append((student_id, image, error))
+        else:
+            self._encodings[student_id].extend(encodings)
+        self._remaining[student_id] -= 1
+        if self._remaining[student_id] == 0:
+            self._finish_student(student_id, source.names[student_id])
+
+    def _fail_student(self, student_id, image, reason):
+        self.report['failed_students'] += 1
+        self.report['image_failures'].append((student_id, image, reason))
+
+    def _finish_student(self, student_id, info):
+        encodings = self._encodings.pop(student_id)
+        del self._remaining[student_id]
+        if not encodings:
+            self._fail_student(student_id, None, 'no usable face in any image')
+            return
+
+        templates = select_templates(encodings, max_templates=self.max_templates, mode=self.template_mode)
+        now = datetime.datetime.now()
+        fields = {
+            'name': info['name'],
+            'face_templates': [encoding_format.encode(template, dtype=self.dtype) for template in templates],
+            'face_encoding': encoding_format.encode(np.mean(templates, axis=0), dtype=self.dtype),
+            'image_count': len(encodings),
+            'updated_at': now
+        }
+        on_insert = {'registration_date': now}
+        # Only overwrite class enrollment when the CSV has a classes column
+        if info.get('classes') is not None:
+            fields['classes'] = info['classes']
+        else:
+            on_insert['classes'] = []
+        self._writes.append(UpdateOne({'student_id': student_id}, {'$set': fields, '$setOnInsert': on_insert},
+                                      upsert=True))
+        if len(self._writes) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if self._writes:
+            self.collection.bulk_write(self._writes, ordered=False)
+            self.report['enrolled'] += len(self._writes)
+            logger.info(f"Bulk enrollment: {self.report['enrolled']} students written")
+            self._writes = []
+        if self.progress is not None:
+            self.progress(self.report)
+
+
+def write_failures(failures, f):
+    """Write ``(student_id, image, reason)`` rows as CSV"""
+    writer = csv.writer(f)
+    writer.writerow(['student_id', 'image', 'reason'])
+    for student_id, image, reason in failures:
+        writer.writerow([student_id, image or '', reason])
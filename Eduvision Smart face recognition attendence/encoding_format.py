@@ -0,0 +1,124 @@
+"""Versioned storage format for face encodings.
+
+Stored encodings start with an 8-byte header followed by the little-endian
+vector::
+
+    b'EV' | version (u8) | dtype code (u8) | dimension (u16) | model id (u8) | reserved (u8)
+
+float32 halves the size of the original raw float64 bytes (and of the
+in-memory gallery), float16 quarters it. Legacy encodings, written before the
+header existed, are bare float64 bytes and are still decoded.
+"""
+import logging
+import struct
+
+import numpy as np
+from pymongo import UpdateOne
+
+logger = logging.getLogger('eduvision.encoding_format')
+
+MAGIC = b'EV'
+VERSION = 1
+HEADER = struct.Struct('<2sBBHBx')
+
+DTYPES = {1: np.dtype('<f8'), 2: np.dtype('<f4'), 3: np.dtype('<f2')}
+DTYPE_CODES = {dtype: code for code, dtype in DTYPES.items()}
+
+# dlib's ResNet model used by face_recognition; new models must get a new id
+MODELS = {1: 'dlib_face_recognition_resnet_model_v1'}
+DEFAULT_MODEL = 1
+
+LEGACY = 'legacy'
+
+
+def encode(encoding, dtype='float32', model=DEFAULT_MODEL):
+    """Serialize a 1-d encoding with a header"""
+    dtype = np.dtype(dtype).newbyteorder('<')
+    if dtype not in DTYPE_CODES:
+        raise ValueError(f"unsupported encoding dtype {dtype}")
+    vector = np.asarray(encoding).reshape(-1).astype(dtype)
+    return HEADER.pack(MAGIC, VERSION, DTYPE_CODES[dtype], vector.size, model) + vector.tobytes()
+
+
+def describe(raw):
+    """Return ``{'version', 'dtype', 'dim', 'model'}`` for stored bytes.
+
+    ``version`` is ``'legacy'`` for raw float64 bytes; ``model`` is a key of ``MODELS``.
+    """
+    raw = bytes(raw)
+    if len(raw) >= HEADER.size:
+        magic, version, code, dim, model = HEADER.unpack_from(raw)
+        if magic == MAGIC and code in DTYPES and len(raw) == HEADER.size + dim * DTYPES[code].itemsize:
+            if version != VERSION:
+                raise ValueError(f"unsupported encoding format version {version}")
+            return {'version': version, 'dtype': DTYPES[code], 'dim': dim, 'model': model}
+    if len(raw) % 8:
+        raise ValueError(f"unrecognized encoding of {len(raw)} bytes")
+    return {'version': LEGACY, 'dtype': DTYPES[1], 'dim': len(raw) // 8, 'model': DEFAULT_MODEL}
+
+
+def decode(raw):
+    """Return the stored encoding as a read-only 1-d array of its stored dtype"""
+    info = describe(raw)
+    offset = 0 if info['version'] == LEGACY else HEADER.size
+    return np.frombuffer(raw, dtype=info['dtype'], offset=offset)
+
+
+def is_current(raw, dtype):
+    """True when ``raw`` already uses the current format version and ``dtype``"""
+    info = describe(raw)
+    return info['version'] == VERSION and info['dtype'] == np.dtype(dtype).newbyteorder('<')
+
+
+def _convert(raw, dtype):
+    return raw if is_current(raw, dtype) else encode(decode(raw), dtype=dtype, model=describe(raw)['model'])
+
+
+def migrate(collection, dtype='float32', batch_size=500, dry_run=False):
+    """Rewrite every stored encoding (and template) not in the current format and ``dtype``.
+
+    Documents are scanned in ``_id`` order and updated with one bulk write per
+    batch. Each update only applies if the encoding is unchanged since it was
+    read, so a student re-registered mid-migration keeps the new encoding.
+    The migration can be interrupted and re-run. Returns counts of
+    ``scanned``, ``converted``, ``skipped`` (already current, or changed while
+    migrating) and ``failed``.
+    """
+    counts = {'scanned': 0, 'converted': 0, 'skipped': 0, 'failed': 0}
+    last_id = None
+    while True:
+        query = {'face_encoding': {'$exists': True}}
+        if last_id is not None:
+            query['_id'] = {'$gt': last_id}
+        batch = list(collection.find(query, {'face_encoding': 1, 'face_templates': 1, 'student_id': 1})
+                     .sort('_id', 1).limit(batch_size))
+        if not batch:
+            break
+        last_id = batch[-1]['_id']
+
+        updates = []
+        for doc in batch:
+            counts['scanned'] += 1
+            fields = {key: doc[key] for key in ('face_encoding', 'face_templates') if key in doc}
+            try:
+                converted = {
+                    key: [_convert(raw, dtype) for raw in value] if key == 'face_templates' else _convert(value, dtype)
+                    for key, value in fields.items()
+                }
+            except Exception as e:
+                logger.error(f"Cannot convert encoding of student {doc.get('student_id', doc['_id'])}: {str(e)}")
+                counts['failed'] += 1
+                continue
+            if converted == fields:
+                counts['skipped'] += 1
+                continue
+            updates.append(UpdateOne(dict(fields, _id=doc['_id']), {'$set': converted}))
+
+        if updates and not dry_run:
+            result = collection.bulk_write(updates, ordered=False)
+            counts['converted'] += result.modified_count
+            counts['skipped'] += len(updates) - result.modified_count
+        else:
+            counts['converted'] += len(updates)
+        logger.info(f"Encoding migration progress: {counts}")
+    return counts
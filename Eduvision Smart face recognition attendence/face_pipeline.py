@@ -0,0 +1,468 @@
+"""Face detection/encoding and the process pool that runs it off the request threads.
+
+dlib detection and encoding are CPU bound and hold the GIL, so running them in
+Flask request threads serializes concurrent classrooms. ``FaceWorkerPool``
+runs them in worker processes with a bounded number of in-flight jobs and a
+per-job timeout.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+import cv2
+import face_recognition
+import numpy as np
+
+logger = logging.getLogger('eduvision.face_pipeline')
+
+
+class PoolSaturated(Exception):
+    """Raised when every job slot is taken; callers should answer 503 and retry later"""
+
+
+class FaceJobTimeout(Exception):
+    """Raised when a job does not finish within the configured timeout"""
+
+
+class InvalidImage(ValueError):
+    """Raised when uploaded bytes cannot be decoded as an image"""
+
+
+def decode_image(data):
+    """Decode uploaded image bytes (JPEG/PNG/...) straight into an RGB array, without touching disk"""
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise InvalidImage("Unsupported or corrupt image")
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+# Detection settings; callers override per route (see FACE_DETECTION in app.py)
+DEFAULT_DETECTION = {
+    'max_width': 640,             # HOG runs on a copy no wider than this (0 = full resolution)
+    'upsample': 1,                # dlib upsampling passes; finds smaller faces, costs ~4x per pass
+    'cnn_fallback': 'precheck',   # when HOG finds nothing: 'always', 'precheck' (OpenCV cascade first) or 'never'
+    'cnn_max_width': 480,         # the CNN detector runs on an even smaller copy
+    'cnn_budget': 3.0,            # seconds; skip the CNN when its estimated cost would exceed this (0 = no limit)
+}
+
+# Encoding settings; callers override per route (see FACE_ENCODING_* in app.py). Faces failing a quality
+# check are not encoded at all: a poor encoding costs as much as a good one and rarely matches
+DEFAULT_ENCODING = {
+    'num_jitters': 1,             # dlib encodes this many perturbed copies and averages them; cost grows linearly (0/1 = once)
+    'min_face_size': 0,           # pixels; faces whose box is narrower or shorter are skipped
+    'min_sharpness': 0,           # variance of the Laplacian of the face scaled to QUALITY_SIZE; blurrier faces are skipped
+    'max_yaw': None,              # nose offset from the eye midpoint / eye distance (0 = frontal); more turned faces are skipped
+}
+QUALITY_SIZE = 96
+
+# Per-process estimate of CNN detection cost, in seconds per megapixel (updated after each run)
+_cnn_seconds_per_mp = None
+_cascade = None
+
+
+def _scaled(img, max_width):
+    """Return a copy no wider than ``max_width`` and the factor that maps it back to ``img``"""
+    height, width = img.shape[:2]
+    if not max_width or width <= max_width:
+        return img, 1.0
+    scale = max_width / width
+    small = cv2.resize(img, (max_width, max(1, int(round(height * scale)))), interpolation=cv2.INTER_AREA)
+    return small, width / max_width
+
+
+def _to_full_resolution(locations, factor, shape):
+    """Map ``(top, right, bottom, left)`` boxes from a scaled copy back onto the original image"""
+    if factor == 1.0:
+        return list(locations)
+    height, width = shape[:2]
+    return [
+        (max(0, int(top * factor)), min(width, int(right * factor)),
+         min(height, int(bottom * factor)), max(0, int(left * factor)))
+        for top, right, bottom, left in locations
+    ]
+
+
+def _face_candidates(img):
+    """Cheap OpenCV Haar-cascade check used to decide whether the CNN fallback is worth running"""
+    global _cascade
+    if _cascade is None:
+        _cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+    gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    return len(_cascade.detectMultiScale(gray, scaleFactor=1.2, minNeighbors=3, minSize=(24, 24))) > 0
+
+
+def detect_faces(img, options=None, timings=None):
+    """Detect faces on downscaled copies and return boxes in full-resolution coordinates.
+
+    HOG runs first; the CNN detector is only tried when HOG finds nothing and
+    ``cnn_fallback`` allows it. Per-stage durations (seconds) are added to
+    ``timings`` when given.
+    """
+    global _cnn_seconds_per_mp
+    options = dict(DEFAULT_DETECTION, **(options or {}))
+    timings = {} if timings is None else timings
+    started = time.perf_counter()
+
+    small, factor = _scaled(img, options['max_width'])
+    timings['resize'] = time.perf_counter() - started
+
+    stage = time.perf_counter()
+    locations = face_recognition.face_locations(small, number_of_times_to_upsample=options['upsample'], model="hog")
+    timings['hog'] = time.perf_counter() - stage
+    detector = 'hog'
+
+    policy = options['cnn_fallback']
+    if not locations and policy in ('always', 'precheck'):
+        cnn_img, cnn_factor = _scaled(img, options['cnn_max_width'])
+        run_cnn = True
+        if policy == 'precheck':
+            stage = time.perf_counter()
+            run_cnn = _face_candidates(cnn_img)
+            timings['precheck'] = time.perf_counter() - stage
+
+        megapixels = cnn_img.shape[0] * cnn_img.shape[1] / 1e6
+        if run_cnn and _cnn_seconds_per_mp is not None and options['cnn_budget']:
+            elapsed = time.perf_counter() - started
+            if elapsed + _cnn_seconds_per_mp * megapixels > options['cnn_budget']:
+                logger.info(f"Skipping CNN fallback: estimated {_cnn_seconds_per_mp * megapixels:.2f}s exceeds budget")
+                run_cnn = False
+
+        if run_cnn:
+            stage = time.perf_counter()
+            locations = face_recognition.face_locations(cnn_img, number_of_times_to_upsample=options['upsample'], model="cnn")
+            timings['cnn'] = time.perf_counter() - stage
+            _cnn_seconds_per_mp = timings['cnn'] / max(megapixels, 1e-6)
+            factor = cnn_factor
+            detector = 'cnn'
+
+    timings['detector'] = detector if locations else None
+    return _to_full_resolution(locations, factor, img.shape)
+
+
+def timings_ms(timings):
+    """Round stage durations to milliseconds for API responses and logs"""
+    return {stage: round(value * 1000, 1) if isinstance(value, float) else value for stage, value in timings.items()}
+
+
+def sharpness(img, location):
+    """Variance of the Laplacian of a face in an RGB image, measured at QUALITY_SIZE pixels"""
+    top, right, bottom, left = location
+    face = img[max(0, top):bottom, max(0, left):right]
+    if face.size == 0:
+        return 0.0
+    face = cv2.resize(face, (QUALITY_SIZE, QUALITY_SIZE), interpolation=cv2.INTER_AREA)
+    return float(cv2.Laplacian(cv2.cvtColor(face, cv2.COLOR_RGB2GRAY), cv2.CV_64F).var())
+
+
+def yaw(img, location):
+    """How far a face is turned sideways, from the 5-point landmarks the encoder uses anyway.
+
+    The horizontal offset of the nose tip from the midpoint between the eyes,
+    divided by the eye distance: about 0 for a frontal face, growing towards
+    a profile.
+    """
+    landmarks = face_recognition.face_landmarks(img, [location], model='small')
+    if not landmarks:
+        return 0.0
+    left_eye = np.mean(landmarks[0]['left_eye'], axis=0)
+    right_eye = np.mean(landmarks[0]['right_eye'], axis=0)
+    nose = np.asarray(landmarks[0]['nose_tip'][0], dtype=float)
+    eye_distance = np.linalg.norm(right_eye - left_eye)
+    if eye_distance < 1:
+        return float('inf')
+    axis = (right_eye - left_eye) / eye_distance
+    return abs(float(np.dot(nose - (left_eye + right_eye) / 2, axis))) / eye_distance
+
+
+def quality_gate(img, face_locations, options=None, timings=None):
+    """Split faces into those worth encoding and the rest; returns ``(kept, rejected)``.
+
+    ``rejected`` counts skipped faces by reason ('small', 'blurry', 'pose').
+    Checks run cheapest first: box size, sharpness, then pose.
+    """
+    options = dict(DEFAULT_ENCODING, **(options or {}))
+    timings = {} if timings is None else timings
+    started = time.perf_counter()
+    kept, rejected = [], {}
+    for location in face_locations:
+        top, right, bottom, left = location
+        reason = None
+        if min(bottom - top, right - left) < options['min_face_size']:
+            reason = 'small'
+        elif options['min_sharpness'] and sharpness(img, location) < options['min_sharpness']:
+            reason = 'blurry'
+        if reason is None and options['max_yaw'] is not None and yaw(img, location) > options['max_yaw']:
+            reason = 'pose'
+        if reason is None:
+            kept.append(location)
+        else:
+            rejected[reason] = rejected.get(reason, 0) + 1
+    timings['quality'] = timings.get('quality', 0.0) + time.perf_counter() - started
+    if rejected:
+        counts = timings.setdefault('rejected', {})
+        for reason, count in rejected.items():
+            counts[reason] = counts.get(reason, 0) + count
+    return kept, rejected
+
+
+def _encode(img, face_locations, options, timings):
+    """Quality-gate and encode faces; returns ``(kept_locations, encodings)``"""
+    options = dict(DEFAULT_ENCODING, **(options or {}))
+    kept, _ = quality_gate(img, face_locations, options, timings)
+    encodings = []
+    if kept:
+        stage = time.perf_counter()
+        encodings = face_recognition.face_encodings(img, kept, num_jitters=options['num_jitters'])
+        timings['encode'] = timings.get('encode', 0.0) + time.perf_counter() - stage
+    return kept, encodings
+
+
+def detect_and_encode(img, encoding=None, detection=None):
+    """Return ``(face_locations, face_encodings, timings)`` for an RGB image array.
+
+    Detection runs on downscaled copies (see :func:`detect_faces`); encoding
+    uses the full-resolution image so accuracy is unchanged. Only faces that
+    pass the ``encoding`` quality checks are encoded and returned; the
+    skipped ones are counted in ``timings['rejected']``.
+    """
+    timings = {}
+    started = time.perf_counter()
+    face_locations = detect_faces(img, detection, timings)
+    face_encodings = []
+    if face_locations:
+        face_locations, face_encodings = _encode(img, face_locations, encoding, timings)
+    timings['total'] = time.perf_counter() - started
+    return face_locations, face_encodings, timings
+
+
+def encode_faces(img, face_locations, encoding=None):
+    """Encode faces at known ``(top, right, bottom, left)`` locations of an RGB image, skipping detection.
+
+    Returns one entry per location: its encoding, or None when the face
+    failed the quality checks.
+    """
+    if not face_locations:
+        return []
+    face_locations = [tuple(location) for location in face_locations]
+    kept, encodings = _encode(img, face_locations, encoding, {})
+    by_location = dict(zip(kept, encodings))
+    return [by_location.get(location) for location in face_locations]
+
+
+def encode_crops(crops, boxes=None, encoding=None, detection=None):
+    """Encode faces cropped by the client; returns ``(face_encodings, timings)``.
+
+    Each crop (image bytes) holds one face. ``boxes`` gives its
+    ``(top, right, bottom, left)`` location inside each crop, or None to
+    detect it on the crop, which is still far cheaper than on a full frame.
+    Crops without a usable face, or whose face fails the ``encoding`` quality
+    checks, are skipped.
+    """
+    timings = {'decode': 0.0, 'detect': 0.0, 'quality': 0.0, 'encode': 0.0}
+    started = time.perf_counter()
+    face_encodings = []
+    for i, data in enumerate(crops):
+        stage = time.perf_counter()
+        img = decode_image(data)
+        timings['decode'] += time.perf_counter() - stage
+
+        height, width = img.shape[:2]
+        box = boxes[i] if boxes else None
+        if box is not None:
+            top, right, bottom, left = (int(round(v)) for v in box)
+            box = (max(0, top), min(width, right), min(height, bottom), max(0, left))
+            if box[1] - box[3] < 8 or box[2] - box[0] < 8:
+                box = None
+        if box is None:
+            stage = time.perf_counter()
+            locations = detect_faces(img, detection)
+            timings['detect'] += time.perf_counter() - stage
+            if not locations:
+                continue
+            # The crop is centred on one face; ignore any neighbours caught in its margin
+            box = max(locations, key=lambda loc: (loc[1] - loc[3]) * (loc[2] - loc[0]))
+
+        face_encodings.extend(_encode(img, [box], encoding, timings)[1])
+    timings['total'] = time.perf_counter() - started
+    return face_encodings, timings
+
+
+def preload_models():
+    """Run every detector and encoder once on a blank image.
+
+    dlib and OpenCV finish initializing on first use; doing it here keeps that
+    cost off the first request a process serves.
+    """
+    blank = np.zeros((96, 96, 3), dtype=np.uint8)
+    face_recognition.face_locations(blank, model="hog")
+    face_recognition.face_locations(blank, model="cnn")
+    face_recognition.face_encodings(blank, [(8, 88, 88, 8)])
+    _face_candidates(blank)
+
+
+def _init_worker():
+    """Pool initializer: every worker process, including replacements, preloads the models before its first job"""
+    try:
+        preload_models()
+    except Exception as e:
+        # A failing initializer would break the pool; the models then initialize on first use instead
+        logger.error(f"Face model preload failed in worker {os.getpid()}: {str(e)}")
+
+
+def encode_image(data, encoding=None, detection=None):
+    """Decode image bytes and detect/encode its faces; runs in a worker so only the bytes cross processes"""
+    return detect_and_encode(decode_image(data), encoding=encoding, detection=detection)
+
+
+class FaceWorkerPool:
+    """Bounded pool of worker processes for face jobs.
+
+    At most ``max_pending`` jobs may be queued or running at once; further
+    submissions raise :class:`PoolSaturated` immediately instead of queueing
+    without bound. A job that times out keeps its slot until the worker
+    actually finishes it, so the bound stays accurate. ``workers=0`` runs
+    jobs inline in the calling thread (useful for development and Windows).
+    Worker processes preload the face models as they start.
+    """
+
+    def __init__(self, workers=None, max_pending=None, timeout=30, start_method=None):
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.max_pending = max_pending or max(self.workers, 2) * 4
+        self.timeout = timeout
+        self.start_method = start_method
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._pending = 0
+
+    def _context(self):
+        method = self.start_method
+        if method is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        context = multiprocessing.get_context(method)
+        if method == 'forkserver':
+            # Workers only need this module; don't re-run the Flask app in the fork server
+            context.set_forkserver_preload([__name__])
+        return context
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=self._context(),
+                                                     initializer=_init_worker)
+                self._pid = os.getpid()
+                logger.info(f"Started face worker pool with {self.workers} processes")
+            return self._executor
+
+    def _reset(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _release(self, _future=None):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    @property
+    def pending(self):
+        """Number of jobs currently queued or running"""
+        return self._pending
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue ``fn(*args, **kwargs)`` on the pool and return its future"""
+        if not self._slots.acquire(blocking=False):
+            raise PoolSaturated(f"all {self.max_pending} face recognition slots are busy")
+        with self._lock:
+            self._pending += 1
+        try:
+            if self.workers == 0:
+                future = _InlineFuture(fn, *args, **kwargs)
+            else:
+                executor = self._get_executor()
+                try:
+                    future = executor.submit(fn, *args, **kwargs)
+                except BrokenProcessPool:
+                    # A worker died (e.g. out of memory); start a fresh pool
+                    logger.error("Face worker pool broken, restarting")
+                    self._reset(executor)
+                    executor = self._get_executor()
+                    future = executor.submit(fn, *args, **kwargs)
+                # Remember which pool ran the job, so a broken pool is not confused with its replacement
+                future.executor = executor
+        except Exception:
+            self._release()
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def result(self, future, timeout=None):
+        """Wait for a submitted job, enforcing the per-job timeout"""
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            future.cancel()
+            raise FaceJobTimeout(f"face recognition did not finish within {timeout:g}s")
+        except BrokenProcessPool:
+            self._reset(getattr(future, 'executor', None))
+            raise
+
+    def run(self, fn, *args, **kwargs):
+        """Submit a job and wait for its result"""
+        return self.result(self.submit(fn, *args, **kwargs))
+
+    def warm_up(self):
+        """Start the worker processes ahead of the first request.
+
+        The models are preloaded by each process as it starts (see
+        ``_init_worker``). Starting all of them here is best-effort: the
+        executor may run several warm-up jobs on one process and start the
+        rest on demand.
+        """
+        try:
+            if self.workers == 0:
+                preload_models()
+                return
+            executor = self._get_executor()
+            # Not counted against the job slots; the pool is idle at startup
+            futures = [executor.submit(os.getpid) for _ in range(self.workers)]
+            pids = {future.result(timeout=self.timeout) for future in futures}
+            logger.info(f"Face worker pool warmed up ({len(pids)} of {self.workers} processes ran a warm-up job)")
+        except Exception as e:
+            logger.error(f"Face worker pool warm-up failed: {str(e)}")
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+class _InlineFuture:
+    """Already-completed future used when the pool runs jobs inline"""
+
+    def __init__(self, fn, *args, **kwargs):
+        self._result = self._exception = None
+        try:
+            self._result = fn(*args, **kwargs)
+        except Exception as e:
+            self._exception = e
+
+    def add_done_callback(self, callback):
+        callback(self)
+
+    def cancel(self):
+        return False
+
+    def result(self, timeout=None):
+        if self._exception is not None:
+            raise self._exception
+        return self._result
@@ -0,0 +1,21 @@
+"""Default face detection and encoding policies of the app.
+
+app.py copies these into ``app.config`` (``FACE_DETECTION`` and so on), where
+they can be overridden; the benchmarks import them from here so they measure
+what the app runs.
+"""
+
+# Face detection pipeline (see face_pipeline.DEFAULT_DETECTION): HOG on a downscaled copy,
+# CNN fallback only when a cheap OpenCV pre-check sees a face and it fits the time budget
+FACE_DETECTION = {'max_width': 640, 'cnn_fallback': 'precheck', 'cnn_budget': 3.0}
+# Enrollment photos are few and matter more, so always allow the CNN fallback there
+FACE_DETECTION_ENROLLMENT = {'max_width': 1024, 'cnn_fallback': 'always', 'cnn_budget': 0}
+
+# Face encoding per route (see face_pipeline.DEFAULT_ENCODING): dlib jitters, and quality checks that skip
+# faces too small, blurry or turned away before they are encoded. Attendance frames encode each face once;
+# a missed face is simply caught on the next frame
+FACE_ENCODING_ATTENDANCE = {'num_jitters': 1, 'min_face_size': 40, 'min_sharpness': 15, 'max_yaw': 0.5}
+# Live streams see every face on many keyframes, so they can afford to wait for a good one
+FACE_ENCODING_STREAM = {'num_jitters': 1, 'min_face_size': 50, 'min_sharpness': 25, 'max_yaw': 0.35}
+# Enrollment encodings become the stored templates: more jitters, and varied poses are wanted
+FACE_ENCODING_ENROLLMENT = {'num_jitters': 5, 'min_face_size': 60, 'min_sharpness': 10, 'max_yaw': None}
@@ -0,0 +1,272 @@
+"""Live stream attendance: face detection on keyframes, OpenCV tracking in between.
+
+The page posts webcam frames one after another. Every ``keyframe_interval``
+frames (or on the next frame when a tracker loses its face) faces are
+detected on the worker pool and matched to the current tracks by overlap; in
+between, each face is followed by a cheap OpenCV tracker in the request
+thread. A face is encoded once per track, on the keyframe that first detects
+it, and again on later keyframes only while it stays unrecognized (up to
+``max_encode_attempts``). A face that fails the encoding quality checks
+(too small, blurry or turned away) is not encoded and does not use up an
+attempt; it is tried again on the next keyframe. Recognitions are queued as
+events that the page collects with each frame response (or by polling), so a
+stream only holds a server thread while one of its frames is processed.
+
+Streams live in the memory of one process, so every request of a stream has
+to reach the same server process (see gunicorn.conf.py).
+"""
+import itertools
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+
+import cv2
+
+import face_pipeline
+
+logger = logging.getLogger('eduvision.face_stream')
+
+
+class StreamLimitReached(Exception):
+    """Raised when the maximum number of live streams is already open"""
+
+
+class StreamClosed(Exception):
+    """Raised when a frame arrives for a stream that has been closed"""
+
+
+def create_tracker(kind='MIL'):
+    """Return a new OpenCV single-object tracker (``MIL``, or ``KCF``/``CSRT`` with opencv-contrib)"""
+    factory = getattr(cv2, f'Tracker{kind}_create', None)
+    if factory is None and hasattr(cv2, f'Tracker{kind}'):
+        factory = getattr(cv2, f'Tracker{kind}').create
+    if factory is None:
+        raise ValueError(f"OpenCV tracker {kind} is not available")
+    return factory()
+
+
+def _to_rect(box):
+    top, right, bottom, left = box
+    return (left, top, right - left, bottom - top)
+
+
+def _to_box(rect, shape):
+    x, y, w, h = (int(round(v)) for v in rect)
+    height, width = shape[:2]
+    return (max(0, y), min(width, x + w), min(height, y + h), max(0, x))
+
+
+def overlap(a, b):
+    """Intersection over union of two ``(top, right, bottom, left)`` boxes"""
+    top, right = max(a[0], b[0]), min(a[1], b[1])
+    bottom, left = min(a[2], b[2]), max(a[3], b[3])
+    if right <= left or bottom <= top:
+        return 0.0
+    inter = (right - left) * (bottom - top)
+    area_a = (a[1] - a[3]) * (a[2] - a[0])
+    area_b = (b[1] - b[3]) * (b[2] - b[0])
+    return inter / float(area_a + area_b - inter)
+
+
+class Track:
+    """One face followed across frames"""
+
+    def __init__(self, track_id, box):
+        self.id = track_id
+        self.box = box
+        self.tracker = None
+        self.student = None
+        self.confidence = 0
+        self.attempts = 0
+
+    def to_dict(self):
+        return {
+            'track_id': self.id,
+            'box': list(self.box),
+            'student_id': self.student['student_id'] if self.student else None,
+            'name': self.student['name'] if self.student else None,
+            'confidence': round(self.confidence, 2) if self.student else None,
+        }
+
+
+class StreamSession:
+    """Tracks and recognition events of one live stream.
+
+    ``process(img, recognize)`` handles one RGB frame; ``recognize(encodings)``
+    must return ``(matches, already_recorded)`` like ``recognize_faces`` in
+    app.py.
+    """
+
+    def __init__(self, class_name, username, pool, detection=None, encoding=None, keyframe_interval=10,
+                 tracker='MIL', max_tracks=30, max_encode_attempts=3, min_overlap=0.3, max_events=500,
+                 clock=time.monotonic):
+        create_tracker(tracker)
+        self.id = uuid.uuid4().hex
+        self.class_name = class_name
+        self.username = username
+        self.pool = pool
+        self.detection = detection
+        self.encoding = encoding
+        self.keyframe_interval = max(1, keyframe_interval)
+        self.tracker = tracker
+        self.max_tracks = max_tracks
+        self.max_encode_attempts = max_encode_attempts
+        self.min_overlap = min_overlap
+        self.clock = clock
+        self.last_active = clock()
+        self.closed = False
+        self.tracks = []
+        self.counts = {'frames': 0, 'keyframes': 0, 'faces_encoded': 0, 'faces_rejected': 0, 'tracks_lost': 0}
+        self._track_ids = itertools.count(1)
+        self._since_keyframe = self.keyframe_interval
+        self._lost = False
+        self._events = deque(maxlen=max_events)
+        self._event_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def process(self, img, recognize):
+        """Detect (keyframe) or track faces in ``img``; returns the frame's tracks"""
+        with self._lock:
+            if self.closed:
+                raise StreamClosed(f"stream {self.id} is closed")
+            self.last_active = self.clock()
+            self.counts['frames'] += 1
+            self._since_keyframe += 1
+            keyframe = self._lost or self._since_keyframe >= self.keyframe_interval
+            if keyframe:
+                self._keyframe(img, recognize)
+            else:
+                self._follow(img)
+            return {
+                'frame': self.counts['frames'],
+                'keyframe': keyframe,
+                'tracks': [track.to_dict() for track in self.tracks],
+            }
+
+    def _keyframe(self, img, recognize):
+        locations = self.pool.run(face_pipeline.detect_faces, img, self.detection)
+        self.counts['keyframes'] += 1
+        self._since_keyframe = 0
+        self._lost = False
+
+        tracks = []
+        for box, track in self._associate(locations):
+            if track is None:
+                if len(tracks) >= self.max_tracks:
+                    continue
+                track = Track(next(self._track_ids), box)
+            # Re-seed every tracker on the detected box so tracking drift never accumulates
+            track.box = box
+            track.tracker = create_tracker(self.tracker)
+            track.tracker.init(img, _to_rect(box))
+            tracks.append(track)
+        self.tracks = tracks
+
+        pending = [track for track in tracks if track.student is None and track.attempts < self.max_encode_attempts]
+        if not pending:
+            return
+        encodings = self.pool.run(face_pipeline.encode_faces, img, [track.box for track in pending],
+                                  encoding=self.encoding)
+        encoded = [(track, encoding) for track, encoding in zip(pending, encodings) if encoding is not None]
+        self.counts['faces_encoded'] += len(encoded)
+        self.counts['faces_rejected'] += len(pending) - len(encoded)
+        if not encoded:
+            return
+        matches, already_recorded = recognize([encoding for _, encoding in encoded])
+        for (track, _), (student, confidence) in zip(encoded, matches):
+            track.attempts += 1
+            if student:
+                track.student = student
+                track.confidence = confidence
+                self._emit('recognized', dict(track.to_dict(),
+                                              already_recorded=student['student_id'] in already_recorded))
+            elif track.attempts == self.max_encode_attempts:
+                self._emit('unknown', track.to_dict())
+
+    def _associate(self, locations):
+        """Pair each detected box with the existing track it overlaps most (or None)"""
+        pairs = sorted(
+            ((overlap(box, track.box), i, j) for i, box in enumerate(locations) for j, track in enumerate(self.tracks)),
+            reverse=True
+        )
+        assigned, used = {}, set()
+        for score, i, j in pairs:
+            if score < self.min_overlap:
+                break
+            if i not in assigned and j not in used:
+                assigned[i] = self.tracks[j]
+                used.add(j)
+        return [(box, assigned.get(i)) for i, box in enumerate(locations)]
+
+    def _follow(self, img):
+        tracks = []
+        for track in self.tracks:
+            found, rect = track.tracker.update(img)
+            if found:
+                track.box = _to_box(rect, img.shape)
+                tracks.append(track)
+            else:
+                # Re-detect on the next frame rather than wait for the keyframe
+                self._lost = True
+                self.counts['tracks_lost'] += 1
+        self.tracks = tracks
+
+    def _emit(self, kind, data):
+        self._events.append(dict(data, id=next(self._event_ids), type=kind))
+
+    def events_after(self, last_id):
+        """Return ``(events, closed)``: the queued events newer than ``last_id`` and whether the stream is closed"""
+        with self._lock:
+            return [event for event in self._events if event['id'] > last_id], self.closed
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            self.tracks = []
+
+
+class StreamRegistry:
+    """Open streams of this process; streams idle for ``idle_timeout`` seconds are closed"""
+
+    def __init__(self, max_streams=20, idle_timeout=60, clock=time.monotonic):
+        self.max_streams = max_streams
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._streams = {}
+
+    def _expire(self):
+        now = self.clock()
+        for stream_id, stream in list(self._streams.items()):
+            if stream.closed or now - stream.last_active > self.idle_timeout:
+                del self._streams[stream_id]
+                stream.close()
+                logger.info(f"Stream {stream_id} ({stream.class_name}) ended after {stream.counts}")
+
+    def open(self, **kwargs):
+        """Start a :class:`StreamSession`; raises :class:`StreamLimitReached` when full"""
+        with self._lock:
+            self._expire()
+            if len(self._streams) >= self.max_streams:
+                raise StreamLimitReached(f"all {self.max_streams} live streams are in use")
+            stream = StreamSession(clock=self.clock, **kwargs)
+            self._streams[stream.id] = stream
+            return stream
+
+    def __len__(self):
+        return len(self._streams)
+
+    def get(self, stream_id):
+        with self._lock:
+            self._expire()
+            return self._streams.get(stream_id)
+
+    def close(self, stream_id):
+        with self._lock:
+            stream = self._streams.pop(stream_id, None)
+        if stream is not None:
+            stream.close()
+            logger.info(f"Stream {stream_id} ({stream.class_name}) closed after {stream.counts}")
+        return stream
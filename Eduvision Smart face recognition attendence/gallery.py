@@ -0,0 +1,415 @@
+"""In-memory gallery of student face encodings used for attendance matching."""
+import logging
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+import encoding_format
+from gallery_index import ExactIndex, ExactSearcher
+
+logger = logging.getLogger('eduvision.gallery')
+
+ENCODING_DIM = 128
+
+# ``matrix`` holds every template; each student's templates are the contiguous rows
+# ``segments[i]:segments[i] + counts[i]``. ``rows`` maps a document ``_id`` to its student index.
+# Students removed or replaced since the last compaction keep their rows but are ``dead`` (skipped
+# by searches, not in ``rows``); ``dead_templates`` counts their matrix rows.
+GalleryState = namedtuple('GalleryState',
+                          'matrix counts segments doc_ids student_ids names classes rows searcher partitions '
+                          'dead dead_templates')
+
+# Per-class slice of the gallery: its members' student indices, and its own small matrix and exact searcher
+Partition = namedtuple('Partition', 'members doc_ids student_ids names searcher')
+
+
+def _segments(counts):
+    """Start offset of each student's block of templates"""
+    return np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.intp) if len(counts) else np.empty(0, np.intp)
+
+
+def _template_rows(segments, counts, students):
+    """Matrix rows of the templates belonging to the given student indices"""
+    students = np.asarray(students, dtype=np.intp)
+    sizes = counts[students]
+    starts = np.repeat(segments[students] - _segments(sizes), sizes)
+    return starts + np.arange(sizes.sum())
+
+
+def select_templates(encodings, max_templates=5, mode='diverse', outlier_distance=0.6):
+    """Choose at most ``max_templates`` templates from a student's enrollment encodings.
+
+    Encodings further than ``outlier_distance`` from the median are dropped
+    first (usually another person in the photo or a bad detection). When more
+    remain than allowed, ``mode='diverse'`` keeps the ones that cover the most
+    pose/lighting variation (farthest-point selection) and
+    ``mode='centroids'`` replaces them with k-means cluster centroids.
+    """
+    encodings = np.asarray(encodings, dtype=np.float64).reshape(-1, ENCODING_DIM)
+    if len(encodings) > 2:
+        distances = np.linalg.norm(encodings - np.median(encodings, axis=0), axis=1)
+        inliers = distances <= outlier_distance
+        if inliers.any():
+            encodings = encodings[inliers]
+    if len(encodings) <= max_templates:
+        return encodings
+
+    if mode == 'centroids':
+        centroids = encodings[_farthest_points(encodings, max_templates)]
+        for _ in range(10):
+            labels = np.argmin(np.linalg.norm(encodings[:, None] - centroids[None], axis=2), axis=1)
+            centroids = np.array([
+                encodings[labels == k].mean(axis=0) if (labels == k).any() else centroids[k]
+                for k in range(max_templates)
+            ])
+        return centroids
+    return encodings[_farthest_points(encodings, max_templates)]
+
+
+def _farthest_points(encodings, count):
+    # Start from the encoding closest to the mean, then keep adding the one farthest from all chosen
+    chosen = [int(np.argmin(np.linalg.norm(encodings - encodings.mean(axis=0), axis=1)))]
+    nearest = np.linalg.norm(encodings - encodings[chosen[0]], axis=1)
+    while len(chosen) < count:
+        chosen.append(int(np.argmax(nearest)))
+        nearest = np.minimum(nearest, np.linalg.norm(encodings - encodings[chosen[-1]], axis=1))
+    return chosen
+
+
+class FaceGallery:
+    """Process-resident matrix of all student templates plus parallel id/name arrays.
+
+    A student may have several templates (``face_templates``, e.g. different
+    poses and lighting); a face matches the student whose closest template is
+    nearest. Students enrolled before templates existed have one template,
+    their ``face_encoding``.
+
+    Readers take a reference to the current state tuple, so matching never
+    blocks on (or sees half of) a concurrent update. Rows are keyed by the
+    student document ``_id`` so change events can be applied incrementally.
+    Nearest-neighbour search is delegated to ``index`` (see gallery_index).
+
+    Students enrolled in classes (the ``classes`` field of the student
+    document) are also kept in per-class partitions so a class roster can be
+    searched on its own. Only partitions whose members changed are rebuilt.
+
+    Changes cost in proportion to their size, not the gallery's: new
+    templates are written into spare capacity at the end of the matrix
+    (grown in chunks), and removed or replaced students are only marked dead.
+    The matrix is compacted once dead templates exceed ``compact_ratio`` of
+    its rows, so that copy is spread over many changes.
+    """
+
+    def __init__(self, dtype=np.float64, index=None, compact_ratio=0.25):
+        self.dtype = np.dtype(dtype)
+        self.index = index or ExactIndex()
+        self.compact_ratio = compact_ratio
+        self._lock = threading.Lock()
+        # Backing array of the current matrix when it has spare rows; rows past the matrix are unused
+        self._buffer = None
+        self._state = self._build_state(np.empty((0, ENCODING_DIM)), [], [], [], [], [])
+        self.loaded = False
+
+    def _partition(self, matrix, counts, segments, doc_ids, student_ids, names, members):
+        members = np.asarray(members, dtype=np.intp)
+        return Partition(
+            members,
+            [doc_ids[row] for row in members],
+            [student_ids[row] for row in members],
+            [names[row] for row in members],
+            ExactSearcher(np.ascontiguousarray(matrix[_template_rows(segments, counts, members)]),
+                          _segments(counts[members]))
+        )
+
+    def _build_state(self, matrix, counts, doc_ids, student_ids, names, classes, previous=None, dirty_classes=None,
+                     kept_rows=None):
+        matrix = np.ascontiguousarray(matrix, dtype=self.dtype).reshape(-1, ENCODING_DIM)
+        counts = np.asarray(counts, dtype=np.intp)
+        segments = _segments(counts)
+        rows = {doc_id: row for row, doc_id in enumerate(doc_ids)}
+        if not len(matrix):
+            searcher = None
+        elif previous is not None and previous.searcher is not None and kept_rows is not None:
+            # Incremental change: the first len(kept_rows) rows are previous rows, the rest are new
+            searcher = self.index.update(previous.searcher, matrix, segments, kept_rows)
+        else:
+            searcher = self.index.build(matrix, segments)
+
+        members = {}
+        for row, row_classes in enumerate(classes):
+            for class_name in row_classes:
+                members.setdefault(class_name, []).append(row)
+
+        partitions = {}
+        for class_name, class_rows in members.items():
+            if previous is not None and class_name not in dirty_classes and class_name in previous.partitions:
+                # Same students, but their indices may have moved
+                partitions[class_name] = previous.partitions[class_name]._replace(
+                    members=np.array(class_rows, dtype=np.intp))
+                continue
+            partitions[class_name] = self._partition(matrix, counts, segments, doc_ids, student_ids, names,
+                                                     class_rows)
+
+        return GalleryState(matrix, counts, segments, list(doc_ids), list(student_ids), list(names),
+                            list(classes), rows, searcher, partitions, np.zeros(len(counts), dtype=bool), 0)
+
+    def _grow(self, matrix, templates):
+        """``matrix`` with ``templates`` appended, written into spare rows of the buffer when it has room"""
+        size = len(matrix) + len(templates)
+        if self._buffer is None or size > len(self._buffer):
+            buffer = np.empty((size + max(size // 4, 1024), ENCODING_DIM), dtype=self.dtype)
+            buffer[:len(matrix)] = matrix
+            self._buffer = buffer
+        # Rows past len(matrix) belong to no published state, so readers never see them change
+        self._buffer[len(matrix):size] = templates
+        return self._buffer[:size]
+
+    def _append_state(self, previous, removed, new_rows, dirty_classes, dead_templates):
+        """``previous`` with the students at indices ``removed`` marked dead and ``new_rows`` appended"""
+        first = len(previous.doc_ids)
+        new_counts = np.array([len(row[4]) for row in new_rows], dtype=np.intp)
+        templates = np.vstack([row[4] for row in new_rows]) if new_rows else np.empty((0, ENCODING_DIM))
+        matrix = self._grow(previous.matrix, templates)
+        counts = np.concatenate((previous.counts, new_counts))
+        segments = np.concatenate((previous.segments, len(previous.matrix) + _segments(new_counts)))
+        doc_ids = previous.doc_ids + [row[0] for row in new_rows]
+        student_ids = previous.student_ids + [row[1] for row in new_rows]
+        names = previous.names + [row[2] for row in new_rows]
+        classes = previous.classes + [row[3] for row in new_rows]
+        dead = np.concatenate((previous.dead, np.zeros(len(new_rows), dtype=bool)))
+        dead[removed] = True
+
+        rows = dict(previous.rows)
+        for row in removed:
+            del rows[previous.doc_ids[row]]
+        for offset, row in enumerate(new_rows):
+            rows[row[0]] = first + offset
+
+        if not len(matrix):
+            searcher = None
+        elif previous.searcher is not None:
+            searcher = self.index.update(previous.searcher, matrix, segments, np.arange(len(previous.matrix)), dead)
+        else:
+            searcher = self.index.build(matrix, segments, dead)
+
+        added = {}
+        for offset, row in enumerate(new_rows):
+            for class_name in row[3]:
+                added.setdefault(class_name, []).append(first + offset)
+        partitions = dict(previous.partitions)
+        for class_name in dirty_classes:
+            old = previous.partitions.get(class_name)
+            members = [] if old is None else [row for row in old.members if not dead[row]]
+            members += added.get(class_name, [])
+            if members:
+                partitions[class_name] = self._partition(matrix, counts, segments, doc_ids, student_ids, names,
+                                                         members)
+            else:
+                partitions.pop(class_name, None)
+
+        return GalleryState(matrix, counts, segments, doc_ids, student_ids, names, classes, rows, searcher,
+                            partitions, dead, dead_templates)
+
+    @staticmethod
+    def _decode(student):
+        """Return the student's templates as a ``(count, 128)`` array, or None"""
+        # Any stored format/dtype (see encoding_format); the matrix is cast to the gallery dtype
+        raw_templates = student.get('face_templates') or ([student['face_encoding']] if student.get('face_encoding') else [])
+        if not raw_templates:
+            return None
+        templates = np.vstack([encoding_format.decode(raw) for raw in raw_templates])
+        if templates.shape[1] != ENCODING_DIM:
+            raise ValueError(f"unexpected encoding size {templates.shape[1]}")
+        return templates
+
+    def _safe_decode(self, student):
+        try:
+            return self._decode(student)
+        except Exception as e:
+            logger.error(f"Skipping student {student.get('student_id', 'unknown')}: {str(e)}")
+            return None
+
+    def __len__(self):
+        return len(self._state.rows)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._state.rows
+
+    @property
+    def template_count(self):
+        """Number of templates (matrix rows) across all students"""
+        state = self._state
+        return len(state.matrix) - state.dead_templates
+
+    def doc_ids(self):
+        """Return the ``_id`` of every student currently in the gallery"""
+        return list(self._state.rows)
+
+    def roster(self, class_name):
+        """Return the student ids enrolled in ``class_name``"""
+        partition = self._state.partitions.get(class_name)
+        return list(partition.student_ids) if partition else []
+
+    def load(self, students):
+        """Replace the gallery contents with the given student documents"""
+        blocks, doc_ids, student_ids, names, classes = [], [], [], [], []
+        for student in students:
+            templates = self._safe_decode(student)
+            if templates is None:
+                continue
+            blocks.append(templates)
+            doc_ids.append(student['_id'])
+            student_ids.append(student['student_id'])
+            names.append(student.get('name'))
+            classes.append(tuple(student.get('classes') or ()))
+
+        matrix = np.vstack(blocks) if blocks else np.empty((0, ENCODING_DIM))
+        self.load_arrays(matrix, [len(b) for b in blocks], doc_ids, student_ids, names, classes)
+
+    def load_arrays(self, matrix, counts, doc_ids, student_ids, names, classes):
+        """Replace the gallery contents with prebuilt arrays (the inverse of :meth:`export`).
+
+        A C-contiguous ``matrix`` already in the gallery dtype, such as a
+        read-only memory map of a snapshot, is used as is without a copy.
+        """
+        classes = [tuple(row_classes or ()) for row_classes in classes]
+        with self._lock:
+            self._buffer = None
+            self._state = self._build_state(matrix, counts, doc_ids, student_ids, names, classes)
+            self.loaded = True
+        logger.info(f"Face gallery loaded with {len(doc_ids)} students ({len(matrix)} templates) "
+                    f"in {len(self._state.partitions)} classes")
+
+    def export(self):
+        """Current contents as ``{'matrix', 'counts', 'doc_ids', 'student_ids', 'names', 'classes'}``"""
+        state = self._state
+        alive = np.flatnonzero(~state.dead)
+        return {
+            'matrix': state.matrix[_template_rows(state.segments, state.counts, alive)] if state.dead_templates
+            else state.matrix,
+            'counts': state.counts[alive],
+            'doc_ids': [state.doc_ids[row] for row in alive],
+            'student_ids': [state.student_ids[row] for row in alive],
+            'names': [state.names[row] for row in alive],
+            'classes': [list(state.classes[row]) for row in alive],
+        }
+
+    def apply_changes(self, changes):
+        """Apply an ordered batch of changes without reloading the gallery.
+
+        ``changes`` is a list of ``('upsert', student_document)`` or
+        ``('delete', doc_id)`` tuples. Upserting a document without a usable
+        encoding removes it. The new state is built once per batch.
+        """
+        pending = {}
+        for op, value in changes:
+            if op == 'delete':
+                pending[value] = None
+                continue
+            templates = self._safe_decode(value)
+            if templates is None:
+                pending[value['_id']] = None
+            else:
+                pending[value['_id']] = (value['student_id'], value.get('name'),
+                                         tuple(value.get('classes') or ()), templates)
+        if not pending:
+            return
+
+        with self._lock:
+            previous = self._state
+            removed = []
+            new_rows = []
+            dirty_classes = set()
+
+            # A changed student is removed and appended again, since its template count may differ
+            for doc_id, entry in pending.items():
+                row = previous.rows.get(doc_id)
+                if row is not None:
+                    dirty_classes.update(previous.classes[row])
+                    removed.append(row)
+                if entry is not None:
+                    dirty_classes.update(entry[2])
+                    new_rows.append((doc_id,) + entry)
+            if not removed and not new_rows:
+                return
+
+            removed = np.array(removed, dtype=np.intp)
+            dead_templates = previous.dead_templates + int(previous.counts[removed].sum())
+            size = len(previous.matrix) + sum(len(row[4]) for row in new_rows)
+            if dead_templates <= self.compact_ratio * size:
+                self._state = self._append_state(previous, removed, new_rows, dirty_classes, dead_templates)
+                return
+
+            # Compact: copy the live rows into a new matrix
+            keep = ~previous.dead
+            keep[removed] = False
+            kept = np.flatnonzero(keep)
+            kept_rows = np.arange(len(previous.matrix)) if keep.all() else _template_rows(
+                previous.segments, previous.counts, kept)
+            matrix = previous.matrix if keep.all() else previous.matrix[kept_rows]
+            counts = list(previous.counts[kept])
+            doc_ids = [previous.doc_ids[row] for row in kept]
+            student_ids = [previous.student_ids[row] for row in kept]
+            names = [previous.names[row] for row in kept]
+            classes = [previous.classes[row] for row in kept]
+            if new_rows:
+                matrix = np.vstack([matrix] + [row[4] for row in new_rows])
+                counts += [len(row[4]) for row in new_rows]
+                doc_ids += [row[0] for row in new_rows]
+                student_ids += [row[1] for row in new_rows]
+                names += [row[2] for row in new_rows]
+                classes += [row[3] for row in new_rows]
+
+            self._buffer = None
+            self._state = self._build_state(matrix, counts, doc_ids, student_ids, names, classes,
+                                            previous=previous, dirty_classes=dirty_classes, kept_rows=kept_rows)
+
+    def upsert(self, student):
+        """Insert or replace a single student in the gallery"""
+        self.apply_changes([('upsert', student)])
+
+    @staticmethod
+    def _search(searcher, student_ids, names, faces, tolerance, min_confidence):
+        # Searchers return the student index (the nearest of its templates)
+        best_rows, best_dist = searcher.search(faces)
+        results = []
+        for row, distance in zip(best_rows, best_dist):
+            confidence = float((1 - distance) * 100)
+            if distance <= tolerance and confidence > min_confidence:
+                results.append(({'student_id': student_ids[row], 'name': names[row]}, confidence))
+            else:
+                results.append((None, 0))
+        return results
+
+    def match(self, face_encodings, tolerance=0.5, min_confidence=65, class_name=None, fallback=True):
+        """Match each face against the gallery in one batched search.
+
+        Returns a list with one entry per face: ``(student, confidence)`` where
+        ``student`` is a ``{'student_id', 'name'}`` dict, or ``(None, 0)`` when
+        the closest student is outside ``tolerance`` or below ``min_confidence``.
+
+        With ``class_name`` the class roster is searched first; faces it does
+        not match are searched in the whole gallery only when ``fallback`` is
+        true. Classes without a roster always use the whole gallery.
+        """
+        state = self._state
+        if len(face_encodings) == 0:
+            return []
+        faces = np.asarray(face_encodings, dtype=self.dtype).reshape(-1, ENCODING_DIM)
+        results = [(None, 0)] * len(faces)
+
+        partition = state.partitions.get(class_name) if class_name else None
+        if partition is not None:
+            results = self._search(partition.searcher, partition.student_ids, partition.names,
+                                   faces, tolerance, min_confidence)
+            if not fallback:
+                return results
+
+        unmatched = [i for i, (student, _) in enumerate(results) if student is None]
+        if unmatched and state.searcher is not None:
+            global_results = self._search(state.searcher, state.student_ids, state.names,
+                                          faces[unmatched], tolerance, min_confidence)
+            for i, result in zip(unmatched, global_results):
+                results[i] = result
+        return results
@@ -0,0 +1,218 @@
+"""Nearest-neighbour index backends used by FaceGallery.
+
+``exact`` (the default) scans the whole gallery with one batched distance
+computation. ``ivf`` partitions the gallery with k-means into ``nlist`` cells
+and only scans the ``nprobe`` cells closest to each face, trading a little
+recall for much lower latency on very large galleries. Raising ``nprobe``
+moves it back towards exact results.
+
+Galleries may hold several templates per student. ``segments`` gives the
+first matrix row of each student's contiguous block of templates, and
+searchers then return the student index and its closest template distance.
+
+``build`` makes a searcher for a whole matrix. ``update`` makes one for a
+matrix whose first rows are ``kept_rows`` of the previous searcher's matrix
+(in order) followed by new rows, reusing what was computed for the kept
+rows, so an incremental gallery change costs in proportion to the change.
+Both accept ``dead``, a boolean per student (or row) that searches skip.
+"""
+import logging
+
+import numpy as np
+
+logger = logging.getLogger('eduvision.gallery_index')
+
+
+def _sq_distances(faces, matrix, sq_norms):
+    # ||f - g||^2 = ||f||^2 + ||g||^2 - 2 f.g, for all (face, row) pairs at once
+    sq_dist = np.einsum('ij,ij->i', faces, faces)[:, None] + sq_norms[None, :] - 2.0 * (faces @ matrix.T)
+    np.maximum(sq_dist, 0, out=sq_dist)
+    return sq_dist
+
+
+def _nearest(points, centroids, centroid_sq_norms, chunk=4096):
+    """Index of the closest centroid for each point, in bounded-memory chunks"""
+    labels = np.empty(len(points), dtype=np.intp)
+    for start in range(0, len(points), chunk):
+        block = points[start:start + chunk]
+        labels[start:start + chunk] = np.argmin(_sq_distances(block, centroids, centroid_sq_norms), axis=1)
+    return labels
+
+
+def _row_sq_norms(previous, matrix, kept_rows):
+    """Squared norms of ``matrix``, reusing those of the rows kept from ``previous``"""
+    new_rows = matrix[len(kept_rows):]
+    return np.concatenate((previous.sq_norms[kept_rows], np.einsum('ij,ij->i', new_rows, new_rows)))
+
+
+def _owners(segments, size):
+    """Student index of every matrix row"""
+    counts = np.diff(np.append(segments, size))
+    return np.repeat(np.arange(len(segments)), counts)
+
+
+def _dead_entries(dead):
+    return np.flatnonzero(dead) if dead is not None and dead.any() else None
+
+
+class ExactSearcher:
+    """Brute-force search over every gallery row"""
+
+    def __init__(self, matrix, segments=None, sq_norms=None, dead=None):
+        self.matrix = matrix
+        self.sq_norms = np.einsum('ij,ij->i', matrix, matrix) if sq_norms is None else sq_norms
+        # One template per student: rows are students, no reduction needed
+        self.segments = None if segments is None or len(segments) == len(matrix) else segments
+        self.dead = _dead_entries(dead)
+
+    def search(self, faces):
+        """Return ``(entries, distances)``: the nearest student (or row) for each face"""
+        sq_dist = _sq_distances(faces, self.matrix, self.sq_norms)
+        if self.segments is not None:
+            # Segment-min: each student's distance is that of its closest template
+            sq_dist = np.minimum.reduceat(sq_dist, self.segments, axis=1)
+        if self.dead is not None:
+            sq_dist[:, self.dead] = np.inf
+        rows = np.argmin(sq_dist, axis=1)
+        return rows, np.sqrt(sq_dist[np.arange(len(faces)), rows])
+
+
+class ExactIndex:
+    """Default backend: exact brute-force matching"""
+
+    name = 'exact'
+
+    def build(self, matrix, segments=None, dead=None):
+        return ExactSearcher(matrix, segments, dead=dead)
+
+    def update(self, previous, matrix, segments, kept_rows, dead=None):
+        return ExactSearcher(matrix, segments, _row_sq_norms(previous, matrix, kept_rows), dead)
+
+
+class IVFSearcher:
+    """Inverted-file search over k-means cells of the gallery"""
+
+    def __init__(self, matrix, centroids, assignments, nprobe, segments=None, sq_norms=None, dead=None):
+        self.matrix = matrix
+        self.owners = None if segments is None else _owners(segments, len(matrix))
+        self.sq_norms = np.einsum('ij,ij->i', matrix, matrix) if sq_norms is None else sq_norms
+        # Per row, since candidates are rows
+        if dead is not None and self.owners is not None:
+            dead = dead[self.owners]
+        self.dead_rows = dead if dead is not None and dead.any() else None
+        self.assignments = assignments
+        self.centroids = centroids
+        self.centroid_sq_norms = np.einsum('ij,ij->i', centroids, centroids)
+        self.nprobe = min(nprobe, len(centroids))
+        # Rows sorted by cell so each cell is one contiguous slice
+        self.order = np.argsort(assignments, kind='stable')
+        self.offsets = np.searchsorted(assignments[self.order], np.arange(len(centroids) + 1))
+
+    def search(self, faces):
+        """Return ``(entries, distances)`` of the nearest row (or its student) among the probed cells"""
+        cell_dist = _sq_distances(faces, self.centroids, self.centroid_sq_norms)
+        probes = np.argpartition(cell_dist, self.nprobe - 1, axis=1)[:, :self.nprobe]
+
+        rows = np.empty(len(faces), dtype=np.intp)
+        distances = np.empty(len(faces), dtype=np.float64)
+        for i, cells in enumerate(probes):
+            candidates = np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in cells])
+            sq_dist = _sq_distances(faces[i:i + 1], self.matrix[candidates], self.sq_norms[candidates])[0]
+            if self.dead_rows is not None:
+                sq_dist[self.dead_rows[candidates]] = np.inf
+            best = np.argmin(sq_dist)
+            rows[i] = candidates[best]
+            distances[i] = np.sqrt(sq_dist[best])
+        if self.owners is not None:
+            rows = self.owners[rows]
+        return rows, distances
+
+
+class IVFIndex:
+    """k-means partitioned backend for very large galleries.
+
+    Centroids are trained when the whole gallery is built (at load) and
+    reused afterwards. Incremental changes keep the cell of every unchanged
+    row and only assign the new or changed rows, without retraining; a full
+    build retrains when the gallery has grown or shrunk by ``retrain_factor``
+    since the last training. Galleries smaller than ``min_size`` are searched
+    exactly.
+    """
+
+    name = 'ivf'
+
+    def __init__(self, nlist=None, nprobe=8, min_size=5000, train_iterations=10,
+                 train_sample=50000, retrain_factor=2.0, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_size = min_size
+        self.train_iterations = train_iterations
+        self.train_sample = train_sample
+        self.retrain_factor = retrain_factor
+        self.seed = seed
+        self.centroids = None
+        self._trained_size = 0
+
+    def _needs_training(self, size):
+        if self.centroids is None:
+            return True
+        return size > self._trained_size * self.retrain_factor or size * self.retrain_factor < self._trained_size
+
+    def train(self, matrix):
+        """Run k-means on (a sample of) the gallery to place the cell centroids"""
+        rng = np.random.default_rng(self.seed)
+        nlist = self.nlist or max(1, int(4 * np.sqrt(len(matrix))))
+        nlist = min(nlist, len(matrix))
+        sample = matrix
+        if len(matrix) > self.train_sample:
+            sample = matrix[rng.choice(len(matrix), self.train_sample, replace=False)]
+
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].astype(np.float64)
+        for _ in range(self.train_iterations):
+            labels = _nearest(sample, centroids, np.einsum('ij,ij->i', centroids, centroids))
+            counts = np.bincount(labels, minlength=nlist)
+            filled = counts > 0
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            sums = np.add.reduceat(sample[np.argsort(labels, kind='stable')], starts[filled], axis=0)
+            # Empty cells keep their previous centroid
+            centroids[filled] = sums / counts[filled, None]
+
+        self.centroids = centroids.astype(matrix.dtype)
+        self._trained_size = len(matrix)
+        logger.info(f"Trained IVF gallery index with {nlist} cells on {len(sample)} encodings")
+
+    def build(self, matrix, segments=None, dead=None):
+        if len(matrix) < self.min_size:
+            return ExactSearcher(matrix, segments, dead=dead)
+        if self._needs_training(len(matrix)):
+            self.train(matrix)
+        centroid_sq_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        assignments = _nearest(matrix, self.centroids, centroid_sq_norms)
+        return IVFSearcher(matrix, self.centroids, assignments, self.nprobe, segments, dead=dead)
+
+    def update(self, previous, matrix, segments, kept_rows, dead=None):
+        if len(matrix) < self.min_size:
+            return ExactSearcher(matrix, segments, dead=dead)
+        if not isinstance(previous, IVFSearcher):
+            # The gallery just grew past min_size
+            return self.build(matrix, segments, dead)
+        new_rows = matrix[len(kept_rows):]
+        assignments = np.concatenate((previous.assignments[kept_rows],
+                                      _nearest(new_rows, previous.centroids, previous.centroid_sq_norms)))
+        return IVFSearcher(matrix, previous.centroids, assignments, self.nprobe, segments,
+                           _row_sq_norms(previous, matrix, kept_rows), dead)
+
+
+INDEX_BACKENDS = {
+    ExactIndex.name: ExactIndex,
+    IVFIndex.name: IVFIndex,
+}
+
+
+def make_index(name='exact', **options):
+    """Create an index backend by name (``exact`` or ``ivf``)"""
+    try:
+        backend = INDEX_BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown gallery index backend: {name}")
+    return backend(**options)
@@ -0,0 +1,88 @@
+"""On-disk snapshot of the face gallery for fast warm-up.
+
+A snapshot is a directory holding the template matrix as a ``.npy`` file
+(written with ``np.save``) and ``gallery.json`` with the student ids, names,
+classes, template counts and the sync watermark it was taken at. Loading maps
+the matrix with ``mmap_mode='r'``: nothing is read up front, and processes
+serving the same snapshot share its pages through the OS page cache instead
+of each holding a private copy. Students changed since the snapshot are then
+applied incrementally (see gallery_sync). That sharing lasts until a process
+applies its first change: the changed gallery is built as a new matrix in the
+process's own memory, so gallery_sync rewrites the snapshot regularly.
+
+``gallery.json`` is replaced atomically and names its matrix file, so a
+reader never pairs metadata with the wrong matrix.
+"""
+import glob
+import logging
+import os
+import time
+
+import numpy as np
+from bson import json_util
+
+logger = logging.getLogger('eduvision.gallery_snapshot')
+
+FORMAT = 1
+META_FILE = 'gallery.json'
+# Seconds a superseded matrix file is kept before a later save removes it
+RECENT_MATRIX_AGE = 60
+
+
+def save(directory, contents, watermark_time, watermark_id):
+    """Write ``FaceGallery.export()`` contents and the sync watermark they are current up to"""
+    os.makedirs(directory, exist_ok=True)
+    matrix = np.ascontiguousarray(contents['matrix'])
+    matrix_file = f"matrix-{time.time_ns()}-{os.getpid()}.npy"
+    np.save(os.path.join(directory, matrix_file), matrix)
+
+    meta = {
+        'format': FORMAT,
+        'matrix_file': matrix_file,
+        'dtype': matrix.dtype.str,
+        'counts': [int(count) for count in contents['counts']],
+        'doc_ids': contents['doc_ids'],
+        'student_ids': contents['student_ids'],
+        'names': contents['names'],
+        'classes': contents['classes'],
+        'watermark_time': watermark_time,
+        'watermark_id': watermark_id,
+    }
+    temp_path = os.path.join(directory, f"{META_FILE}.{os.getpid()}.tmp")
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(json_util.dumps(meta))
+    os.replace(temp_path, os.path.join(directory, META_FILE))
+
+    # Older matrices stay readable by processes that still map them (POSIX keeps unlinked files alive).
+    # Recent ones are kept: another worker saving at the same time may be about to name its matrix
+    removable = time.time() - RECENT_MATRIX_AGE
+    for path in glob.glob(os.path.join(directory, 'matrix-*.npy')):
+        if os.path.basename(path) != matrix_file:
+            try:
+                if os.path.getmtime(path) < removable:
+                    os.remove(path)
+            except OSError:
+                pass
+    logger.info(f"Gallery snapshot written to {directory}: {len(meta['doc_ids'])} students, "
+                f"{matrix.nbytes / 1e6:.1f} MB")
+
+
+def load(directory, dtype):
+    """Return the snapshot with its matrix memory-mapped, or None when it is missing or unusable"""
+    meta_path = os.path.join(directory, META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    try:
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json_util.loads(f.read())
+        if meta.get('format') != FORMAT or np.dtype(meta['dtype']) != np.dtype(dtype):
+            logger.info(f"Ignoring gallery snapshot in {directory}: different format or dtype")
+            return None
+        matrix = np.load(os.path.join(directory, meta['matrix_file']), mmap_mode='r')
+        if len(matrix) != sum(meta['counts']) or len(meta['counts']) != len(meta['doc_ids']):
+            raise ValueError('matrix does not match the metadata')
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable gallery snapshot in {directory}: {str(e)}")
+        return None
+    meta['matrix'] = matrix
+    return meta
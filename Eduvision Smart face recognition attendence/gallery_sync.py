@@ -0,0 +1,299 @@
+"""Keeps each worker's in-memory face gallery in step with the students collection.
+
+After the initial warm-up (from a gallery snapshot when one is configured,
+else a full scan of the collection) only new, changed or deleted student
+documents are applied. A MongoDB change stream is used when the server supports it (replica
+sets and sharded clusters); otherwise the collection is polled with an
+``updated_at``/``_id`` watermark. Both paths work against a mongomock client.
+"""
+import datetime
+import logging
+import os
+import threading
+import time
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+import gallery_snapshot
+
+logger = logging.getLogger('eduvision.gallery_sync')
+
+STUDENT_PROJECTION = {'student_id': 1, 'name': 1, 'classes': 1, 'face_encoding': 1, 'face_templates': 1, 'updated_at': 1}
+
+
+class GallerySync:
+    """Incrementally syncs a FaceGallery from ``get_collection()``.
+
+    ``get_collection`` is a callable returning the students collection (or
+    None when the database is unavailable). Call :meth:`refresh` before using
+    the gallery; it is cheap when nothing has changed.
+
+    With ``snapshot_path`` the warm-up maps the gallery from a snapshot (see
+    gallery_snapshot) and catches up from the snapshot's watermark instead of
+    fetching every student. Once the gallery has changed, the snapshot is
+    rewritten when it is older than ``reconcile_interval``; workers share one
+    snapshot, so whichever is due first rewrites it.
+    """
+
+    def __init__(self, gallery, get_collection, poll_interval=5.0, use_change_stream=True,
+                 clock_skew=datetime.timedelta(seconds=5), reconcile_interval=300.0, snapshot_path=None):
+        self.gallery = gallery
+        self.get_collection = get_collection
+        self.poll_interval = poll_interval
+        self.use_change_stream = use_change_stream
+        self.clock_skew = clock_skew
+        self.reconcile_interval = reconcile_interval
+        self.snapshot_path = snapshot_path
+
+        self._lock = threading.RLock()
+        self._warm_lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._streaming = False
+        self._resume_token = None
+        self._last_poll = 0.0
+        self._last_reconcile = 0.0
+        self._watermark_time = None
+        self._watermark_id = None
+        self._known_count = 0
+        # updated_at of documents applied inside the clock-skew overlap window
+        self._recent = {}
+        # Changes applied since the gallery was last written to the snapshot
+        self._snapshot_dirty = False
+
+    @property
+    def streaming(self):
+        """True while a change stream is delivering updates to this process"""
+        return self._streaming and self._thread is not None and self._thread.is_alive()
+
+    def warm_up(self, watch=True, use_snapshot=True):
+        """Load the whole gallery once and (with ``watch``) start watching for changes"""
+        if use_snapshot and self.snapshot_path and self._warm_up_from_snapshot():
+            if watch:
+                self._start_watcher()
+            return True
+
+        collection = self.get_collection()
+        if collection is None:
+            return False
+        started = datetime.datetime.now()
+        students = list(collection.find({}, STUDENT_PROJECTION).sort('_id', 1))
+        self.gallery.load(students)
+        with self._lock:
+            self._watermark_time = started
+            self._watermark_id = students[-1]['_id'] if students else None
+            self._known_count = len(students)
+            self._recent = {student['_id']: student.get('updated_at') for student in students
+                            if student.get('updated_at') and student['updated_at'] >= started - self.clock_skew}
+            self._last_poll = self._last_reconcile = time.monotonic()
+        if self.snapshot_path:
+            self._write_snapshot()
+        if watch:
+            self._start_watcher()
+        return True
+
+    def _warm_up_from_snapshot(self):
+        written_at = self._snapshot_written_at()
+        snapshot = gallery_snapshot.load(self.snapshot_path, self.gallery.dtype)
+        if snapshot is None:
+            return False
+        self.gallery.load_arrays(snapshot['matrix'], snapshot['counts'], snapshot['doc_ids'],
+                                 snapshot['student_ids'], snapshot['names'], snapshot['classes'])
+        with self._lock:
+            self._watermark_time = snapshot['watermark_time']
+            self._watermark_id = snapshot['watermark_id']
+            self._known_count = len(snapshot['doc_ids'])
+            self._recent = {}
+            # Students deleted since the snapshot are found by the reconcile of the first poll
+            self._last_reconcile = float('-inf')
+        # Catch up with everything written since the snapshot (a no-op while the database is down),
+        # and save what was caught up unless another worker already has
+        self.poll()
+        self._refresh_snapshot(written_before=written_at)
+        return True
+
+    def save_snapshot(self):
+        """Write the gallery and its watermark to ``snapshot_path``"""
+        with self._lock:
+            contents = self.gallery.export()
+            watermark_time, watermark_id = self._watermark_time, self._watermark_id
+            self._snapshot_dirty = False
+        gallery_snapshot.save(self.snapshot_path, contents, watermark_time, watermark_id)
+
+    def _write_snapshot(self):
+        try:
+            self.save_snapshot()
+        except OSError as e:
+            # Retried after the next change rather than on every poll
+            logger.error(f"Cannot write gallery snapshot: {str(e)}")
+
+    def _snapshot_written_at(self):
+        try:
+            return os.path.getmtime(os.path.join(self.snapshot_path, gallery_snapshot.META_FILE))
+        except OSError:
+            return float('-inf')
+
+    def _refresh_snapshot(self, written_before=None):
+        """Rewrite the snapshot if the gallery changed since this process last wrote it and the
+        snapshot on disk is older than ``written_before`` (default: ``reconcile_interval`` ago)"""
+        if not self.snapshot_path or not self._snapshot_dirty:
+            return
+        if written_before is None:
+            written_before = time.time() - self.reconcile_interval
+        if self._snapshot_written_at() <= written_before:
+            self._write_snapshot()
+
+    def refresh(self, force=False):
+        """Bring the gallery up to date, warming it up on first use"""
+        if not self.gallery.loaded:
+            with self._warm_lock:
+                # A failed warm-up is simply retried on the next call
+                if not self.gallery.loaded:
+                    self.warm_up()
+            return
+
+        if self._pid != os.getpid():
+            # Forked worker (or warmed up without watching): no watcher thread runs here yet, and
+            # students may have changed since the gallery was loaded
+            self._start_watcher()
+            force = True
+        if self.streaming and not force:
+            return
+        if force or time.monotonic() - self._last_poll >= self.poll_interval:
+            self.poll()
+            self._refresh_snapshot()
+
+    def poll(self):
+        """Apply students inserted, updated or deleted since the last watermark"""
+        collection = self.get_collection()
+        if collection is None:
+            return
+        with self._lock:
+            since = self._watermark_time - self.clock_skew if self._watermark_time else None
+            last_id = self._watermark_id
+            polled_at = datetime.datetime.now()
+            self._last_poll = time.monotonic()
+
+            if last_id is None:
+                # No student was known at the last watermark, so every document is new
+                # (including ones without updated_at, written by older versions)
+                query = {}
+            elif since is None:
+                query = {'_id': {'$gt': last_id}}
+            else:
+                query = {'$or': [{'updated_at': {'$gte': since}}, {'_id': {'$gt': last_id}}]}
+
+            try:
+                changed = list(collection.find(query, STUDENT_PROJECTION))
+                # Collection metadata, not a scan; if it is off (orphans, unclean shutdown) a delete is
+                # still found by the periodic reconcile
+                total = collection.estimated_document_count()
+            except PyMongoError as e:
+                logger.error(f"Gallery poll failed: {str(e)}")
+                return
+
+            # The overlap window re-reads recent writes; skip the ones already applied
+            changed = [student for student in changed
+                       if student['_id'] not in self._recent or self._recent[student['_id']] != student.get('updated_at')]
+            for student in changed:
+                self._recent[student['_id']] = student.get('updated_at')
+            changes = [('upsert', student) for student in changed]
+            new_ids = [student['_id'] for student in changed if last_id is None or student['_id'] > last_id]
+            expected = self._known_count + len(new_ids)
+            reconcile_due = time.monotonic() - self._last_reconcile >= self.reconcile_interval
+            if total < expected or reconcile_due:
+                # Something was deleted; diff ids only, never re-fetch encodings
+                changes += self._deletions(collection)
+                self._last_reconcile = time.monotonic()
+            self.gallery.apply_changes(changes)
+            if changes:
+                self._snapshot_dirty = True
+
+            horizon = polled_at - self.clock_skew
+            self._recent = {doc_id: updated for doc_id, updated in self._recent.items()
+                            if updated is not None and updated >= horizon}
+            self._watermark_time = polled_at
+            if new_ids:
+                self._watermark_id = max(new_ids)
+            self._known_count = total
+        if changed:
+            logger.info(f"Gallery poll applied {len(changed)} changed students")
+
+    def _deletions(self, collection):
+        present = {doc['_id'] for doc in collection.find({}, {'_id': 1})}
+        return [('delete', doc_id) for doc_id in self.gallery.doc_ids() if doc_id not in present]
+
+    def apply_event(self, change):
+        """Apply a single change stream event to the gallery"""
+        op = change.get('operationType')
+        doc_id = change.get('documentKey', {}).get('_id')
+        with self._lock:
+            self._snapshot_dirty = True
+            if op in ('insert', 'update', 'replace'):
+                student = change.get('fullDocument')
+                if student is None:
+                    # Document was deleted before the lookup ran
+                    self.gallery.apply_changes([('delete', doc_id)])
+                else:
+                    self.gallery.apply_changes([('upsert', student)])
+                if op == 'insert':
+                    self._known_count += 1
+                    if self._watermark_id is None or doc_id > self._watermark_id:
+                        self._watermark_id = doc_id
+            elif op == 'delete':
+                self.gallery.apply_changes([('delete', doc_id)])
+                self._known_count = max(self._known_count - 1, 0)
+            elif op in ('drop', 'rename', 'invalidate'):
+                self.gallery.apply_changes([('delete', d) for d in self.gallery.doc_ids()])
+                self._known_count = 0
+                self._resume_token = None
+
+    def _start_watcher(self):
+        self._pid = os.getpid()
+        self._streaming = False
+        if not self.use_change_stream:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, name='gallery-sync', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the change stream watcher (used on shutdown and in tests)"""
+        self._stop.set()
+
+    def _watch(self):
+        while not self._stop.is_set():
+            collection = self.get_collection()
+            if collection is None:
+                self._stop.wait(self.poll_interval)
+                continue
+            try:
+                kwargs = {'full_document': 'updateLookup', 'max_await_time_ms': 1000}
+                if self._resume_token is not None:
+                    kwargs['resume_after'] = self._resume_token
+                with collection.watch(**kwargs) as stream:
+                    self._streaming = True
+                    # Catch anything written between the last watermark and the stream opening
+                    self.poll()
+                    while not self._stop.is_set() and stream.alive:
+                        change = stream.try_next()
+                        if change is not None:
+                            self.apply_event(change)
+                        self._resume_token = stream.resume_token
+                        self._refresh_snapshot()
+            except (NotImplementedError, TypeError, OperationFailure) as e:
+                if isinstance(e, OperationFailure) and self._resume_token is not None:
+                    # Resume point fell off the oplog; reopen and let the watermark poll catch up
+                    logger.warning(f"Gallery change stream could not resume: {str(e)}")
+                    self._resume_token = None
+                    continue
+                # Standalone servers and local stand-ins (mongomock) have no change streams
+                logger.info(f"Change streams unavailable, polling students every {self.poll_interval}s: {str(e)}")
+                return
+            except PyMongoError as e:
+                logger.error(f"Gallery change stream error, resuming: {str(e)}")
+                self._streaming = False
+                self._stop.wait(self.poll_interval)
+            finally:
+                self._streaming = False
@@ -0,0 +1,46 @@
+"""Production server settings: gunicorn -c gunicorn.conf.py app:app
+
+The app is imported once in the master (``preload_app``), which then loads the
+gallery (``app.warm_up``) before forking; workers inherit it copy-on-write and
+start serving without their own full gallery load. A memory-mapped gallery
+snapshot is only shared until a process applies its first student change,
+which builds the new matrix in that process's private memory; once students
+change, the workers rewrite the snapshot every few minutes (see gallery_sync).
+
+The face models are not shared: face jobs run in each worker's face worker
+pool, whose processes start from a fresh interpreter (forkserver or spawn)
+and load the models themselves. Each worker starts its pool in the
+background, sized so that the pools of all workers together run one process
+per CPU core (``EDUVISION_FACE_WORKERS`` overrides this).
+
+Live attendance streams keep their trackers in the memory of the worker that
+opened them, and gunicorn does not route a stream's requests back to it, so
+one worker process is run by default; face detection and encoding run in the
+face worker pool's processes anyway. To use more CPUs for the web tier, run
+several single-worker instances behind a proxy that routes
+``/take_attendance/stream/<stream_id>`` by stream id (e.g. nginx ``hash``),
+and set ``EDUVISION_FACE_WORKERS`` to the cores divided by the instances.
+"""
+import os
+import threading
+
+bind = os.environ.get('EDUVISION_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+# Requests mostly wait on the face worker processes and MongoDB, so threads keep a worker busy
+worker_class = 'gthread'
+threads = int(os.environ.get('EDUVISION_THREADS', 8))
+timeout = 120
+preload_app = True
+
+# Face worker processes per web worker; read by app.py, which the master imports after this file
+os.environ.setdefault('EDUVISION_FACE_WORKERS', str(max(1, (os.cpu_count() or 1) // workers)))
+
+
+def when_ready(server):
+    import app as eduvision
+    eduvision.warm_up()
+
+
+def post_worker_init(worker):
+    import app as eduvision
+    threading.Thread(target=eduvision.face_pool.warm_up, name='face-pool-warm-up', daemon=True).start()
@@ -0,0 +1,171 @@
+"""In-process metrics rendered in the Prometheus text exposition format.
+
+Counters, gauges and histograms are declared once and then updated with
+labels, e.g. ``registry.observe('eduvision_face_stage_seconds', 0.12,
+stage='hog')``. Collectors are callables that report values computed at
+scrape time (gallery size, connection pool counters, ...).
+
+A disabled registry returns immediately from every update, so
+instrumented code costs a function call and nothing else.
+
+Each process keeps its own registry; with several server processes, a
+scrape shows the process that answered it (see ``process_id``).
+"""
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from pymongo.monitoring import CommandListener
+
+# Seconds; covers a sub-millisecond gallery search up to a slow CNN detection
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, buckets, value):
+        self.counts[bisect.bisect_left(buckets, value)] += 1
+        self.sum += value
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+    return '{' + pairs + '}'
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return str(int(value))
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    """Thread-safe set of labelled counters, gauges and histograms"""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = []
+
+    def _declare(self, name, kind, help_text, buckets=None):
+        with self._lock:
+            self._metrics.setdefault(name, {'kind': kind, 'help': help_text, 'buckets': buckets, 'series': {}})
+
+    def counter(self, name, help_text):
+        self._declare(name, 'counter', help_text)
+
+    def gauge(self, name, help_text):
+        self._declare(name, 'gauge', help_text)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self._declare(name, 'histogram', help_text, tuple(buckets))
+
+    def add_collector(self, collector):
+        """Register ``collector()``, which returns ``(name, kind, help, value or [(labels, value)])`` tuples"""
+        self._collectors.append(collector)
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._metrics[name]['series']
+            series[key] = series.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._metrics[name]['series'][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            metric = self._metrics[name]
+            histogram = metric['series'].get(key)
+            if histogram is None:
+                histogram = metric['series'][key] = _Histogram(metric['buckets'])
+            histogram.observe(metric['buckets'], value)
+
+    def timer(self, name, **labels):
+        """Context manager that observes its duration in seconds"""
+        if not self.enabled:
+            return nullcontext()
+        return self._timer(name, labels)
+
+    @contextmanager
+    def _timer(self, name, labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def render(self):
+        """All metrics in the Prometheus text format (version 0.0.4)"""
+        lines = []
+        with self._lock:
+            snapshot = [
+                (name, metric['kind'], metric['help'], metric['buckets'], list(metric['series'].items()))
+                for name, metric in sorted(self._metrics.items())
+            ]
+        for name, kind, help_text, buckets, series in snapshot:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in series:
+                if kind != 'histogram':
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + (float('inf'),), value.counts):
+                    cumulative += count
+                    bucket_labels = labels + (('le', _format_value(float(bound))),)
+                    lines.append(f"{name}_bucket{_format_labels(bucket_labels)} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value.sum)}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+
+        lines.append("# HELP process_id Operating system id of the process serving this scrape")
+        lines.append("# TYPE process_id gauge")
+        lines.append(f"process_id {os.getpid()}")
+        for collector in self._collectors:
+            for name, kind, help_text, values in collector():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                if not isinstance(values, list):
+                    values = [({}, values)]
+                for labels, value in values:
+                    lines.append(f"{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+class CommandTimer(CommandListener):
+    """MongoDB command listener that records the latency of every command"""
+
+    def __init__(self, registry, name='eduvision_mongo_command_seconds'):
+        self.registry = registry
+        self.name = name
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.registry.observe(self.name, event.duration_micros / 1e6, command=event.command_name, outcome='ok')
+
+    def failed(self, event):
+        self.registry.observe(self.name, event.duration_micros / 1e6, command=event.command_name, outcome='error')
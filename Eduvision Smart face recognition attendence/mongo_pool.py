@@ -0,0 +1,182 @@
+"""Process-wide MongoDB client with pool metrics.
+
+One ``MongoClient`` (and therefore one connection pool) is shared by every
+request in a process. A new client is created after a fork, because pymongo
+clients must not be shared across processes. The server is pinged at most
+once per ``health_check_interval`` instead of on every ``get_db()`` call.
+"""
+import logging
+import os
+import threading
+import time
+
+from pymongo import MongoClient
+from pymongo.monitoring import ConnectionPoolListener
+
+logger = logging.getLogger('eduvision.mongo_pool')
+
+
+class PoolMetrics(ConnectionPoolListener):
+    """Connection pool event listener that keeps running counters"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wait_started = {}
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.connections_open = 0
+            self.checked_out = 0
+            self.checkouts = 0
+            self.checkout_failures = 0
+            self.wait_seconds_total = 0.0
+            self.wait_seconds_max = 0.0
+            self.pool_clears = 0
+            self._wait_started.clear()
+
+    def snapshot(self):
+        """Return the current counters as a dict"""
+        with self._lock:
+            return {
+                'connections_open': self.connections_open,
+                'checked_out': self.checked_out,
+                'checkouts': self.checkouts,
+                'checkout_failures': self.checkout_failures,
+                'wait_seconds_total': self.wait_seconds_total,
+                'wait_seconds_max': self.wait_seconds_max,
+                'wait_seconds_avg': self.wait_seconds_total / self.checkouts if self.checkouts else 0.0,
+                'pool_clears': self.pool_clears,
+            }
+
+    def _end_wait(self):
+        started = self._wait_started.pop(threading.get_ident(), None)
+        return 0.0 if started is None else time.perf_counter() - started
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pool_clears += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self.connections_open += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.connections_open -= 1
+
+    def connection_check_out_started(self, event):
+        with self._lock:
+            self._wait_started[threading.get_ident()] = time.perf_counter()
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self._end_wait()
+            self.checkout_failures += 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            wait = self._end_wait()
+            self.checked_out += 1
+            self.checkouts += 1
+            self.wait_seconds_total += wait
+            self.wait_seconds_max = max(self.wait_seconds_max, wait)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+
+class MongoClientManager:
+    """Lazily creates one MongoClient per process and hands out the database"""
+
+    def __init__(self, uri, db_name, max_pool_size=100, min_pool_size=0, wait_queue_timeout_ms=None,
+                 server_selection_timeout_ms=5000, connect_timeout_ms=10000, health_check_interval=30,
+                 event_listeners=()):
+        self.uri = uri
+        self.db_name = db_name
+        self.max_pool_size = max_pool_size
+        self.min_pool_size = min_pool_size
+        self.wait_queue_timeout_ms = wait_queue_timeout_ms
+        self.server_selection_timeout_ms = server_selection_timeout_ms
+        self.connect_timeout_ms = connect_timeout_ms
+        self.health_check_interval = health_check_interval
+        self.metrics = PoolMetrics()
+        # Extra pymongo monitoring listeners (e.g. command timings)
+        self.event_listeners = list(event_listeners)
+        self._lock = threading.Lock()
+        self._client = None
+        self._pid = None
+        self._last_healthy = None
+
+    def client(self):
+        """Return this process's MongoClient, creating it on first use or after a fork"""
+        with self._lock:
+            if self._client is None or self._pid != os.getpid():
+                # Don't close an inherited client: its sockets belong to the parent process
+                self.metrics.reset()
+                self._client = MongoClient(
+                    self.uri,
+                    maxPoolSize=self.max_pool_size,
+                    minPoolSize=self.min_pool_size,
+                    waitQueueTimeoutMS=self.wait_queue_timeout_ms,
+                    serverSelectionTimeoutMS=self.server_selection_timeout_ms,
+                    connectTimeoutMS=self.connect_timeout_ms,
+                    event_listeners=[self.metrics] + self.event_listeners
+                )
+                self._pid = os.getpid()
+                self._last_healthy = None
+                logger.info(f"Created MongoDB client (maxPoolSize={self.max_pool_size}) in process {self._pid}")
+            return self._client
+
+    def get_db(self):
+        """Return the database, pinging the server only when the last check is stale.
+
+        Raises the driver's exception when the health check fails.
+        """
+        client = self.client()
+        now = time.monotonic()
+        if self._last_healthy is None or now - self._last_healthy > self.health_check_interval:
+            try:
+                client.admin.command('ping')
+            except Exception:
+                self._last_healthy = None
+                raise
+            self._last_healthy = now
+        return client[self.db_name]
+
+    def close(self):
+        """Close this process's client, e.g. in a server master before it forks workers"""
+        with self._lock:
+            # An inherited client is only dropped: its sockets belong to the parent process
+            if self._client is not None and self._pid == os.getpid():
+                self._client.close()
+            self._client = None
+            self._pid = None
+            self._last_healthy = None
+
+    def mark_unhealthy(self):
+        """Force a health check on the next get_db() call"""
+        self._last_healthy = None
+
+    def pool_metrics(self):
+        """Pool counters plus configuration, for the metrics endpoints"""
+        stats = self.metrics.snapshot()
+        stats.update({
+            'max_pool_size': self.max_pool_size,
+            'min_pool_size': self.min_pool_size,
+            'pid': self._pid,
+        })
+        return stats
@@ -0,0 +1,123 @@
+"""Short-lived cache of faces recently recognized and recorded in each class.
+
+A kiosk streaming frames keeps sending the same faces after their students
+are marked present. A face within ``distance`` of a face confirmed in the
+same class within the last ``ttl`` seconds (and on the same day) resolves
+straight to that student, with no gallery search and no attendance write.
+"""
+import datetime
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+# One class's cached faces; rows of ``encodings`` line up with the other fields
+Entries = namedtuple('Entries', 'encodings students confidences expires day')
+
+
+class RecentRecognitions:
+    """Per-class TTL cache of ``encoding -> (student, confidence)`` for students already recorded today"""
+
+    def __init__(self, ttl=300, distance=0.3, max_per_class=500, clock=time.monotonic):
+        self.ttl = ttl
+        self.distance = distance
+        self.max_per_class = max_per_class
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._classes = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def _live(self, class_name, now, today):
+        entries = self._classes.get(class_name)
+        if entries is None:
+            return None
+        if entries.day != today:
+            del self._classes[class_name]
+            return None
+        alive = entries.expires > now
+        if not alive.all():
+            if not alive.any():
+                del self._classes[class_name]
+                return None
+            entries = Entries(entries.encodings[alive], [s for s, a in zip(entries.students, alive) if a],
+                              entries.confidences[alive], entries.expires[alive], today)
+            self._classes[class_name] = entries
+        return entries
+
+    def lookup(self, class_name, faces):
+        """Return ``(student, confidence)`` for each face found in the cache, or None for misses"""
+        faces = np.asarray(faces, dtype=np.float64).reshape(-1, 128)
+        results = [None] * len(faces)
+        if not self.enabled or not len(faces):
+            return results
+        with self._lock:
+            entries = self._live(class_name, self.clock(), datetime.date.today())
+        if entries is not None:
+            cached = entries.encodings
+            sq_dist = (np.einsum('ij,ij->i', faces, faces)[:, None] + np.einsum('ij,ij->i', cached, cached)[None, :]
+                       - 2.0 * (faces @ cached.T))
+            nearest = np.argmin(sq_dist, axis=1)
+            for i, row in enumerate(nearest):
+                if sq_dist[i, row] <= self.distance ** 2:
+                    results[i] = (entries.students[row], float(entries.confidences[row]))
+        hits = sum(result is not None for result in results)
+        with self._lock:
+            self.hits += hits
+            self.misses += len(results) - hits
+        return results
+
+    def remember(self, class_name, faces, matches):
+        """Cache faces whose students are now recorded for ``class_name`` today.
+
+        ``matches`` holds ``(student, confidence)`` per face; unmatched faces
+        (``student`` is None) are not cached.
+        """
+        if not self.enabled:
+            return
+        keep = [i for i, (student, _) in enumerate(matches) if student]
+        if not keep:
+            return
+        faces = np.asarray(faces, dtype=np.float64).reshape(-1, 128)[keep]
+        students = [matches[i][0] for i in keep]
+        confidences = np.array([matches[i][1] for i in keep], dtype=np.float64)
+        now = self.clock()
+        today = datetime.date.today()
+        expires = np.full(len(keep), now + self.ttl)
+
+        with self._lock:
+            entries = self._live(class_name, now, today)
+            if entries is not None:
+                faces = np.vstack([entries.encodings, faces])
+                students = entries.students + students
+                confidences = np.concatenate([entries.confidences, confidences])
+                expires = np.concatenate([entries.expires, expires])
+            # Over the cap, the oldest faces go first
+            start = max(0, len(students) - self.max_per_class)
+            self._classes[class_name] = Entries(faces[start:], students[start:], confidences[start:],
+                                                expires[start:], today)
+
+    def clear(self, class_name=None):
+        with self._lock:
+            if class_name is None:
+                self._classes.clear()
+            else:
+                self._classes.pop(class_name, None)
+
+    def stats(self):
+        """Hit/miss counters and current size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'classes': len(self._classes),
+                'entries': sum(len(entries.students) for entries in self._classes.values()),
+            }
@@ -0,0 +1,74 @@
+"""Paginated student listing for the dashboard and the students page.
+
+Students are listed newest first with keyset ("cursor") pagination on
+``(registration_date, _id)``, backed by an index on the same keys, so every
+page costs the same however deep it is. The projection leaves out the face
+encodings and templates; a listing never needs them.
+"""
+import base64
+import datetime
+import re
+
+from bson import ObjectId
+from pymongo import DESCENDING
+
+PROJECTION = {'_id': 1, 'student_id': 1, 'name': 1, 'classes': 1, 'registration_date': 1}
+SORT = [('registration_date', DESCENDING), ('_id', DESCENDING)]
+
+
+def ensure_indexes(db):
+    db.students.create_index(SORT, name='registration_date_id')
+
+
+def encode_cursor(student):
+    """Opaque cursor pointing just after ``student``"""
+    registered = student.get('registration_date')
+    stamp = registered.isoformat() if registered else ''
+    return base64.urlsafe_b64encode(f"{stamp}|{student['_id']}".encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return ``(registration_date or None, _id)``; raises ValueError for malformed cursors"""
+    try:
+        stamp, _, object_id = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().partition('|')
+        return (datetime.datetime.fromisoformat(stamp) if stamp else None), ObjectId(object_id)
+    except Exception:
+        raise ValueError('invalid cursor')
+
+
+def _after(cursor):
+    registered, object_id = decode_cursor(cursor)
+    if registered is None:
+        # Students without a registration date sort last
+        return {'registration_date': None, '_id': {'$lt': object_id}}
+    return {'$or': [
+        {'registration_date': {'$lt': registered}},
+        {'registration_date': registered, '_id': {'$lt': object_id}},
+        {'registration_date': None},
+    ]}
+
+
+def search_filter(search):
+    """Students whose id starts with ``search`` or whose name contains it (case-insensitive)"""
+    pattern = re.escape(search.strip())
+    return {'$or': [
+        {'student_id': {'$regex': f'^{pattern}'}},
+        {'name': {'$regex': pattern, '$options': 'i'}},
+    ]}
+
+
+def list_students(collection, limit=25, cursor=None, search=None):
+    """Return ``(students, next_cursor)``; ``next_cursor`` is None on the last page"""
+    clauses = []
+    if search and search.strip():
+        clauses.append(search_filter(search))
+    if cursor:
+        clauses.append(_after(cursor))
+    query = {'$and': clauses} if len(clauses) > 1 else (clauses[0] if clauses else {})
+
+    # One extra document tells whether another page follows
+    students = list(collection.find(query, PROJECTION).sort(SORT).limit(limit + 1))
+    if len(students) <= limit:
+        return students, None
+    students = students[:limit]
+    return students, encode_cursor(students[-1])
@@ -0,0 +1,103 @@
+"""One attendance record per student, class and day (on mongomock)."""
+import datetime
+
+import mongomock
+import pytest
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+import attendance_records
+
+MORNING = datetime.datetime(2024, 3, 4, 9, 0)
+
+
+@pytest.fixture
+def db():
+    db = mongomock.MongoClient().eduvision_test
+    attendance_records.ensure_indexes(db)
+    return db
+
+
+def test_records_each_student_once(db):
+    new = attendance_records.record(db, 'CS101', {'S1': 90.0, 'S2': 80.0}, MORNING)
+    assert sorted(r['student_id'] for r in new) == ['S1', 'S2']
+    assert all(r['day'] == '2024-03-04' and r['class_name'] == 'CS101' for r in new)
+    assert {r['_id'] for r in new} == {doc['_id'] for doc in db.attendance.find()}
+
+
+def test_same_student_twice_in_one_day(db):
+    attendance_records.record(db, 'CS101', {'S1': 90.0}, MORNING)
+    later = attendance_records.record(db, 'CS101', {'S1': 99.0, 'S2': 70.0}, MORNING + datetime.timedelta(hours=3))
+
+    # Only S2 is new (mongomock numbers upserts by count, not operation index, so check the ids)
+    assert [r['_id'] for r in later] == [db.attendance.find_one({'student_id': 'S2'})['_id']]
+    first = db.attendance.find_one({'student_id': 'S1'})
+    # The first record is left as it was
+    assert (first['confidence'], first['timestamp']) == (90.0, MORNING)
+    assert db.attendance.count_documents({'student_id': 'S1'}) == 1
+
+
+def test_two_classes_and_two_days(db):
+    attendance_records.record(db, 'CS101', {'S1': 90.0}, MORNING)
+    assert len(attendance_records.record(db, 'MATH200', {'S1': 90.0}, MORNING)) == 1
+    assert len(attendance_records.record(db, 'CS101', {'S1': 90.0}, MORNING + datetime.timedelta(days=1))) == 1
+    assert db.attendance.count_documents({'student_id': 'S1'}) == 3
+
+
+def test_unique_index_rejects_a_second_record(db):
+    attendance_records.record(db, 'CS101', {'S1': 90.0}, MORNING)
+    with pytest.raises(DuplicateKeyError):
+        db.attendance.insert_one({'student_id': 'S1', 'class_name': 'CS101', 'day': '2024-03-04'})
+    # Legacy records without day are outside the (partial) index
+    db.attendance.insert_many([{'student_id': 'S1', 'class_name': 'CS101', 'timestamp': MORNING} for _ in range(2)])
+    assert db.attendance.count_documents({'student_id': 'S1'}) == 3
+
+
+def test_concurrent_duplicates_count_as_already_recorded(db, monkeypatch):
+    inserted = ObjectId()
+
+    def racing_bulk_write(self, operations, ordered=True):
+        # Another request upserted S1 between our filter match and insert
+        raise BulkWriteError({'writeErrors': [{'index': 0, 'code': attendance_records.DUPLICATE_KEY}],
+                              'upserted': [{'index': 1, '_id': inserted}], 'nModified': 0})
+
+    monkeypatch.setattr(mongomock.collection.Collection, 'bulk_write', racing_bulk_write)
+    new = attendance_records.record(db, 'CS101', {'S1': 90.0, 'S2': 80.0}, MORNING)
+    assert [(r['student_id'], r['_id']) for r in new] == [('S2', inserted)]
+
+
+def test_other_write_errors_are_raised(db, monkeypatch):
+    def failing_bulk_write(self, operations, ordered=True):
+        raise BulkWriteError({'writeErrors': [{'index': 0, 'code': 121}], 'upserted': []})
+
+    monkeypatch.setattr(mongomock.collection.Collection, 'bulk_write', failing_bulk_write)
+    with pytest.raises(BulkWriteError):
+        attendance_records.record(db, 'CS101', {'S1': 90.0}, MORNING)
+
+
+def test_backfill_gives_legacy_records_a_day(db):
+    legacy = {'student_id': 'S1', 'class_name': 'CS101'}
+    db.attendance.insert_many([
+        dict(legacy, timestamp=MORNING),
+        dict(legacy, timestamp=MORNING + datetime.timedelta(hours=1)),
+        dict(legacy, class_name='MATH200', timestamp=MORNING),
+    ])
+
+    assert attendance_records.backfill_days(db) == (2, 1)
+    earliest = db.attendance.find_one({'class_name': 'CS101', 'day': '2024-03-04'})
+    assert earliest['timestamp'] == MORNING
+    assert db.attendance.count_documents({'day': {'$exists': False}}) == 1
+    # Backfilled records now stop the same student being recorded again that day
+    assert attendance_records.record(db, 'CS101', {'S1': 90.0}, MORNING + datetime.timedelta(hours=2)) == []
+    # The later duplicate now collides with the backfilled record and keeps no day
+    assert attendance_records.backfill_days(db) == (0, 0)
+    assert db.attendance.count_documents({'day': {'$exists': False}}) == 1
+
+
+def test_backfill_skips_legacy_records_already_recorded_with_a_day(db):
+    attendance_records.record(db, 'CS101', {'S1': 90.0}, MORNING)
+    db.attendance.insert_one({'student_id': 'S1', 'class_name': 'CS101', 'timestamp': MORNING})
+
+    updated, _ = attendance_records.backfill_days(db, since=MORNING - datetime.timedelta(days=1))
+    assert updated == 0
+    assert db.attendance.count_documents({'student_id': 'S1', 'day': '2024-03-04'}) == 1
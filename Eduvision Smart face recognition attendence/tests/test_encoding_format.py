@@ -0,0 +1,81 @@
+"""Stored encoding format: header round-trips, legacy float64 bytes and the migration (on mongomock)."""
+import mongomock
+import numpy as np
+import pytest
+from bson import Binary
+
+import encoding_format
+
+
+@pytest.fixture
+def encoding():
+    return np.random.default_rng(0).normal(0, 0.1, size=128)
+
+
+@pytest.mark.parametrize('dtype, size', [('float64', 1024), ('float32', 512), ('float16', 256)])
+def test_round_trip(encoding, dtype, size):
+    raw = encoding_format.encode(encoding, dtype=dtype)
+    assert len(raw) == encoding_format.HEADER.size + size
+    assert encoding_format.describe(raw) == {'version': encoding_format.VERSION, 'dtype': np.dtype(dtype),
+                                             'dim': 128, 'model': encoding_format.DEFAULT_MODEL}
+
+    decoded = encoding_format.decode(raw)
+    assert decoded.dtype == np.dtype(dtype) and decoded.shape == (128,)
+    np.testing.assert_allclose(decoded, encoding, atol=1e-3 if dtype == 'float16' else 1e-7)
+
+
+def test_header_keeps_dimension_and_model():
+    raw = encoding_format.encode(np.arange(64, dtype=np.float32), model=7)
+    assert raw[:2] == encoding_format.MAGIC
+    info = encoding_format.describe(raw)
+    assert (info['dim'], info['model']) == (64, 7)
+    np.testing.assert_array_equal(encoding_format.decode(raw), np.arange(64))
+
+
+def test_decodes_legacy_float64_bytes(encoding):
+    # Written before the header existed: bare float64 bytes, as returned by MongoDB (bson Binary)
+    raw = Binary(encoding.astype(np.float64).tobytes())
+    info = encoding_format.describe(raw)
+    assert info['version'] == encoding_format.LEGACY
+    assert (info['dtype'], info['dim']) == (np.dtype('float64'), 128)
+    np.testing.assert_array_equal(encoding_format.decode(raw), encoding)
+    assert not encoding_format.is_current(raw, 'float64')
+
+
+def test_rejects_unknown_data(encoding):
+    with pytest.raises(ValueError):
+        encoding_format.describe(b'\x00' * 13)
+    with pytest.raises(ValueError):
+        encoding_format.encode(encoding, dtype='int32')
+    future = bytearray(encoding_format.encode(encoding))
+    future[2] = encoding_format.VERSION + 1
+    with pytest.raises(ValueError):
+        encoding_format.describe(bytes(future))
+
+
+def test_is_current(encoding):
+    assert encoding_format.is_current(encoding_format.encode(encoding, dtype='float32'), 'float32')
+    assert not encoding_format.is_current(encoding_format.encode(encoding, dtype='float32'), 'float16')
+
+
+def test_migrate_converts_legacy_documents(encoding):
+    students = mongomock.MongoClient().eduvision_test.students
+    legacy = encoding.tobytes()
+    students.insert_many([
+        {'student_id': 'OLD', 'face_encoding': legacy, 'face_templates': [legacy, legacy]},
+        {'student_id': 'NEW', 'face_encoding': encoding_format.encode(encoding)},
+        {'student_id': 'BAD', 'face_encoding': b'\x00' * 13},
+    ])
+
+    assert encoding_format.migrate(students, dry_run=True) == {'scanned': 3, 'converted': 1, 'skipped': 1, 'failed': 1}
+    assert students.find_one({'student_id': 'OLD'})['face_encoding'] == legacy
+
+    assert encoding_format.migrate(students, batch_size=2) == {'scanned': 3, 'converted': 1, 'skipped': 1,
+                                                                 'failed': 1}
+    old = students.find_one({'student_id': 'OLD'})
+    for raw in [old['face_encoding']] + old['face_templates']:
+        assert encoding_format.is_current(raw, 'float32')
+        np.testing.assert_allclose(encoding_format.decode(raw), encoding, atol=1e-7)
+
+    # Re-running finds nothing left to convert
+    assert encoding_format.migrate(students)['converted'] == 0
@@ -0,0 +1,92 @@
+"""Incremental FaceGallery changes: appends into spare capacity, dead students and compaction."""
+import numpy as np
+import pytest
+
+import encoding_format
+from gallery import FaceGallery
+
+
+def make_student(student_id, seed, classes=('CS101',), templates=1):
+    encodings = np.random.default_rng(seed).normal(0, 0.1, size=(templates, 128))
+    student = {'_id': student_id, 'student_id': student_id, 'name': f'Student {student_id}', 'classes': list(classes),
+               'face_templates': [encoding_format.encode(encoding) for encoding in encodings]}
+    return student, encodings
+
+
+@pytest.fixture
+def gallery():
+    gallery = FaceGallery(dtype='float32', compact_ratio=0.5)
+    gallery.load([make_student(f'S{i}', i, templates=1 + i % 3)[0] for i in range(10)])
+    return gallery
+
+
+def matched_id(gallery, encoding, class_name=None):
+    student, _ = gallery.match([encoding], class_name=class_name, fallback=False)[0]
+    return student['student_id'] if student else None
+
+
+def test_appends_reuse_the_buffer_without_copying(gallery):
+    gallery.upsert(make_student('N0', 100)[0])
+    buffer = gallery._buffer
+    for i in range(1, 20):
+        gallery.upsert(make_student(f'N{i}', 100 + i)[0])
+    assert gallery._buffer is buffer
+    assert np.shares_memory(gallery._state.matrix, buffer)
+    assert len(gallery) == 30
+
+
+def test_older_states_are_unchanged_by_appends(gallery):
+    before = gallery._state
+    matrix = before.matrix.copy()
+    gallery.upsert(make_student('N0', 100)[0])
+    gallery.upsert(make_student('N1', 101)[0])
+    np.testing.assert_array_equal(before.matrix, matrix)
+    assert len(before.doc_ids) == 10
+
+
+def test_replaced_and_deleted_students_are_not_matched(gallery):
+    _, old = make_student('S4', 4, templates=2)
+    replacement, new = make_student('S4', 200, classes=('MATH200',))
+    gallery.apply_changes([('upsert', replacement), ('delete', 'S5')])
+
+    assert gallery._state.dead_templates == 2 + 3
+    assert matched_id(gallery, old[0]) is None
+    assert matched_id(gallery, new[0]) == 'S4'
+    assert matched_id(gallery, make_student('S5', 5, templates=3)[1][0]) is None
+    assert len(gallery) == 9
+    assert gallery.template_count == sum(1 + i % 3 for i in range(10)) - 5 + 1
+    assert 'S4' not in gallery.roster('CS101') and gallery.roster('MATH200') == ['S4']
+    assert matched_id(gallery, new[0], class_name='MATH200') == 'S4'
+    assert matched_id(gallery, old[0], class_name='CS101') is None
+
+
+def test_roster_edits_keep_matching_in_both_classes(gallery):
+    student, encodings = make_student('S2', 2, classes=('CS101', 'BIO1'), templates=3)
+    gallery.upsert(student)
+    assert matched_id(gallery, encodings[2], class_name='BIO1') == 'S2'
+    assert matched_id(gallery, encodings[2], class_name='CS101') == 'S2'
+    assert sorted(gallery.roster('CS101')) == sorted(f'S{i}' for i in range(10))
+
+
+def test_compacts_once_dead_templates_pass_the_ratio(gallery):
+    gallery.apply_changes([('delete', f'S{i}') for i in range(3)])
+    assert gallery._state.dead_templates == 6
+    gallery.apply_changes([('delete', f'S{i}') for i in range(3, 6)])
+
+    state = gallery._state
+    assert state.dead_templates == 0 and not state.dead.any()
+    assert gallery.doc_ids() == [f'S{i}' for i in range(6, 10)]
+    assert len(state.matrix) == gallery.template_count == sum(1 + i % 3 for i in range(6, 10))
+    assert all(matched_id(gallery, make_student(f'S{i}', i, templates=3)[1][0]) == f'S{i}' for i in range(6, 10))
+
+
+def test_export_leaves_out_dead_students(gallery):
+    gallery.apply_changes([('delete', 'S1'), ('upsert', make_student('N0', 100, templates=2)[0])])
+    contents = gallery.export()
+    assert contents['doc_ids'] == [f'S{i}' for i in range(10) if i != 1] + ['N0']
+    assert len(contents['matrix']) == sum(contents['counts']) == gallery.template_count
+
+    reloaded = FaceGallery(dtype='float32')
+    reloaded.load_arrays(**contents)
+    encoding = make_student('N0', 100, templates=2)[1][1]
+    assert matched_id(reloaded, encoding) == matched_id(gallery, encoding) == 'N0'
@@ -0,0 +1,71 @@
+"""Incremental gallery changes with the IVF index: existing cells are kept, only changed rows are assigned."""
+import numpy as np
+import pytest
+
+import encoding_format
+import gallery_index
+from gallery import FaceGallery
+from gallery_index import ExactSearcher, IVFIndex, IVFSearcher
+
+
+def make_students(count, seed=0, prefix='S'):
+    encodings = np.random.default_rng(seed).normal(0, 0.1, size=(count, 128))
+    return [{'_id': f'{prefix}{i}', 'student_id': f'{prefix}{i}', 'name': f'{prefix}{i}',
+             'face_encoding': encoding_format.encode(encoding)} for i, encoding in enumerate(encodings)], encodings
+
+
+@pytest.fixture
+def ivf_gallery():
+    students, encodings = make_students(400)
+    gallery = FaceGallery(dtype='float32', index=IVFIndex(nlist=16, nprobe=16, min_size=100))
+    gallery.load(students)
+    return gallery, students, encodings
+
+
+def matched_id(gallery, encoding):
+    student, _ = gallery.match([encoding])[0]
+    return student['student_id'] if student else None
+
+
+def test_changes_assign_only_new_rows_without_retraining(ivf_gallery, monkeypatch):
+    gallery, students, _ = ivf_gallery
+    index = gallery.index
+    before = gallery._state.searcher
+    assert isinstance(before, IVFSearcher)
+
+    assigned = []
+    nearest = gallery_index._nearest
+    monkeypatch.setattr(gallery_index, '_nearest', lambda points, *args: assigned.append(len(points))
+                        or nearest(points, *args))
+    monkeypatch.setattr(index, 'train', lambda matrix: pytest.fail('incremental change retrained the index'))
+
+    new_students, new_encodings = make_students(3, seed=1, prefix='N')
+    gallery.apply_changes([('upsert', student) for student in new_students] + [('delete', students[5]['_id'])])
+    after = gallery._state.searcher
+
+    assert assigned == [3]
+    assert after.centroids is before.centroids
+    # The deleted student keeps its row (marked dead) until the gallery is compacted
+    np.testing.assert_array_equal(after.assignments[:len(students)], before.assignments)
+    assert 'S5' not in gallery
+    assert all(matched_id(gallery, encoding) == student['student_id']
+               for student, encoding in zip(new_students, new_encodings))
+
+
+def test_incremental_state_matches_a_full_build(ivf_gallery):
+    gallery, students, encodings = ivf_gallery
+    replaced, replacement = make_students(1, seed=2)
+    gallery.apply_changes([('upsert', dict(replaced[0], _id='S7', student_id='S7'))])
+    searcher = gallery._state.searcher
+    rebuilt = gallery.index.build(gallery._state.matrix, gallery._state.segments)
+
+    np.testing.assert_array_equal(searcher.assignments, rebuilt.assignments)
+    np.testing.assert_allclose(searcher.sq_norms, rebuilt.sq_norms, rtol=1e-6)
+    assert matched_id(gallery, replacement[0]) == 'S7'
+    assert matched_id(gallery, encodings[8]) == 'S8'
+
+
+def test_shrinking_below_min_size_searches_exactly(ivf_gallery):
+    gallery, students, _ = ivf_gallery
+    gallery.apply_changes([('delete', student['_id']) for student in students[:350]])
+    assert isinstance(gallery._state.searcher, ExactSearcher)
@@ -0,0 +1,260 @@
+"""GallerySync against a mongomock students collection (no change streams, so the polling path)."""
+import datetime
+import os
+
+import mongomock
+import numpy as np
+import pytest
+from bson import ObjectId
+
+import encoding_format
+import gallery_snapshot
+from gallery import FaceGallery
+from gallery_sync import GallerySync
+
+
+@pytest.fixture
+def students():
+    return mongomock.MongoClient().eduvision_test.students
+
+
+def make_student(student_id, seed, classes=('CS101',), updated_at=True):
+    encoding = np.random.default_rng(seed).normal(0, 0.1, size=128)
+    student = {
+        'student_id': student_id,
+        'name': f'Student {student_id}',
+        'classes': list(classes),
+        'face_encoding': encoding_format.encode(encoding),
+    }
+    if updated_at:
+        student['updated_at'] = datetime.datetime.now()
+    return student, encoding
+
+
+def make_sync(students, **kwargs):
+    gallery = FaceGallery(dtype='float32')
+    kwargs.setdefault('use_change_stream', False)
+    return gallery, GallerySync(gallery, lambda: students, **kwargs)
+
+
+def matched_id(gallery, encoding):
+    student, _ = gallery.match([encoding])[0]
+    return student['student_id'] if student else None
+
+
+def test_warm_up_loads_every_student(students):
+    encodings = {}
+    for i in range(5):
+        student, encodings[f'S{i}'] = make_student(f'S{i}', i)
+        students.insert_one(student)
+    gallery, sync = make_sync(students)
+
+    assert sync.warm_up()
+    assert len(gallery) == 5
+    assert all(matched_id(gallery, encoding) == student_id for student_id, encoding in encodings.items())
+
+
+def test_poll_applies_inserts(students):
+    gallery, sync = make_sync(students)
+    sync.warm_up()
+    student, encoding = make_student('NEW', 1)
+    students.insert_one(student)
+
+    sync.refresh(force=True)
+    assert len(gallery) == 1
+    assert matched_id(gallery, encoding) == 'NEW'
+
+
+def test_poll_applies_updates(students):
+    student, _ = make_student('S1', 1)
+    doc_id = students.insert_one(student).inserted_id
+    gallery, sync = make_sync(students)
+    sync.warm_up()
+
+    _, new_encoding = make_student('S1', 2)
+    students.update_one({'_id': doc_id}, {'$set': {
+        'classes': ['MATH200'],
+        'face_encoding': encoding_format.encode(new_encoding),
+        # MongoDB keeps milliseconds; make sure the update is distinguishable from the insert
+        'updated_at': student['updated_at'] + datetime.timedelta(seconds=1),
+    }})
+    sync.refresh(force=True)
+
+    assert len(gallery) == 1
+    assert gallery.roster('MATH200') == ['S1']
+    assert gallery.roster('CS101') == []
+    assert matched_id(gallery, new_encoding) == 'S1'
+
+
+def test_poll_applies_deletes(students):
+    ids = [students.insert_one(make_student(f'S{i}', i)[0]).inserted_id for i in range(3)]
+    gallery, sync = make_sync(students)
+    sync.warm_up()
+
+    students.delete_one({'_id': ids[1]})
+    sync.refresh(force=True)
+    assert ids[1] not in gallery
+    assert len(gallery) == 2
+
+
+@pytest.mark.parametrize('existing', [0, 2])
+def test_watermark_picks_up_documents_without_updated_at(students, existing):
+    for i in range(existing):
+        students.insert_one(make_student(f'S{i}', i)[0])
+    gallery, sync = make_sync(students)
+    sync.warm_up()
+    # Written by an older version that did not set updated_at; found through the _id watermark
+    # (or, when the collection was empty, because every document is new)
+    legacy, encoding = make_student('LEGACY', 3, updated_at=False)
+    students.insert_one(legacy)
+
+    sync.refresh(force=True)
+    assert len(gallery) == existing + 1
+    assert matched_id(gallery, encoding) == 'LEGACY'
+
+
+def test_repeated_polls_do_not_reapply_unchanged_students(students, monkeypatch):
+    students.insert_one(make_student('S1', 1)[0])
+    gallery, sync = make_sync(students)
+    sync.warm_up()
+    applied = []
+    original = gallery.apply_changes
+    monkeypatch.setattr(gallery, 'apply_changes', lambda changes: applied.append(changes) or original(changes))
+
+    sync.refresh(force=True)
+    sync.refresh(force=True)
+    assert all(not changes for changes in applied)
+
+
+def test_refresh_polls_only_after_the_interval(students):
+    gallery, sync = make_sync(students, poll_interval=3600)
+    sync.warm_up()
+    students.insert_one(make_student('LATE', 4)[0])
+
+    sync.refresh()
+    assert len(gallery) == 0
+    sync.refresh(force=True)
+    assert len(gallery) == 1
+
+
+def test_falls_back_to_polling_without_change_streams(students):
+    # mongomock has no change streams, like a standalone server
+    gallery, sync = make_sync(students, use_change_stream=True)
+    sync.warm_up()
+    sync._thread.join(timeout=5)
+    assert not sync._thread.is_alive()
+    assert not sync.streaming
+
+    student, encoding = make_student('POLLED', 5)
+    students.insert_one(student)
+    sync.refresh(force=True)
+    assert matched_id(gallery, encoding) == 'POLLED'
+
+
+def test_deletes_are_found_by_the_document_count(students):
+    ids = [students.insert_one(make_student(f'S{i}', i)[0]).inserted_id for i in range(3)]
+    gallery, sync = make_sync(students, reconcile_interval=3600)
+    sync.warm_up()
+
+    # A delete and an insert in the same poll: the insert is new, so the count still falls short
+    students.delete_one({'_id': ids[0]})
+    students.insert_one(make_student('S9', 9)[0])
+    sync.refresh(force=True)
+    assert ids[0] not in gallery
+    assert len(gallery) == 3
+
+
+def test_reconcile_finds_deletes_hidden_from_the_count(students):
+    ids = [students.insert_one(make_student(f'S{i}', i)[0]).inserted_id for i in range(3)]
+    gallery, sync = make_sync(students, reconcile_interval=3600)
+    sync.warm_up()
+
+    # A client-generated _id below the watermark is not counted as new, so the count looks unchanged
+    students.delete_one({'_id': ids[0]})
+    old_id = ObjectId.from_datetime(datetime.datetime(2020, 1, 1))
+    students.insert_one(dict(make_student('S9', 9)[0], _id=old_id))
+    sync.refresh(force=True)
+    assert old_id in gallery
+    assert ids[0] in gallery
+
+    sync.reconcile_interval = 0
+    sync.refresh(force=True)
+    assert ids[0] not in gallery
+    assert len(gallery) == 3
+
+
+def test_change_stream_events(students):
+    gallery, sync = make_sync(students)
+    sync.warm_up()
+    student, encoding = make_student('EV', 6)
+    student['_id'] = doc_id = students.insert_one(student).inserted_id
+
+    sync.apply_event({'operationType': 'insert', 'documentKey': {'_id': doc_id}, 'fullDocument': student})
+    assert matched_id(gallery, encoding) == 'EV'
+    sync.apply_event({'operationType': 'update', 'documentKey': {'_id': doc_id},
+                      'fullDocument': dict(student, classes=['BIO1'])})
+    assert gallery.roster('BIO1') == ['EV']
+    sync.apply_event({'operationType': 'delete', 'documentKey': {'_id': doc_id}})
+    assert doc_id not in gallery
+
+
+def test_polls_do_not_count_documents(students, monkeypatch):
+    students.insert_one(make_student('S1', 1)[0])
+    gallery, sync = make_sync(students)
+    sync.warm_up()
+    # A full count is an aggregation over the collection; polls use the collection metadata
+    estimated = []
+    monkeypatch.setattr(type(students), 'estimated_document_count',
+                        lambda collection, **kwargs: estimated.append(1) or len(list(collection.find({}, {'_id': 1}))))
+    monkeypatch.setattr(type(students), 'count_documents', lambda *args, **kwargs: pytest.fail('count_documents'))
+
+    students.insert_one(make_student('S2', 2)[0])
+    sync.refresh(force=True)
+    assert len(gallery) == 2
+    assert estimated
+
+
+
+def snapshot_ids(path):
+    return gallery_snapshot.load(str(path), 'float32')['student_ids']
+
+
+def age_snapshot(path, seconds):
+    meta = os.path.join(str(path), gallery_snapshot.META_FILE)
+    written = os.path.getmtime(meta) - seconds
+    os.utime(meta, (written, written))
+    return written
+
+
+def test_snapshot_is_rewritten_after_a_catch_up(students, tmp_path):
+    students.insert_one(make_student('S1', 1)[0])
+    make_sync(students, snapshot_path=str(tmp_path))[1].warm_up()
+    student, encoding = make_student('S2', 2)
+    students.insert_one(student)
+
+    # The next process catches up from the snapshot and saves what it applied
+    gallery, sync = make_sync(students, snapshot_path=str(tmp_path))
+    assert sync.warm_up()
+    assert matched_id(gallery, encoding) == 'S2'
+    assert snapshot_ids(tmp_path) == ['S1', 'S2']
+
+
+def test_snapshot_is_refreshed_on_the_reconcile_interval(students, tmp_path):
+    students.insert_one(make_student('S1', 1)[0])
+    gallery, sync = make_sync(students, snapshot_path=str(tmp_path), reconcile_interval=3600)
+    sync.warm_up()
+    students.insert_one(make_student('S2', 2)[0])
+
+    # Written less than reconcile_interval ago (by this or another worker): left alone
+    sync.refresh(force=True)
+    assert len(gallery) == 2
+    assert snapshot_ids(tmp_path) == ['S1']
+
+    age_snapshot(tmp_path, 3600)
+    sync.refresh(force=True)
+    assert snapshot_ids(tmp_path) == ['S1', 'S2']
+
+    # Nothing changed since: an old snapshot is not rewritten
+    written = age_snapshot(tmp_path, 3600)
+    sync.refresh(force=True)
+    assert os.path.getmtime(os.path.join(str(tmp_path), gallery_snapshot.META_FILE)) == written